@@ -0,0 +1,211 @@
+"""
+This module loads a directory of NDJSON resource files into a FHIR server
+with the Bulk Data $import operation.
+
+The files are served from a local HTTP file server that the FHIR server must
+be able to reach. A $import job is kicked off with one input per file, and
+its status endpoint is polled until the job completes. The completion
+manifest lists the number of resources imported per file and the
+OperationOutcome files of any errors.
+
+Reference: https://github.com/smart-on-fhir/bulk-import/blob/master/import.md
+"""
+import socket
+import threading
+import time
+from collections import defaultdict
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urljoin
+
+import requests
+
+from kf_model_fhir.common.ndjson import resource_files
+
+NDJSON_TYPE = "application/fhir+ndjson"
+
+
+class BulkImportError(Exception):
+    pass
+
+
+class NdjsonRequestHandler(SimpleHTTPRequestHandler):
+    extensions_map = {
+        **SimpleHTTPRequestHandler.extensions_map,
+        ".ndjson": NDJSON_TYPE,
+    }
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_directory(directory, port=0, host=""):
+    """
+    Serve the files of a directory from a background thread and return the
+    server, whose server_address holds the port actually bound.
+    """
+    server = ThreadingHTTPServer(
+        (host, port), partial(NdjsonRequestHandler, directory=directory)
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def import_parameters(source, inputs):
+    """
+    Build the Parameters resource of a $import request for the files of a
+    source URL given as a list of (resource type, file URL) inputs.
+    """
+    parameter = [
+        {"name": "inputFormat", "valueCode": NDJSON_TYPE},
+        {"name": "inputSource", "valueUri": source},
+        {
+            "name": "storageDetail",
+            "part": [{"name": "type", "valueCode": "https"}],
+        },
+    ]
+    for resource_type, url in inputs:
+        parameter.append(
+            {
+                "name": "input",
+                "part": [
+                    {"name": "type", "valueCode": resource_type},
+                    {"name": "url", "valueUri": url},
+                ],
+            }
+        )
+    return {"resourceType": "Parameters", "parameter": parameter}
+
+
+def kick_off(session, base_url, parameters):
+    """
+    Start a $import job and return the URL of its status endpoint.
+    """
+    response = session.post(
+        f"{base_url}/$import",
+        json=parameters,
+        headers={
+            "Prefer": "respond-async",
+            "Accept": "application/fhir+json",
+            "Content-Type": "application/fhir+json",
+        },
+    )
+    if response.status_code != 202:
+        raise BulkImportError(
+            f"$import kick-off returned {response.status_code}:\n"
+            f"{response.text}"
+        )
+    location = response.headers.get("Content-Location")
+    if not location:
+        raise BulkImportError("$import kick-off returned no Content-Location")
+    return urljoin(f"{base_url}/", location)
+
+
+def retry_after(response, default):
+    try:
+        return max(float(response.headers["Retry-After"]), 0)
+    except (KeyError, ValueError):
+        return default
+
+
+def poll(session, status_url, interval=10, timeout=None, progress=print):
+    """
+    Poll a $import status endpoint until the job completes and return the
+    completion manifest.
+
+    The endpoint answers 202 while the job is running, with an optional
+    X-Progress header and a Retry-After header that is honored over the
+    default interval, and 200 with the manifest once it is done. Anything
+    else means that the job failed.
+    """
+    started = time.monotonic()
+    while True:
+        response = session.get(
+            status_url, headers={"Accept": "application/json"}
+        )
+        if response.status_code == 200:
+            return response.json()
+        if response.status_code != 202:
+            raise BulkImportError(
+                f"$import status returned {response.status_code}:\n"
+                f"{response.text}"
+            )
+        if progress and "X-Progress" in response.headers:
+            progress(f"$import in progress: {response.headers['X-Progress']}")
+        if timeout is not None and time.monotonic() - started > timeout:
+            raise BulkImportError(
+                f"$import did not complete within {timeout} seconds"
+            )
+        time.sleep(retry_after(response, interval))
+
+
+def summarize(manifest):
+    """
+    Return {resource type: {"count": resources imported, "errors": [error
+    entries]}} from a completion manifest.
+    """
+    summary = defaultdict(lambda: {"count": 0, "errors": []})
+    for output in manifest.get("output", []):
+        summary[output.get("type")]["count"] += output.get("count", 0)
+    for error in manifest.get("error", []):
+        summary[error.get("type")]["errors"].append(error)
+    return dict(summary)
+
+
+def report(summary):
+    for resource_type, result in sorted(summary.items(), key=str):
+        print(
+            f"{resource_type}: {result['count']} imported, "
+            f"{len(result['errors'])} error files"
+        )
+        for error in result["errors"]:
+            print(f"  {error.get('url', error)}")
+
+
+def bulk_import(
+    directory,
+    base_url,
+    auth=None,
+    headers=None,
+    port=0,
+    file_server_url=None,
+    interval=10,
+    timeout=None,
+    progress=print,
+):
+    """
+    Serve the resource files of a directory and import them into a FHIR
+    server. Return the summary of the completion manifest.
+
+    file_server_url is the URL that the FHIR server reaches the file server
+    at, which defaults to this host's name and the bound port.
+    """
+    files = resource_files(directory)
+    if not files:
+        raise BulkImportError(f"No NDJSON resource files in {directory}")
+
+    server = serve_directory(directory, port)
+    try:
+        if not file_server_url:
+            file_server_url = (
+                f"http://{socket.getfqdn()}:{server.server_address[1]}"
+            )
+        inputs = [
+            (resource_type, f"{file_server_url.rstrip('/')}/{name}")
+            for resource_type, name in files
+        ]
+        with requests.Session() as session:
+            session.auth = auth
+            session.headers.update(headers or {})
+            status_url = kick_off(
+                session,
+                base_url.rstrip("/"),
+                import_parameters(file_server_url, inputs),
+            )
+            if progress:
+                progress(f"$import started: {status_url}")
+            manifest = poll(session, status_url, interval, timeout, progress)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return summarize(manifest)
@@ -0,0 +1,77 @@
+"""
+This module keeps a local manifest of the resources last sent to each FHIR
+server, so that reloads can skip resources that haven't changed.
+
+The manifest is a SQLite database of (target URL, Type/id) to the SHA-256 of
+the canonical JSON (sorted keys, no whitespace) of the last body that the
+target accepted. Writes are committed every commit_every records and on
+close, so a crash only loses the record of a few sends, which are then sent
+again on the next run.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+
+def canonical_hash(payload):
+    return hashlib.sha256(
+        json.dumps(
+            payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+        ).encode()
+    ).hexdigest()
+
+
+def resource_key(payload):
+    return f'{payload["resourceType"]}/{payload["id"]}'
+
+
+class ResourceManifest:
+    def __init__(self, path, commit_every=1000):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.commit_every = commit_every
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS sent ("
+            "target TEXT NOT NULL, key TEXT NOT NULL, hash TEXT NOT NULL, "
+            "PRIMARY KEY (target, key))"
+        )
+        self._connection.commit()
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def unchanged(self, target, payload):
+        """
+        Return whether the target last accepted exactly this payload.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT hash FROM sent WHERE target = ? AND key = ?",
+                (target, resource_key(payload)),
+            ).fetchone()
+        return row is not None and row[0] == canonical_hash(payload)
+
+    def record(self, target, payload):
+        """
+        Record that the target accepted the payload.
+        """
+        digest = canonical_hash(payload)
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO sent (target, key, hash) "
+                "VALUES (?, ?, ?)",
+                (target, resource_key(payload), digest),
+            )
+            self._pending += 1
+            if self._pending >= self.commit_every:
+                self._connection.commit()
+                self._pending = 0
+
+    def close(self):
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
@@ -0,0 +1,263 @@
+"""
+This module collects throughput and latency metrics of a load.
+
+Timings are recorded per stage (e.g. extract, map, serialize, send) and
+resource type, or table for extraction, with counts of observations and of
+the resources they cover, and bytes. Latency
+percentiles come from a fixed-size uniform sample of each stage and resource
+type, so that memory stays bounded however large the load. Retries and the
+slowest requests are kept too.
+
+The metrics can be written as a JSON summary and as a Prometheus text
+format file (e.g. for the node exporter's textfile collector), at the end of
+a load and periodically from a background thread while it runs.
+"""
+import heapq
+import itertools
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Stats:
+    def __init__(self, sample_size):
+        self.count = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.observed = 0
+        self.sample = []
+        self.sample_size = sample_size
+
+    def add(self, seconds, size, count):
+        self.count += count
+        self.bytes += size
+        self.seconds += seconds
+        # Reservoir sampling keeps a uniform sample of every latency seen
+        self.observed += 1
+        if len(self.sample) < self.sample_size:
+            self.sample.append(seconds)
+        else:
+            i = random.randrange(self.observed)
+            if i < self.sample_size:
+                self.sample[i] = seconds
+
+    def quantiles(self):
+        ordered = sorted(self.sample)
+        if not ordered:
+            return {q: None for q in QUANTILES}
+        return {
+            q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+            for q in QUANTILES
+        }
+
+
+class Metrics:
+    def __init__(self, slowest=20, sample_size=4096):
+        self.slowest = slowest
+        self.sample_size = sample_size
+        self.started = time.time()
+        self._stats = {}
+        self._retries = defaultdict(int)
+        self._slow = []
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+
+    def observe(self, stage, resource_type, seconds, size=0, count=1):
+        with self._lock:
+            key = (stage, resource_type)
+            if key not in self._stats:
+                self._stats[key] = Stats(self.sample_size)
+            self._stats[key].add(seconds, size, count)
+
+    def retry(self, resource_type):
+        with self._lock:
+            self._retries[resource_type] += 1
+
+    def request(self, seconds, resource_type, description, status):
+        """
+        Record a request in the slowest-N log.
+        """
+        with self._lock:
+            entry = (
+                seconds,
+                next(self._order),
+                resource_type,
+                description,
+                status,
+            )
+            if len(self._slow) < self.slowest:
+                heapq.heappush(self._slow, entry)
+            elif entry > self._slow[0]:
+                heapq.heapreplace(self._slow, entry)
+
+    def send_observer(self, resource_type, description, count=1):
+        """
+        Return an observe callback for send_with_retries that records every
+        attempt of a request of count resources.
+        """
+
+        def observe(attempt, success, result, latency):
+            if attempt:
+                self.retry(resource_type)
+            self.observe("send", resource_type, latency, count=count)
+            self.request(
+                latency, resource_type, description, result.get("status_code")
+            )
+
+        return observe
+
+    def summary(self):
+        with self._lock:
+            elapsed = time.time() - self.started
+            stages = defaultdict(dict)
+            for (stage, resource_type), stats in sorted(
+                self._stats.items(), key=str
+            ):
+                quantiles = stats.quantiles()
+                stages[stage][resource_type] = {
+                    "count": stats.count,
+                    "observations": stats.observed,
+                    "bytes": stats.bytes,
+                    "seconds": round(stats.seconds, 6),
+                    "per_second": round(stats.count / elapsed, 3)
+                    if elapsed
+                    else None,
+                    **{f"p{int(q * 100)}": v for q, v in quantiles.items()},
+                }
+            return {
+                "started": self.started,
+                "elapsed": round(elapsed, 3),
+                "stages": dict(stages),
+                "retries": dict(self._retries),
+                "slowest": [
+                    {
+                        "seconds": round(entry[0], 6),
+                        "resource_type": entry[2],
+                        "request": entry[3],
+                        "status": entry[4],
+                    }
+                    for entry in sorted(self._slow, reverse=True)
+                ],
+            }
+
+    def prometheus(self, prefix="kf_fhir_load"):
+        """
+        Return the metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            lines = [
+                f"# HELP {prefix}_seconds Seconds per observation (a row, "
+                "resource or request) of each stage",
+                f"# TYPE {prefix}_seconds summary",
+            ]
+            for (stage, resource_type), stats in sorted(
+                self._stats.items(), key=str
+            ):
+                labels = (
+                    f'stage="{escape(stage)}",'
+                    f'resource_type="{escape(resource_type)}"'
+                )
+                for q, v in stats.quantiles().items():
+                    if v is not None:
+                        lines.append(
+                            f'{prefix}_seconds{{{labels},quantile="{q}"}} {v}'
+                        )
+                lines += [
+                    f"{prefix}_seconds_sum{{{labels}}} {stats.seconds}",
+                    f"{prefix}_seconds_count{{{labels}}} {stats.observed}",
+                ]
+            lines += [
+                f"# HELP {prefix}_resources_total Resources per stage",
+                f"# TYPE {prefix}_resources_total counter",
+            ]
+            for (stage, resource_type), stats in sorted(
+                self._stats.items(), key=str
+            ):
+                lines.append(
+                    f'{prefix}_resources_total{{stage="{escape(stage)}",'
+                    f'resource_type="{escape(resource_type)}"}} {stats.count}'
+                )
+            lines += [
+                f"# HELP {prefix}_bytes_total Bytes per stage",
+                f"# TYPE {prefix}_bytes_total counter",
+            ]
+            for (stage, resource_type), stats in sorted(
+                self._stats.items(), key=str
+            ):
+                lines.append(
+                    f'{prefix}_bytes_total{{stage="{escape(stage)}",'
+                    f'resource_type="{escape(resource_type)}"}} {stats.bytes}'
+                )
+            lines += [
+                f"# HELP {prefix}_retries_total Retried requests",
+                f"# TYPE {prefix}_retries_total counter",
+            ]
+            for resource_type, count in sorted(self._retries.items(), key=str):
+                lines.append(
+                    f'{prefix}_retries_total{{resource_type="'
+                    f'{escape(resource_type)}"}} {count}'
+                )
+            return "\n".join(lines) + "\n"
+
+    def write(self, json_path=None, prometheus_path=None):
+        if json_path:
+            write_atomically(json_path, json.dumps(self.summary(), indent=2))
+        if prometheus_path:
+            write_atomically(prometheus_path, self.prometheus())
+
+    def start(self, interval, json_path=None, prometheus_path=None):
+        """
+        Write the metrics every interval seconds from a background thread
+        until the returned event is set.
+        """
+        stop = threading.Event()
+
+        def report():
+            while not stop.wait(interval):
+                self.write(json_path, prometheus_path)
+
+        threading.Thread(target=report, daemon=True).start()
+        return stop
+
+
+def serialize(body, metrics=None, resource_type=None, count=1):
+    """
+    Serialize a request body of count resources to JSON bytes, and record
+    the time it took and its size if metrics are given.
+    """
+    started = time.perf_counter()
+    data = json.dumps(body).encode()
+    if metrics:
+        metrics.observe(
+            "serialize",
+            resource_type,
+            time.perf_counter() - started,
+            len(data),
+            count,
+        )
+    return data
+
+
+def escape(value):
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+
+
+def write_atomically(path, text):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, "w") as f:
+        f.write(text)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
@@ -0,0 +1,85 @@
+"""
+This module writes FHIR resources to NDJSON files, one set of files per
+resource type, in the layout that FHIR Bulk Data $import reads.
+
+Files are named <name>.<shard number>.ndjson, with a .gz suffix if
+compressed, and a new shard is started every shard_size records. Resource
+files are named after their resource type; other record sets (e.g. deferred
+patches) use lowercase names so that resource_files skips them.
+"""
+import gzip
+import json
+import os
+import re
+import threading
+from collections import defaultdict
+
+RESOURCE_FILE = re.compile(r"^([A-Z][A-Za-z]+)\.\d+\.ndjson(\.gz)?$")
+
+
+def resource_files(directory):
+    """
+    Return (resource type, file name) pairs for the resource files in a
+    directory, sorted by file name.
+    """
+    files = []
+    for name in sorted(os.listdir(directory)):
+        match = RESOURCE_FILE.match(name)
+        if match:
+            files.append((match.group(1), name))
+    return files
+
+
+def read_records(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+class NdjsonWriter:
+    def __init__(self, directory, shard_size=100000, compress=False):
+        self.directory = directory
+        self.shard_size = shard_size
+        self.compress = compress
+        self._files = {}
+        self._counts = defaultdict(int)
+        self._locks = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name, shard):
+        suffix = ".ndjson.gz" if self.compress else ".ndjson"
+        return os.path.join(self.directory, f"{name}.{shard}{suffix}")
+
+    def _open(self, path):
+        if self.compress:
+            return gzip.open(path, "wt", encoding="utf-8")
+        return open(path, "w", encoding="utf-8")
+
+    def write(self, record, name=None):
+        """
+        Append a record to the files of the given name, which defaults to
+        the record's resource type, and return the path written to.
+        """
+        name = name or record["resourceType"]
+        line = json.dumps(record, separators=(",", ":"))
+        with self._lock:
+            lock = self._locks[name]
+        with lock:
+            count = self._counts[name]
+            shard = count // self.shard_size
+            if count % self.shard_size == 0:
+                if name in self._files:
+                    self._files[name].close()
+                self._files[name] = self._open(self._path(name, shard))
+            self._files[name].write(line + "\n")
+            self._counts[name] += 1
+        return self._path(name, shard)
+
+    def close(self):
+        with self._lock:
+            for f in self._files.values():
+                f.close()
+            self._files = {}
@@ -0,0 +1,98 @@
+"""
+This module profiles the phases of a load with cProfile and tracemalloc.
+
+Each phase gets a <prefix>.<name>.pstats file, to read with pstats or
+snakeviz, and a <prefix>.<name>.alloc.txt file listing the source lines
+that allocated the most memory during the phase. tracemalloc is process
+wide, so phases that run at the same time share each other's allocations.
+
+Since Python 3.12 only one cProfile profiler can be active at a time, so a
+phase that starts while another is profiled only gets its allocations
+recorded.
+"""
+import cProfile
+import functools
+import os
+import re
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+TRACEBACK_FRAMES = 10
+
+
+class Profiler:
+    def __init__(self, directory, prefix, top=25):
+        self.directory = directory
+        self.prefix = prefix
+        self.top = top
+        self._profiles = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEBACK_FRAMES)
+
+    def _path(self, name, suffix):
+        name = re.sub(r"[^A-Za-z0-9_.-]+", "-", f"{self.prefix}.{name}")
+        return os.path.join(self.directory, f"{name}{suffix}")
+
+    @staticmethod
+    def _enable(profile):
+        try:
+            profile.enable()
+            return True
+        except ValueError:
+            return False
+
+    def _dump(self, name, profile, before, after):
+        profile.dump_stats(self._path(name, ".pstats"))
+        stats = after.compare_to(before, "lineno")[: self.top]
+        with open(self._path(name, ".alloc.txt"), "w") as f:
+            f.write(f"Top {self.top} allocations of {name} by line\n\n")
+            for stat in stats:
+                f.write(f"{stat}\n")
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Profile the block of a phase and dump its files when it ends.
+        """
+        profile = cProfile.Profile()
+        before = tracemalloc.take_snapshot()
+        enabled = self._enable(profile)
+        try:
+            yield
+        finally:
+            if enabled:
+                profile.disable()
+            self._dump(name, profile, before, tracemalloc.take_snapshot())
+
+    def wrap(self, name, func):
+        """
+        Profile every call of func into the same profile, which is dumped
+        by dump_all with the allocations since the first call.
+        """
+
+        @functools.wraps(func)
+        def profiled(*args, **kwargs):
+            with self._lock:
+                if name not in self._profiles:
+                    self._profiles[name] = (
+                        cProfile.Profile(),
+                        tracemalloc.take_snapshot(),
+                    )
+                profile = self._profiles[name][0]
+            enabled = self._enable(profile)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if enabled:
+                    profile.disable()
+
+        return profiled
+
+    def dump_all(self):
+        with self._lock:
+            after = tracemalloc.take_snapshot()
+            for name, (profile, before) in self._profiles.items():
+                self._dump(name, profile, before, after)
@@ -0,0 +1,297 @@
+"""
+This module retries FHIR writes that failed for transient reasons and adapts
+the number of concurrent writes to what the server can take.
+
+Failures are classified by status code: 408, 425, 429 and 5xx gateway and
+availability errors, as well as requests that got no response at all
+(connection errors and timeouts), are retried with full-jitter exponential
+backoff, honoring Retry-After when the server sends it. Any other failure
+is final. Writes that aren't idempotent, like POSTs that create resources,
+are only retried when the server says that it didn't process them (429, or
+503 with Retry-After), since sending them again could create duplicates.
+
+Concurrency follows additive-increase/multiplicative-decrease (AIMD): each
+successful write adds increase / limit to the limit, i.e. about one more
+concurrent write per round of writes, while a transient failure or a write
+slower than the latency target multiplies it by decrease, at most once per
+cooldown so that one burst of failures only counts once.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+
+def retryable(status_code):
+    """
+    Return whether a write that got this status code (None if it got no
+    response) may succeed if it is sent again.
+    """
+    return status_code is None or status_code in RETRY_STATUSES
+
+
+def retry_after(result):
+    try:
+        return float(result["retry_after"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def unprocessed(result):
+    """
+    Return whether the server says that it didn't process a failed write.
+    """
+    status_code = result.get("status_code")
+    return status_code == 429 or (
+        status_code == 503 and retry_after(result) is not None
+    )
+
+
+class RetryPolicy:
+    def __init__(self, retries=8, base=0.5, cap=60.0):
+        self.retries = retries
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt, retry_after=None):
+        """
+        Return the seconds to wait before retry number attempt (from 0).
+        """
+        if retry_after is not None:
+            return min(max(retry_after, 0), self.cap)
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+
+class Aimd:
+    def __init__(
+        self,
+        maximum,
+        minimum=1,
+        initial=None,
+        increase=1.0,
+        decrease=0.5,
+        latency_target=None,
+        cooldown=1.0,
+    ):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+        self.limit = float(
+            initial if initial is not None else max(minimum, maximum // 2)
+        )
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def allowed(self):
+        return int(self.limit)
+
+    def on_success(self, latency):
+        if self.latency_target is not None and latency > self.latency_target:
+            self.on_overload()
+            return
+        with self._lock:
+            self.limit = min(
+                self.maximum, self.limit + self.increase / self.limit
+            )
+
+    def on_overload(self):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            self.limit = max(self.minimum, self.limit * self.decrease)
+
+
+class FixedLimit:
+    """
+    A limit that stays at its maximum, for turning AIMD off
+    """
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.allowed = maximum
+
+    def on_success(self, latency):
+        pass
+
+    def on_overload(self):
+        pass
+
+
+class ConcurrencyLimiter:
+    """
+    Hold back writes from threads beyond the current limit, and beyond the
+    limit of a parent limiter shared with other writers if given
+    """
+
+    def __init__(self, limit, parent=None):
+        self.limit = limit
+        self.parent = parent
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        with self._condition:
+            while self.in_flight >= self.limit.allowed:
+                self._condition.wait()
+            self.in_flight += 1
+        if self.parent:
+            self.parent.__enter__()
+
+    def __exit__(self, *exc):
+        if self.parent:
+            self.parent.__exit__(*exc)
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+
+class AsyncConcurrencyLimiter:
+    """
+    Hold back writes from coroutines beyond the current limit
+
+    asyncio primitives belong to one event loop, so the in-flight count is
+    guarded by a thread lock, and a write held back waits on a future of its
+    own loop, which is woken thread-safely when another write finishes. This
+    lets the phases of a load run their own loops, concurrently or one after
+    another, while they share the limit.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self._waiters = []
+        self._lock = threading.Lock()
+
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self.in_flight < self.limit.allowed:
+                    self.in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+            try:
+                await waiter
+            finally:
+                with self._lock:
+                    if (loop, waiter) in self._waiters:
+                        self._waiters.remove((loop, waiter))
+
+    async def __aexit__(self, *exc):
+        with self._lock:
+            self.in_flight -= 1
+            waiters, self._waiters = self._waiters, []
+        # The limit may have grown too, so every waiter checks it again
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def _outcome(limiter, success, result, latency, idempotent=True):
+    """
+    Feed the outcome of a write to the limit and return whether to retry it.
+    """
+    if success:
+        limiter.limit.on_success(latency)
+        return False
+    if retryable(result.get("status_code")):
+        limiter.limit.on_overload()
+        return idempotent or unprocessed(result)
+    return False
+
+
+def _no_response(error):
+    return False, {"status_code": None, "response": repr(error)}
+
+
+def send_with_retries(
+    send,
+    policy,
+    limiter,
+    errors=(),
+    log=logger.warning,
+    observe=None,
+    idempotent=True,
+):
+    """
+    Call send, which returns (success, {"status_code", "response"}), until
+    it succeeds, fails for good or runs out of retries, and return its last
+    result. Exceptions of the errors types count as getting no response.
+    If the write isn't idempotent, it is only retried when it certainly
+    wasn't processed.
+
+    observe, if given, is called with the attempt number (from 0), success,
+    result and latency of every attempt.
+    """
+    for attempt in range(policy.retries + 1):
+        with limiter:
+            started = time.monotonic()
+            try:
+                success, result = send()
+            except errors as e:
+                success, result = _no_response(e)
+            latency = time.monotonic() - started
+        if observe:
+            observe(attempt, success, result, latency)
+        retry = _outcome(limiter, success, result, latency, idempotent)
+        if not retry or attempt == policy.retries:
+            break
+        delay = policy.delay(attempt, retry_after(result))
+        if log:
+            log(
+                f"Retrying in {delay:.1f}s after "
+                f"{result.get('status_code') or 'no response'}"
+            )
+        time.sleep(delay)
+    return success, result
+
+
+async def async_send_with_retries(
+    send,
+    policy,
+    limiter,
+    errors=(),
+    log=logger.warning,
+    observe=None,
+    idempotent=True,
+):
+    """
+    Like send_with_retries for a send coroutine function
+    """
+    for attempt in range(policy.retries + 1):
+        async with limiter:
+            started = time.monotonic()
+            try:
+                success, result = await send()
+            except errors as e:
+                success, result = _no_response(e)
+            latency = time.monotonic() - started
+        if observe:
+            observe(attempt, success, result, latency)
+        retry = _outcome(limiter, success, result, latency, idempotent)
+        if not retry or attempt == policy.retries:
+            break
+        delay = policy.delay(attempt, retry_after(result))
+        if log:
+            log(
+                f"Retrying in {delay:.1f}s after "
+                f"{result.get('status_code') or 'no response'}"
+            )
+        await asyncio.sleep(delay)
+    return success, result
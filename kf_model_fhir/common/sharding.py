@@ -0,0 +1,34 @@
+"""
+This module splits a study between N independent loads, or shards, so that
+N hosts can each load a disjoint slice of it without coordinating.
+
+Participant-scoped resources belong to the shard of a stable hash of their
+participant, which is the same on every host and in every run. Resources
+shared by many participants (practitioners, organizations, the research
+study and families) belong to shard 0. Resource ids are deterministic, so
+references across shards resolve once every shard has loaded.
+"""
+import zlib
+
+OWNER = 0
+
+
+def shard_of(value, shards, salt=""):
+    """
+    Return the shard of a value. Different salts split the same values
+    independently, so that shards can be split again.
+    """
+    return zlib.crc32(f"{salt}{value}".encode()) % shards
+
+
+def parse_shard(text):
+    """
+    Parse "i/N" into (i, N), where shards are numbered from 0.
+    """
+    try:
+        index, shards = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise ValueError(f"{text} is not of the form i/N")
+    if not 0 <= index < shards:
+        raise ValueError(f"shard {index} is not between 0 and {shards - 1}")
+    return index, shards
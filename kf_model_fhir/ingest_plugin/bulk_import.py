@@ -0,0 +1,95 @@
+"""
+Load the NDJSON files that the ingest plugin writes when KF_FHIR_NDJSON_DIR
+is set into a FHIR server with $import, then apply the deferred patient
+relation patches.
+
+Usage: python -m kf_model_fhir.ingest_plugin.bulk_import <ndjson dir> <url>
+"""
+import argparse
+import os
+from pprint import pformat
+
+from requests import RequestException
+
+from ncpi_fhir_utility.client import FhirApiClient
+
+from kf_model_fhir.common.bulk_import import bulk_import, report
+from kf_model_fhir.common.ndjson import read_records
+from kf_model_fhir.ingest_plugin.kids_first_fhir import (
+    FHIR_USER,
+    FHIR_PW,
+    PATCHES,
+    patch_headers,
+)
+
+
+def apply_patches(client, directory):
+    count = 0
+    for name in sorted(os.listdir(directory)):
+        if not name.startswith(f"{PATCHES}."):
+            continue
+        for record in read_records(os.path.join(directory, name)):
+            api_path = (
+                f"{client.base_url}/{record['resourceType']}/{record['id']}"
+            )
+            success, result = client.send_request(
+                "PATCH",
+                api_path,
+                json=record["patch"],
+                headers=patch_headers(client),
+            )
+            if not success:
+                raise RequestException(
+                    f"Sent PATCH request to {api_path}:\n"
+                    f"{pformat(record['patch'])}\nGot:\n{pformat(result)}"
+                )
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("ndjson_dir", help="the KF_FHIR_NDJSON_DIR of a load")
+    parser.add_argument("target_url", help="the FHIR server to import into")
+    parser.add_argument(
+        "--file_server_port",
+        type=int,
+        default=8080,
+        help="the port of the file server that serves the NDJSON files",
+    )
+    parser.add_argument(
+        "--file_server_url",
+        help="the URL that the FHIR server reaches the file server at",
+    )
+    parser.add_argument(
+        "--poll_interval",
+        type=float,
+        default=10,
+        help="seconds between polls of the $import status endpoint",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        help="give up on the $import job after this many seconds",
+    )
+    args = parser.parse_args()
+
+    client = FhirApiClient(base_url=args.target_url, auth=(FHIR_USER, FHIR_PW))
+    summary = bulk_import(
+        args.ndjson_dir,
+        client.base_url,
+        (FHIR_USER, FHIR_PW),
+        client._fhir_version_headers(),
+        args.file_server_port,
+        args.file_server_url,
+        args.poll_interval,
+        args.timeout,
+    )
+    report(summary)
+    print(f"Applied {apply_patches(client, args.ndjson_dir)} patches")
+    if any(result["errors"] for result in summary.values()):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,14 +9,57 @@ Reference: https://github.com/kids-first/kf-lib-data-ingest
 
 See docstrings in kf_lib_data_ingest.etl.configuration.target_api_config for
 more details on the requirements for format and content.
+
+If KF_FHIR_NDJSON_DIR is set, resources are written to NDJSON files in that
+directory instead of being sent to the target service, and patient relation
+patches are deferred to a patches file. Load the directory afterwards with
+python -m kf_model_fhir.ingest_plugin.bulk_import.
+
+If KF_FHIR_MANIFEST is set to a file path, resources that the target service
+already accepted with the same content are not sent again, unless
+KF_FHIR_FORCE is set too.
+
+Requests that fail for a transient reason are retried up to KF_FHIR_RETRIES
+times (default 8) with backoff, and the number of concurrent requests to a
+host adapts to its responses up to KF_FHIR_MAX_CONCURRENCY (default 10),
+also backing off when a request takes longer than KF_FHIR_LATENCY_TARGET
+seconds if that is set.
+
+If KF_FHIR_METRICS or KF_FHIR_PROMETHEUS is set to a file path, request
+counts, bytes, latency percentiles, retries and the slowest requests per
+resource type are written there as JSON or in the Prometheus text format
+when the process exits, and every KF_FHIR_METRICS_INTERVAL seconds if that
+is set.
+
+If KF_FHIR_PROFILE_DIR is set, every target's build_entity and
+transform_records_list calls are profiled with cProfile and tracemalloc, and
+their pstats and top allocations are written to that directory when the
+process exits, named by KF_FHIR_STUDY_ID and resource type.
+
+KF_FHIR_SHARD isn't supported: the target service assigns the ids of new
+resources, so a shard can't reference the Patients that other shards create.
+Use python loader.py --shard i/N to split a study between hosts instead.
 """
+import atexit
 import os
+import uuid
 from pprint import pformat
 
 from requests import RequestException
 
 from ncpi_fhir_utility.client import FhirApiClient
 
+from kf_model_fhir.common.ndjson import NdjsonWriter
+from kf_model_fhir.common.manifest import ResourceManifest
+from kf_model_fhir.common.metrics import Metrics, serialize
+from kf_model_fhir.common.profiling import Profiler
+from kf_model_fhir.common.retry import (
+    RetryPolicy,
+    Aimd,
+    ConcurrencyLimiter,
+    send_with_retries,
+)
+
 from kf_model_fhir.ingest_plugin.target_api_builders.practitioner import (
     Practitioner,
 )
@@ -78,16 +121,124 @@ all_targets = [
 
 FHIR_USER = os.getenv("FHIR_USER") or "admin"
 FHIR_PW = os.getenv("FHIR_PW") or "password"
+NDJSON_DIR = os.getenv("KF_FHIR_NDJSON_DIR")
+MANIFEST = os.getenv("KF_FHIR_MANIFEST")
+FORCE = bool(os.getenv("KF_FHIR_FORCE"))
+RETRIES = int(os.getenv("KF_FHIR_RETRIES") or 8)
+MAX_CONCURRENCY = int(os.getenv("KF_FHIR_MAX_CONCURRENCY") or 10)
+LATENCY_TARGET = os.getenv("KF_FHIR_LATENCY_TARGET")
+METRICS = os.getenv("KF_FHIR_METRICS")
+PROMETHEUS = os.getenv("KF_FHIR_PROMETHEUS")
+METRICS_INTERVAL = os.getenv("KF_FHIR_METRICS_INTERVAL")
+PROFILE_DIR = os.getenv("KF_FHIR_PROFILE_DIR")
+STUDY_ID = os.getenv("KF_FHIR_STUDY_ID") or "study"
+PATCHES = "patches"
 clients = {}
+limiters = {}
+retry_policy = RetryPolicy(RETRIES)
+if os.getenv("KF_FHIR_SHARD"):
+    raise ValueError(
+        "KF_FHIR_SHARD isn't supported by the ingest plugin, since the ids "
+        "of new resources are assigned by the target service. Use "
+        "python loader.py --shard i/N instead."
+    )
+
+ndjson_writer = None
+if NDJSON_DIR:
+    ndjson_writer = NdjsonWriter(NDJSON_DIR)
+    atexit.register(ndjson_writer.close)
+
+manifest = None
+if MANIFEST:
+    manifest = ResourceManifest(MANIFEST)
+    atexit.register(manifest.close)
+
+metrics = None
+if METRICS or PROMETHEUS:
+    metrics = Metrics()
+    if METRICS_INTERVAL:
+        metrics.start(float(METRICS_INTERVAL), METRICS, PROMETHEUS)
+    atexit.register(metrics.write, METRICS, PROMETHEUS)
+
+if PROFILE_DIR:
+    profiler = Profiler(PROFILE_DIR, STUDY_ID)
+    for target in all_targets:
+        for attr in ("transform_records_list", "build_entity"):
+            if hasattr(target, attr):
+                setattr(
+                    target,
+                    attr,
+                    staticmethod(
+                        profiler.wrap(
+                            f"{target.resource_type}.{target.class_name}"
+                            f".{attr}",
+                            getattr(target, attr),
+                        )
+                    ),
+                )
+    atexit.register(profiler.dump_all)
+
+
+def patch_headers(client):
+    headers = client._fhir_version_headers()
+    headers["Content-Type"] = headers["Content-Type"].replace(
+        "application/fhir", "application/json-patch"
+    )
+    return headers
+
+
+def write_ndjson(entity_class, body):
+    if entity_class == PatientRelation:
+        ndjson_writer.write(
+            {
+                "resourceType": entity_class.resource_type,
+                "id": body["id"],
+                "patch": body["patches"],
+            },
+            PATCHES,
+        )
+        return body["id"]
+
+    # $import doesn't assign ids, so give new resources one here
+    body.setdefault("id", str(uuid.uuid4()))
+    ndjson_writer.write(body)
+    return body["id"]
 
 
 def submit(host, entity_class, body):
+    # drop empty fields
+    body = {k: v for k, v in body.items() if v not in (None, [], {})}
+
+    if ndjson_writer:
+        return write_ndjson(entity_class, body)
+
     clients[host] = clients.get(host) or FhirApiClient(
         base_url=host, auth=(FHIR_USER, FHIR_PW)
     )
+    limiters[host] = limiters.get(host) or ConcurrencyLimiter(
+        Aimd(
+            MAX_CONCURRENCY,
+            latency_target=LATENCY_TARGET and float(LATENCY_TARGET),
+        )
+    )
 
-    # drop empty fields
-    body = {k: v for k, v in body.items() if v not in (None, [], {})}
+    def send(verb, api_path, body, headers):
+        observe = None
+        if metrics:
+            observe = metrics.send_observer(
+                entity_class.resource_type, f"{verb} {api_path}"
+            )
+        data = serialize(body, metrics, entity_class.resource_type)
+        return send_with_retries(
+            lambda: clients[host].send_request(
+                verb, api_path, data=data, headers=headers
+            ),
+            retry_policy,
+            limiters[host],
+            errors=(RequestException,),
+            observe=observe,
+            idempotent=verb != "POST",
+        )
 
     verb = "POST"
     api_path = f"{host}/{entity_class.resource_type}"
@@ -98,15 +249,17 @@ def submit(host, entity_class, body):
             verb = "PATCH"
             body = body["patches"]
 
-    cheaders = clients[host]._fhir_version_headers()
+    # Patches aren't skipped since a changed Patient is PUT without them
+    if manifest and not FORCE and verb == "PUT":
+        if manifest.unchanged(host, body):
+            return body["id"]
+
     if verb == "PATCH":
-        cheaders["Content-Type"] = cheaders["Content-Type"].replace(
-            "application/fhir", "application/json-patch"
-        )
+        cheaders = patch_headers(clients[host])
+    else:
+        cheaders = clients[host]._fhir_version_headers()
 
-    success, result = clients[host].send_request(
-        verb, api_path, json=body, headers=cheaders
-    )
+    success, result = send(verb, api_path, body, cheaders)
 
     if (
         (not success)
@@ -120,11 +273,11 @@ def submit(host, entity_class, body):
     ):
         verb = "POST"
         api_path = f"{host}/{entity_class.resource_type}"
-        success, result = clients[host].send_request(
-            verb, api_path, json=body, headers=cheaders
-        )
+        success, result = send(verb, api_path, body, cheaders)
 
     if success:
+        if manifest and verb == "PUT":
+            manifest.record(host, body)
         return result["response"]["id"]
     else:
         raise RequestException(
@@ -0,0 +1,183 @@
+"""
+This module sends FHIR resources from an asyncio event loop with aiohttp.
+
+A load runs one event loop in a thread of its own, with one session whose
+connector opens at most max_in_flight connections, and every phase sends
+its requests to it. Loads into the same target can share them, and with
+them the connections, by sending through the same AsyncSession.
+
+A phase has at most max_in_flight requests outstanding, and only advances
+its payload generator, in its own thread, when one of them completes, so a
+phase of any size runs in constant memory. Within that bound, requests are
+further held back by the concurrency limiter and retried under the retry
+policy.
+"""
+import asyncio
+import threading
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import aiohttp
+
+from kf_model_fhir.common.metrics import serialize
+from kf_model_fhir.common.retry import async_send_with_retries
+
+from kf_model_fhir.mappers.common.bundle import (
+    bundle_results,
+    bundle_resource_type,
+    retry_indices,
+    retry_bundle,
+)
+
+
+class AsyncSession:
+    """
+    An event loop in a thread of its own, with one aiohttp session whose
+    connector opens at most max_connections connections
+    """
+
+    def __init__(self, auth, max_connections):
+        self.auth = aiohttp.BasicAuth(*auth) if all(auth) else None
+        self.max_connections = max_connections
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self.loop.run_forever, daemon=True
+        )
+        self._thread.start()
+        self.client_session = self.run(self._open_session())
+
+    async def _open_session(self):
+        # The session and its connector belong to the loop they're made in
+        return aiohttp.ClientSession(
+            auth=self.auth,
+            connector=aiohttp.TCPConnector(limit=self.max_connections),
+        )
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        return self.submit(coro).result()
+
+    def close(self):
+        self.run(self.client_session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+class AsyncSender:
+    """
+    Send the requests of a load from the given AsyncSession, or from one of
+    its own, which close closes.
+    """
+
+    def __init__(
+        self,
+        base_url,
+        auth,
+        headers,
+        max_in_flight,
+        policy,
+        limiter,
+        metrics=None,
+        session=None,
+    ):
+        self.base_url = base_url
+        self.headers = headers
+        self.max_in_flight = max_in_flight
+        self.policy = policy
+        self.limiter = limiter
+        self.metrics = metrics
+        self._own_session = session is None
+        self.session = session or AsyncSession(auth, max_in_flight)
+
+    def close(self):
+        if self._own_session:
+            self.session.close()
+
+    async def _send_once(self, method, url, data):
+        async with self.session.client_session.request(
+            method, url, data=data, headers=self.headers
+        ) as response:
+            try:
+                content = await response.json(content_type=None)
+            except ValueError:
+                content = await response.text()
+            result = {
+                "status_code": response.status,
+                "response": content,
+                "retry_after": response.headers.get("Retry-After"),
+            }
+            return response.status in {200, 201}, result
+
+    async def _send_request(
+        self, method, url, body, resource_type, count=1, data=None
+    ):
+        observe = None
+        if self.metrics:
+            observe = self.metrics.send_observer(
+                resource_type, f"{method} {url}", count
+            )
+        if data is None:
+            data = serialize(body, self.metrics, resource_type, count)
+        return await async_send_with_retries(
+            lambda: self._send_once(method, url, data),
+            self.policy,
+            self.limiter,
+            errors=(aiohttp.ClientError, asyncio.TimeoutError),
+            observe=observe,
+        )
+
+    async def put_resource(self, payload, data=None):
+        """
+        data is the payload serialized to JSON, if it already is.
+        """
+        endpoint = f'{self.base_url}/{payload["resourceType"]}/{payload["id"]}'
+        success, result = await self._send_request(
+            "PUT", endpoint, payload, payload["resourceType"], data=data
+        )
+        return [(success, result, payload)]
+
+    async def _post_bundle(self, bundle):
+        success, result = await self._send_request(
+            "POST",
+            self.base_url,
+            bundle,
+            bundle_resource_type(bundle),
+            len(bundle["entry"]),
+        )
+        return bundle_results(bundle, success, result)
+
+    async def post_bundle(self, bundle):
+        results = await self._post_bundle(bundle)
+        for attempt in range(self.policy.retries):
+            indices = retry_indices(results)
+            if not indices:
+                break
+            await asyncio.sleep(self.policy.delay(attempt))
+            retried = await self._post_bundle(retry_bundle(bundle, indices))
+            for i, result in zip(indices, retried):
+                results[i] = result
+        return results
+
+    def send_all(self, units, request, consume):
+        """
+        Send every unit (a payload or a Bundle) with the given request
+        coroutine function and pass each list of (success, result, payload)
+        tuples to consume as soon as its request completes.
+        """
+        pending = set()
+        try:
+            for unit in units:
+                if len(pending) >= self.max_in_flight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        consume(future.result())
+                pending.add(self.session.submit(request(unit)))
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    consume(future.result())
+        finally:
+            for future in pending:
+                future.cancel()
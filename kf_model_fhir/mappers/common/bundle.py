@@ -0,0 +1,114 @@
+"""
+This module packs FHIR resources into batch/transaction Bundles and maps the
+entries of a response Bundle back to the resources that produced them.
+
+http://hl7.org/fhir/R4/http.html#transaction
+"""
+import json
+
+from kf_model_fhir.common.retry import retryable
+
+BUNDLE_TYPES = ("batch", "transaction")
+
+
+def make_entry(payload):
+    return {
+        "resource": payload,
+        "request": {
+            "method": "PUT",
+            "url": f'{payload["resourceType"]}/{payload["id"]}',
+        },
+    }
+
+
+def make_bundle(bundle_type, entries):
+    return {"resourceType": "Bundle", "type": bundle_type, "entry": entries}
+
+
+def yield_bundles(payloads, bundle_type, max_entries, max_bytes):
+    """
+    Pack payloads into Bundles holding at most max_entries entries and at
+    most max_bytes of serialized entries. A single entry larger than
+    max_bytes still gets a Bundle of its own.
+    """
+    entries = []
+    size = 0
+    for payload in payloads:
+        entry = make_entry(payload)
+        entry_size = len(json.dumps(entry).encode())
+        if entries and (
+            len(entries) >= max_entries or size + entry_size > max_bytes
+        ):
+            yield make_bundle(bundle_type, entries)
+            entries = []
+            size = 0
+        entries.append(entry)
+        size += entry_size
+    if entries:
+        yield make_bundle(bundle_type, entries)
+
+
+def bundle_resource_type(bundle):
+    """
+    Return the resource type of the entries of a Bundle, or "Bundle" if
+    they are of several types.
+    """
+    resource_types = {e["resource"]["resourceType"] for e in bundle["entry"]}
+    return resource_types.pop() if len(resource_types) == 1 else "Bundle"
+
+
+def bundle_results(bundle, success, result):
+    """
+    Split the result of a Bundle submission into one (success, result,
+    payload) tuple per submitted entry.
+
+    Response entries come back in the order of the request entries. If the
+    Bundle as a whole was rejected (always the case for a failed transaction)
+    every entry is reported as failed with the whole response.
+    """
+    payloads = [entry["resource"] for entry in bundle["entry"]]
+    response = result.get("response")
+    if not (success and isinstance(response, dict)):
+        return [(False, result, payload) for payload in payloads]
+
+    response_entries = response.get("entry") or []
+    results = []
+    for i, payload in enumerate(payloads):
+        if i >= len(response_entries):
+            results.append(
+                (False, {"error": "missing Bundle response entry"}, payload)
+            )
+            continue
+        entry_response = response_entries[i].get("response", {})
+        entry_success = str(entry_response.get("status", "")).startswith("2")
+        results.append((entry_success, entry_response, payload))
+    return results
+
+
+def entry_status(result):
+    """
+    Return the status code of a Bundle response entry, or None if the result
+    isn't one.
+    """
+    try:
+        return int(str(result["status"]).split()[0])
+    except (KeyError, IndexError, ValueError):
+        return None
+
+
+def retry_indices(results):
+    """
+    Return the positions of the entries of a batch that failed on their own
+    for a transient reason and may be sent again in another batch.
+    """
+    return [
+        i
+        for i, (success, result, _) in enumerate(results)
+        if not success
+        and entry_status(result) is not None
+        and retryable(entry_status(result))
+    ]
+
+
+def retry_bundle(bundle, indices):
+    return make_bundle(bundle["type"], [bundle["entry"][i] for i in indices])
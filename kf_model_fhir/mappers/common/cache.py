@@ -0,0 +1,148 @@
+"""
+This module caches the warehouse columns that the mappers read in local Arrow
+IPC files, so that reruns of a study load can skip the warehouse entirely.
+
+Cached scans are kept per study, ingest package, table and set of columns
+together with the table's columns and fingerprint (row count and max xmin)
+at the time of caching. Cached files are memory-mapped when read. They are
+trusted as they are unless verify is set, in which case the table's current
+fingerprint is compared first and stale entries are dropped.
+"""
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+from kf_model_fhir.mappers.common.sources import Source
+from kf_model_fhir.mappers.common.file_sources import read_arrow
+
+BATCH_SIZE = 65536
+
+
+def table_slug(table):
+    return re.sub(r"[^A-Za-z0-9]+", "-", table).strip("-")
+
+
+def columns_hash(columns):
+    return hashlib.sha1("\0".join(columns).encode()).hexdigest()[:12]
+
+
+class CachedSource(Source):
+    def __init__(
+        self,
+        source,
+        cache_dir,
+        study_id,
+        ingest_package,
+        verify=False,
+        refresh=False,
+    ):
+        if pa is None:
+            raise ImportError("The warehouse cache requires pyarrow")
+        self.source = source
+        self.directory = os.path.join(cache_dir, study_id, ingest_package)
+        self.verify = verify
+        self.refresh = refresh
+        self._meta = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, table, suffix):
+        return os.path.join(self.directory, f"{table_slug(table)}{suffix}")
+
+    def _load_meta(self, table):
+        with self._lock:
+            if table not in self._meta:
+                self._meta[table] = self._read_meta(table)
+            return self._meta[table]
+
+    def _read_meta(self, table):
+        path = self._path(table, ".json")
+        meta = None
+        if not self.refresh and os.path.exists(path):
+            with open(path) as f:
+                meta = json.load(f)
+            if self.verify and (
+                meta["fingerprint"] != self.source.fingerprint(table)
+            ):
+                meta = None
+        if meta is None:
+            for name in os.listdir(self.directory):
+                if name.startswith(f"{table_slug(table)}-"):
+                    os.remove(os.path.join(self.directory, name))
+            meta = {
+                "table": table,
+                "columns": self.source.columns(table),
+                "fingerprint": self.source.fingerprint(table),
+                "entries": [],
+            }
+            self._write_meta(table, meta)
+        return meta
+
+    def _write_meta(self, table, meta):
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, self._path(table, ".json"))
+
+    def columns(self, table):
+        return self._load_meta(table)["columns"]
+
+    def fingerprint(self, table):
+        return self._load_meta(table)["fingerprint"]
+
+    def _write(self, table, columns):
+        schema = pa.schema([(c, pa.string()) for c in columns])
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as sink, pa.ipc.new_file(
+                sink, schema
+            ) as writer:
+                chunk = []
+                for values in self.source.scan(table, columns):
+                    yield values
+                    chunk.append(values)
+                    if len(chunk) >= BATCH_SIZE:
+                        writer.write_batch(self._batch(schema, chunk))
+                        chunk = []
+                if chunk:
+                    writer.write_batch(self._batch(schema, chunk))
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+        name = f"{table_slug(table)}-{columns_hash(columns)}.arrow"
+        os.replace(tmp, os.path.join(self.directory, name))
+        with self._lock:
+            meta = self._meta[table]
+            meta["entries"].append({"name": name, "columns": list(columns)})
+            self._write_meta(table, meta)
+
+    @staticmethod
+    def _batch(schema, chunk):
+        return pa.RecordBatch.from_arrays(
+            [
+                pa.array(
+                    [None if v is None else str(v) for v in values],
+                    type=pa.string(),
+                )
+                for values in zip(*chunk)
+            ],
+            schema=schema,
+        )
+
+    def scan(self, table, columns):
+        meta = self._load_meta(table)
+        for entry in meta["entries"]:
+            path = os.path.join(self.directory, entry["name"])
+            if set(columns) <= set(entry["columns"]) and os.path.exists(path):
+                yield from read_arrow(path, columns)
+                return
+        yield from self._write(table, columns)
@@ -0,0 +1,153 @@
+"""
+This module works out what a delta load of a study has to rebuild.
+
+The loader keeps the high watermark of each warehouse table, taken at the
+start of the last successful load of a study into a target. A delta load
+selects the keys of the rows added or changed since then and only rebuilds
+the resources that depend on them:
+
+- the Patients, Conditions, Phenotypes and Specimens of changed participants
+- the Groups of changed families, with all of their members
+- the related Patients of changed participants and family relationships
+
+Everything that the rebuilt resources reference is indexed too. Deleted rows
+leave nothing behind for a watermark to find, so a full load is still needed
+after deletions.
+"""
+import json
+import os
+import tempfile
+import threading
+
+from kf_lib_data_ingest.common.concept_schema import CONCEPT
+
+from kf_model_fhir.mappers.common.utils import make_select, get
+
+
+class WatermarkStore:
+    """
+    A JSON file of {target|study|ingest package: {table name: watermark}}
+    """
+
+    # Concurrent loads of several studies share the file
+    _lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def key(target_url, study_id, ingest_package):
+        return f"{target_url}|{study_id}|{ingest_package}"
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def get(self, key):
+        return self._read().get(key)
+
+    def set(self, key, watermarks):
+        with self._lock:
+            stored = self._read()
+            stored[key] = watermarks
+            directory = os.path.dirname(os.path.abspath(self.path))
+            fd, tmp = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, "w") as f:
+                json.dump(stored, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+
+
+def high_watermarks(source, tables, column):
+    return {
+        name: source.watermark(table, column) for name, table in tables.items()
+    }
+
+
+def _since(column, watermarks, name):
+    # A table that was empty at the last load has only new rows
+    if watermarks.get(name) is None:
+        return None
+    return (column, watermarks[name])
+
+
+class Changes:
+    """
+    The keys of the rows of a study changed since the given watermarks, and
+    the where filters of the mappers that rebuild what depends on them
+    """
+
+    def __init__(self, source, tables, column, watermarks):
+        participants, families = set(), set()
+        for row in make_select(
+            source,
+            tables["default"],
+            CONCEPT.PARTICIPANT.ID,
+            CONCEPT.FAMILY.ID,
+            since=_since(column, watermarks, "default"),
+        ):
+            participant_id = get(row, CONCEPT.PARTICIPANT.ID)
+            family_id = get(row, CONCEPT.FAMILY.ID)
+            if participant_id is not None:
+                participants.add(participant_id)
+            if family_id is not None:
+                families.add(family_id)
+
+        # Rebuilt Groups list every member of the changed families
+        members = {
+            get(row, CONCEPT.PARTICIPANT.ID)
+            for row in make_select(
+                source,
+                tables["default"],
+                CONCEPT.FAMILY.ID,
+                CONCEPT.PARTICIPANT.ID,
+                required=(CONCEPT.PARTICIPANT.ID,),
+                where={CONCEPT.FAMILY.ID: families},
+            )
+        }
+
+        # Changed participants are rebuilt with their relations too
+        related = set(participants)
+        for row in make_select(
+            source,
+            tables["family_relationship"],
+            CONCEPT.FAMILY_RELATIONSHIP.PERSON2.ID,
+            required=(CONCEPT.FAMILY_RELATIONSHIP.PERSON2.ID,),
+            since=_since(column, watermarks, "family_relationship"),
+        ):
+            related.add(get(row, CONCEPT.FAMILY_RELATIONSHIP.PERSON2.ID))
+        relatives = {
+            get(row, CONCEPT.FAMILY_RELATIONSHIP.PERSON1.ID)
+            for row in make_select(
+                source,
+                tables["family_relationship"],
+                CONCEPT.FAMILY_RELATIONSHIP.PERSON1.ID,
+                CONCEPT.FAMILY_RELATIONSHIP.PERSON2.ID,
+                required=(CONCEPT.FAMILY_RELATIONSHIP.PERSON1.ID,),
+                where={CONCEPT.FAMILY_RELATIONSHIP.PERSON2.ID: related},
+            )
+        }
+
+        self.participants = participants
+        self.families = families
+        self.related = related
+        self.patients = participants | members | related | relatives
+
+    def where(self, name):
+        return {
+            "participants": {CONCEPT.PARTICIPANT.ID: self.participants},
+            "patients": {CONCEPT.PARTICIPANT.ID: self.patients},
+            "groups": {CONCEPT.FAMILY.ID: self.families},
+            "sent_patients": {CONCEPT.PARTICIPANT.ID: self.related},
+            "relations": {
+                CONCEPT.FAMILY_RELATIONSHIP.PERSON2.ID: self.related
+            },
+        }[name]
+
+    def __str__(self):
+        return (
+            f"{len(self.participants)} changed participants, "
+            f"{len(self.families)} changed families, "
+            f"{len(self.related)} patients with relations to rebuild"
+        )
@@ -0,0 +1,95 @@
+"""
+This module holds sources that read the warehouse tables from exported files
+instead of Postgres, so that studies can be loaded offline.
+
+Each source is given a dict of table name to file path. Only the columns a
+scan asks for are read: TSV files are parsed in chunks with the other
+columns skipped, and Arrow IPC and Parquet files are memory-mapped.
+"""
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+import pandas as pd
+
+from kf_model_fhir.mappers.common.sources import Source
+
+CHUNK_SIZE = 65536
+
+
+def read_arrow(path, columns):
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            yield from zip(*(batch.column(c).to_pylist() for c in columns))
+
+
+class FileSource(Source):
+    def __init__(self, paths):
+        self.paths = paths
+        self._columns = {}
+
+    def columns(self, table):
+        if table not in self._columns:
+            self._columns[table] = self.read_columns(self.paths[table])
+        return self._columns[table]
+
+    def read_columns(self, path):
+        raise NotImplementedError
+
+
+class TsvSource(FileSource):
+    def read_columns(self, path):
+        return list(pd.read_csv(path, sep="\t", nrows=0).columns)
+
+    def scan(self, table, columns):
+        for chunk in pd.read_csv(
+            self.paths[table],
+            sep="\t",
+            usecols=columns,
+            dtype=str,
+            na_filter=False,
+            chunksize=CHUNK_SIZE,
+        ):
+            yield from chunk[columns].itertuples(index=False, name=None)
+
+
+class ArrowSource(FileSource):
+    def __init__(self, paths):
+        if pa is None:
+            raise ImportError("Reading Arrow files requires pyarrow")
+        super().__init__(paths)
+
+    def read_columns(self, path):
+        with pa.memory_map(path) as source:
+            return pa.ipc.open_file(source).schema.names
+
+    def scan(self, table, columns):
+        yield from read_arrow(self.paths[table], columns)
+
+
+class ParquetSource(FileSource):
+    def __init__(self, paths):
+        if pq is None:
+            raise ImportError("Reading Parquet files requires pyarrow")
+        super().__init__(paths)
+
+    def read_columns(self, path):
+        return pq.ParquetFile(path, memory_map=True).schema_arrow.names
+
+    def scan(self, table, columns):
+        parquet_file = pq.ParquetFile(self.paths[table], memory_map=True)
+        for batch in parquet_file.iter_batches(
+            batch_size=CHUNK_SIZE, columns=columns
+        ):
+            yield from zip(*(batch.column(c).to_pylist() for c in columns))
+
+
+FILE_SOURCES = {
+    "tsv": TsvSource,
+    "arrow": ArrowSource,
+    "parquet": ParquetSource,
+}
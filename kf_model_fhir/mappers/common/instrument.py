@@ -0,0 +1,83 @@
+"""
+This module instruments the loader with kf_model_fhir.common.metrics.
+
+Extraction is timed per table by wrapping the source, and mapping per
+resource type by wrapping the payloads of each phase. Serialization is timed
+by the sinks, as they serialize the bodies of their requests.
+Mapping time is the time a mapper takes to yield a payload less the time
+spent extracting in the meantime, which is tracked per thread since each
+phase pulls its rows and payloads from a single thread.
+"""
+import threading
+import time
+
+from kf_model_fhir.mappers.common.sources import Source
+
+_extraction = threading.local()
+
+
+def _extracted():
+    return getattr(_extraction, "seconds", 0.0)
+
+
+class MeteredSource(Source):
+    def __init__(self, source, metrics):
+        self.source = source
+        self.metrics = metrics
+
+    def columns(self, table):
+        return self.source.columns(table)
+
+    def fingerprint(self, table):
+        return self.source.fingerprint(table)
+
+    def watermark(self, table, column):
+        return self.source.watermark(table, column)
+
+    def scan(self, table, columns):
+        return self.source.scan(table, columns)
+
+    def count(self, table, columns, required=(), group_by=(), where=None):
+        return self.source.count(table, columns, required, group_by, where)
+
+    def select(
+        self, table, columns, required=(), group_by=(), where=None, since=None
+    ):
+        rows = iter(
+            self.source.select(
+                table, columns, required, group_by, where, since
+            )
+        )
+        while True:
+            started = time.perf_counter()
+            try:
+                row = next(rows)
+            except StopIteration:
+                _extraction.seconds = (
+                    _extracted() + time.perf_counter() - started
+                )
+                return
+            seconds = time.perf_counter() - started
+            _extraction.seconds = _extracted() + seconds
+            self.metrics.observe("extract", table, seconds)
+            yield row
+
+
+def meter_payloads(items, metrics):
+    """
+    Time the mapping of payloads, or of (payload, key) pairs, as they are
+    pulled.
+    """
+    items = iter(items)
+    while True:
+        started = time.perf_counter()
+        extracted = _extracted()
+        try:
+            item = next(items)
+        except StopIteration:
+            return
+        seconds = time.perf_counter() - started - (_extracted() - extracted)
+        payload = item[0] if isinstance(item, tuple) else item
+        resource_type = payload["resourceType"]
+        metrics.observe("map", resource_type, seconds)
+        yield item
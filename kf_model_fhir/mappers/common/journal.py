@@ -0,0 +1,126 @@
+"""
+This module keeps a checkpoint journal of a load, so that a load that died
+can be resumed where it stopped.
+
+The journal is a SQLite database that records, per target, study and
+ingest package, every resource that the target acknowledged, and the phases
+that completed together with the reference index that each of them built.
+Resuming a load restores the indexes of completed phases instead of running
+them again and skips acknowledged resources in the others. A new load of
+the same study into the same target starts a new journal.
+"""
+import json
+import sqlite3
+import threading
+
+from kf_model_fhir.mappers.common.refindex import intern_key
+
+
+def _key(payload):
+    return f'{payload["resourceType"]}/{payload["id"]}'
+
+
+def _index_key(value):
+    if isinstance(value, list):
+        return tuple(_index_key(v) for v in value)
+    return value
+
+
+class Journal:
+    def __init__(self, path, run_key, resume=False, commit_every=1000):
+        self.run_key = run_key
+        self.commit_every = commit_every
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS phases (
+                run TEXT NOT NULL, phase TEXT NOT NULL,
+                PRIMARY KEY (run, phase));
+            CREATE TABLE IF NOT EXISTS acked (
+                run TEXT NOT NULL, key TEXT NOT NULL,
+                PRIMARY KEY (run, key));
+            CREATE TABLE IF NOT EXISTS refs (
+                run TEXT NOT NULL, phase TEXT NOT NULL,
+                key TEXT NOT NULL, id TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS refs_phase ON refs (run, phase);
+            """
+        )
+        if not resume:
+            for table in ("phases", "acked", "refs"):
+                self._connection.execute(
+                    f"DELETE FROM {table} WHERE run = ?", (run_key,)
+                )
+        self._connection.commit()
+
+    def completed(self):
+        """
+        Return the names of the phases that completed.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT phase FROM phases WHERE run = ?", (self.run_key,)
+            )
+            return {phase for phase, in rows}
+
+    def acked(self):
+        """
+        Return the Type/id keys of the resources that were acknowledged.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT key FROM acked WHERE run = ?", (self.run_key,)
+            )
+            return {intern_key(key) for key, in rows}
+
+    def ack(self, payload):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO acked (run, key) VALUES (?, ?)",
+                (self.run_key, _key(payload)),
+            )
+            self._pending += 1
+            if self._pending >= self.commit_every:
+                self._connection.commit()
+                self._pending = 0
+
+    def restore(self, phase, index):
+        """
+        Fill a reference index with the entries that a completed phase
+        built.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT key, id FROM refs WHERE run = ? AND phase = ?",
+                (self.run_key, phase),
+            ).fetchall()
+        for key, resource_id in rows:
+            index[_index_key(json.loads(key))] = resource_id
+
+    def complete(self, phase, index=None):
+        """
+        Record that a phase completed, with the reference index it built.
+        """
+        with self._lock:
+            if index is not None:
+                self._connection.executemany(
+                    "INSERT INTO refs (run, phase, key, id) "
+                    "VALUES (?, ?, ?, ?)",
+                    (
+                        (self.run_key, phase, json.dumps(key), resource_id)
+                        for key, resource_id in index.items()
+                    ),
+                )
+            self._connection.execute(
+                "INSERT OR IGNORE INTO phases (run, phase) VALUES (?, ?)",
+                (self.run_key, phase),
+            )
+            self._connection.commit()
+            self._pending = 0
+
+    def close(self):
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
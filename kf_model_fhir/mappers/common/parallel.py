@@ -0,0 +1,268 @@
+"""
+This module runs the yield_* mappers of a phase in worker processes, which
+builds resources on every core instead of one thread under the GIL.
+
+The loader first runs the mapper over a source without rows to record the
+selects it makes, then reads each of them once and splits its rows into
+shards by a stable hash of their participant ID, or of their group when
+grouped. Each worker maps the rows of one shard, and sends any select that
+depends on the rows it read to the source.
+Workers are forked from the loader, so they inherit the shards, the source
+and the reference indexes read-only instead of receiving copies. They return
+every resource serialized to JSON bytes, which the loader decodes far
+faster than the mapper builds it, and keeps for the sinks to send as they
+are. Shards are yielded in order, so a phase yields its resources in the
+same order on every run.
+"""
+import itertools
+import json
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from kf_lib_data_ingest.common.concept_schema import CONCEPT
+
+from kf_model_fhir.mappers.common.sources import Source
+from kf_model_fhir.mappers.common.utils import get
+
+from kf_model_fhir.common.sharding import shard_of
+
+SHARD_COLUMNS = (
+    CONCEPT.PARTICIPANT.ID,
+    CONCEPT.FAMILY_RELATIONSHIP.PERSON2.ID,
+)
+SHARDS_PER_PROCESS = 4
+
+_jobs = {}
+_job_ids = itertools.count()
+_inherited = []
+
+
+def shard_keys(columns, group_by=()):
+    """
+    Return the columns whose values shard the rows of a select.
+    """
+    if group_by:
+        return list(group_by)
+    return [c for c in SHARD_COLUMNS if c in columns][:1]
+
+
+def row_shard(row, keys, shards, salt=""):
+    if not keys:
+        return 0
+    return shard_of("|".join(str(get(row, k)) for k in keys), shards, salt)
+
+
+class ShardedSource(Source):
+    """
+    Select only the rows of one shard from a source
+
+    Rows without a participant ID or group all go to shard 0.
+    """
+
+    def __init__(self, source, shard, shards, salt=""):
+        self.source = source
+        self.shard = shard
+        self.shards = shards
+        self.salt = salt
+
+    def columns(self, table):
+        return self.source.columns(table)
+
+    def fingerprint(self, table):
+        return self.source.fingerprint(table)
+
+    def watermark(self, table, column):
+        return self.source.watermark(table, column)
+
+    def scan(self, table, columns):
+        return self.source.scan(table, columns)
+
+    def select(
+        self, table, columns, required=(), group_by=(), where=None, since=None
+    ):
+        keys = shard_keys(columns, group_by)
+        for row in self.source.select(
+            table, columns, required, group_by, where, since
+        ):
+            if row_shard(row, keys, self.shards, self.salt) == self.shard:
+                yield row
+
+    def count(self, table, columns, required=(), group_by=(), where=None):
+        total = self.source.count(table, columns, required, group_by, where)
+        if total is None:
+            return None
+        if not shard_keys(columns, group_by):
+            return total if self.shard == 0 else 0
+        # Rows are only hashed as they are read, so this is an estimate
+        return -(-total // self.shards)
+
+
+def select_key(
+    table, columns, required=(), group_by=(), where=None, since=None
+):
+    """
+    Return a hashable key of the arguments of a select.
+    """
+    return (
+        table,
+        tuple(columns),
+        tuple(required),
+        tuple(group_by),
+        frozenset(
+            (column, frozenset(values))
+            for column, values in (where or {}).items()
+        ),
+        since,
+    )
+
+
+class Serialized(dict):
+    """
+    A payload decoded from the JSON bytes that a worker returned, which are
+    kept in data
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        super().__init__(json.loads(data))
+        self.data = data
+
+
+def serialized(payload):
+    """
+    Return the JSON bytes of a payload if it is Serialized, or None.
+    """
+    return getattr(payload, "data", None)
+
+
+class RecordingSource(Source):
+    """
+    Record the selects made on a source, which yield no rows
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.selects = {}
+
+    def columns(self, table):
+        return self.source.columns(table)
+
+    def select(
+        self, table, columns, required=(), group_by=(), where=None, since=None
+    ):
+        args = (table, columns, required, group_by, where, since)
+        self.selects[select_key(*args)] = args
+        return iter(())
+
+
+class ChunkSource(Source):
+    """
+    Serve the rows of a shard of recorded selects, and send other selects to
+    a source
+    """
+
+    def __init__(self, source, chunks):
+        self.source = source
+        self.chunks = chunks
+
+    def columns(self, table):
+        return self.source.columns(table)
+
+    def fingerprint(self, table):
+        return self.source.fingerprint(table)
+
+    def watermark(self, table, column):
+        return self.source.watermark(table, column)
+
+    def scan(self, table, columns):
+        return self.source.scan(table, columns)
+
+    def select(
+        self, table, columns, required=(), group_by=(), where=None, since=None
+    ):
+        key = select_key(table, columns, required, group_by, where, since)
+        if key in self.chunks:
+            return iter(self.chunks[key])
+        return self.source.select(
+            table, columns, required, group_by, where, since
+        )
+
+
+def split(source, selects, shards):
+    """
+    Read each select once, and return the rows of each shard by select key.
+    """
+    chunks = [{key: [] for key in selects} for _ in range(shards)]
+    for key, args in selects.items():
+        table, columns, required, group_by, where, since = args
+        keys = shard_keys(columns, group_by)
+        for row in source.select(*args):
+            chunks[row_shard(row, keys, shards, "map")][key].append(row)
+    return chunks
+
+
+def _after_fork(job):
+    source = _jobs[job][1]
+    while source is not None:
+        # Threads of the loader don't exist in the worker, so locks that
+        # they held when it was forked would never be released
+        if hasattr(source, "_lock"):
+            source._lock = threading.Lock()
+        metrics = getattr(source, "metrics", None)
+        if metrics is not None:
+            metrics._lock = threading.Lock()
+        # The pooled connections belong to the loader, so the worker opens
+        # its own. The old pool is kept so that it is never garbage
+        # collected, which would close the loader's connections.
+        engine = getattr(source, "eng", None)
+        if engine is not None:
+            _inherited.append(engine.pool)
+            engine.pool = engine.pool.recreate()
+        source = getattr(source, "source", None)
+
+
+def _map_shard(job, shard):
+    mapper, source, args, pairs, chunks = _jobs[job]
+    items = mapper(ChunkSource(source, chunks[shard]), *args)
+    if pairs:
+        return [(json.dumps(payload).encode(), key) for payload, key in items]
+    return [json.dumps(payload).encode() for payload in items]
+
+
+def map_in_processes(processes, mapper, source, *args, pairs=False):
+    """
+    Yield what mapper(source, *args) yields, mapped by forked processes.
+
+    pairs tells whether the mapper yields (payload, key) pairs instead of
+    payloads. Payloads are Serialized, and come in the order of the shards
+    of their rows.
+    """
+    recording = RecordingSource(source)
+    for _ in mapper(recording, *args):
+        pass
+    shards = processes * SHARDS_PER_PROCESS
+    chunks = split(source, recording.selects, shards)
+
+    job = next(_job_ids)
+    _jobs[job] = (mapper, source, args, pairs, chunks)
+    try:
+        with ProcessPoolExecutor(
+            processes,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_after_fork,
+            initargs=(job,),
+        ) as pool:
+            futures = [
+                pool.submit(_map_shard, job, shard) for shard in range(shards)
+            ]
+            for future in futures:
+                if pairs:
+                    for data, key in future.result():
+                        yield Serialized(data), key
+                else:
+                    for data in future.result():
+                        yield Serialized(data)
+    finally:
+        del _jobs[job]
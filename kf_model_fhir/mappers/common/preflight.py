@@ -0,0 +1,173 @@
+"""
+This module checks the references between the resources of a study before
+the loader builds or sends any of them.
+
+The mappers look the resources they reference up in the reference indexes
+of earlier phases, so a row that references a participant, institution or
+investigator that no resource is built for fails its phase with a KeyError,
+possibly hours into a load. The check selects only the key columns of the
+referenced and referencing rows, and reports every dangling reference of
+every phase at once.
+"""
+from kf_lib_data_ingest.common.concept_schema import CONCEPT
+
+from kf_model_fhir.mappers.common.utils import get
+from kf_model_fhir.mappers.resources import (
+    practitioner,
+    organization,
+    practitioner_role,
+    kfdrc_research_study,
+    kfdrc_patient,
+    group,
+    kfdrc_patient_relations,
+    kfdrc_condition,
+    kfdrc_phenotype,
+    kfdrc_specimen,
+)
+
+EXAMPLES = 10
+
+# The keys of the resources that can be referenced, by the reference index
+# that holds them: (table name, key columns, required columns)
+KEYS = {
+    "practitioners": (
+        "default",
+        (CONCEPT.INVESTIGATOR.NAME,),
+        practitioner.REQUIRED,
+    ),
+    "organizations": (
+        "default",
+        (CONCEPT.INVESTIGATOR.INSTITUTION,),
+        organization.REQUIRED,
+    ),
+    "practitioner_roles": (
+        "default",
+        (CONCEPT.INVESTIGATOR.INSTITUTION, CONCEPT.INVESTIGATOR.NAME),
+        practitioner_role.REQUIRED,
+    ),
+    "kfdrc_patients": (
+        "default",
+        (CONCEPT.PARTICIPANT.ID,),
+        kfdrc_patient.REQUIRED,
+    ),
+}
+
+# The references of each phase: (phase, table name, key columns, required
+# columns of the phase's rows, referenced index)
+REFERENCES = [
+    (
+        "practitioner_roles",
+        "default",
+        (CONCEPT.INVESTIGATOR.NAME,),
+        practitioner_role.REQUIRED,
+        "practitioners",
+    ),
+    (
+        "practitioner_roles",
+        "default",
+        (CONCEPT.INVESTIGATOR.INSTITUTION,),
+        practitioner_role.REQUIRED,
+        "organizations",
+    ),
+    (
+        "kfdrc_research_studies",
+        "default",
+        (CONCEPT.INVESTIGATOR.INSTITUTION,),
+        kfdrc_research_study.REQUIRED,
+        "organizations",
+    ),
+    (
+        "kfdrc_research_studies",
+        "default",
+        (CONCEPT.INVESTIGATOR.INSTITUTION, CONCEPT.INVESTIGATOR.NAME),
+        kfdrc_research_study.REQUIRED,
+        "practitioner_roles",
+    ),
+    (
+        "groups",
+        "default",
+        (CONCEPT.PARTICIPANT.ID,),
+        group.REQUIRED,
+        "kfdrc_patients",
+    ),
+    (
+        "kfdrc_patient_relations",
+        "family_relationship",
+        (CONCEPT.FAMILY_RELATIONSHIP.PERSON1.ID,),
+        kfdrc_patient_relations.REQUIRED,
+        "kfdrc_patients",
+    ),
+    (
+        "kfdrc_conditions",
+        "default",
+        (CONCEPT.PARTICIPANT.ID,),
+        kfdrc_condition.REQUIRED,
+        "kfdrc_patients",
+    ),
+    (
+        "kfdrc_phenotypes",
+        "default",
+        (CONCEPT.PARTICIPANT.ID,),
+        kfdrc_phenotype.REQUIRED,
+        "kfdrc_patients",
+    ),
+    (
+        "kfdrc_specimens",
+        "default",
+        (CONCEPT.PARTICIPANT.ID,),
+        kfdrc_specimen.REQUIRED,
+        "kfdrc_patients",
+    ),
+]
+
+
+def select_keys(source, table, columns, required, where=None):
+    """
+    Return the distinct values of the key columns in the rows of the table
+    that have every required column and pass the where filter.
+    """
+    return {
+        tuple(get(row, c) for c in columns)
+        for row in source.select(
+            table, (*columns, *required, *(where or {})), required, where=where
+        )
+    }
+
+
+def check_references(source, tables, phases, wheres=None):
+    """
+    Return a description of every dangling reference of the given phases,
+    or an empty list if there are none. wheres maps phases to the where
+    filter of the rows they build from, if they are filtered.
+    """
+    wheres = wheres or {}
+    keys = {}
+    violations = []
+    for phase, name, columns, required, index in REFERENCES:
+        if phase not in phases:
+            continue
+        if index not in keys:
+            key_name, key_columns, key_required = KEYS[index]
+            keys[index] = select_keys(
+                source,
+                tables[key_name],
+                key_columns,
+                key_required,
+                wheres.get(index),
+            )
+        references = select_keys(
+            source, tables[name], columns, required, wheres.get(phase)
+        )
+        missing = sorted(references - keys[index], key=str)
+        if not missing:
+            continue
+        examples = ", ".join(
+            "/".join(str(value) for value in key)
+            for key in missing[:EXAMPLES]
+        )
+        violations.append(
+            f"{phase}: {len(missing)} {'/'.join(columns)} values of {name} "
+            f"rows reference no {index} resource ({examples}"
+            + (", ...)" if len(missing) > EXAMPLES else ")")
+        )
+    return violations
@@ -0,0 +1,89 @@
+"""
+This module reports the progress of the phases of a load.
+
+Each phase counts its resources as they are sent or skipped against a total
+counted up front, when the source can tell it cheaply. At most every
+interval seconds, one line per running phase shows how many are done, how
+many per second and the time left. A quiet reporter only reports each phase
+once it is done, and the whole load at the end.
+"""
+import threading
+import time
+from datetime import timedelta
+
+
+def duration(seconds):
+    return str(timedelta(seconds=round(seconds)))
+
+
+class PhaseProgress:
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.started = time.monotonic()
+
+    def line(self, name, now):
+        elapsed = now - self.started
+        rate = self.done / elapsed if elapsed else 0.0
+        if self.total:
+            eta = (
+                duration(max(self.total - self.done, 0) / rate)
+                if rate
+                else "?"
+            )
+            return (
+                f"{name}: {self.done}/{self.total} "
+                f"({100 * self.done // self.total}%), "
+                f"{rate:.1f}/s, ETA {eta}"
+            )
+        return f"{name}: {self.done}, {rate:.1f}/s"
+
+
+class Progress:
+    def __init__(self, interval=10.0, quiet=False, log=print):
+        self.interval = interval
+        self.quiet = quiet
+        self.log = log
+        self.started = time.monotonic()
+        self.done = 0
+        self.finished = {}
+        self._phases = {}
+        self._last = self.started
+        self._lock = threading.Lock()
+
+    def start(self, name, total=None):
+        with self._lock:
+            self._phases[name] = PhaseProgress(total)
+
+    def advance(self, name, count=1):
+        with self._lock:
+            self._phases[name].done += count
+            self.done += count
+            if self.quiet:
+                return
+            now = time.monotonic()
+            if now - self._last < self.interval:
+                return
+            self._last = now
+            for phase_name, phase in self._phases.items():
+                self.log(phase.line(phase_name, now))
+
+    def finish(self, name):
+        with self._lock:
+            phase = self._phases.pop(name)
+            elapsed = time.monotonic() - phase.started
+            self.finished[name] = {
+                "resources": phase.done,
+                "seconds": round(elapsed, 3),
+            }
+            self.log(
+                f"{name}: done, {phase.done} resources in "
+                f"{duration(elapsed)}"
+                + (f" ({phase.done / elapsed:.1f}/s)" if elapsed else "")
+            )
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def summary(self):
+        self.log(f"Loaded {self.done} resources in {duration(self.elapsed())}")
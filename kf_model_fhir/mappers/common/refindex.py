@@ -0,0 +1,36 @@
+"""
+This module holds a compact index from source keys to FHIR resource ids.
+
+Mappers only need the ids of previously built resources to make references,
+so the loader keeps an index of interned key and id strings instead of the
+full payloads.
+"""
+import sys
+from collections.abc import Mapping
+
+
+def intern_key(key):
+    if isinstance(key, str):
+        return sys.intern(key)
+    if isinstance(key, tuple):
+        return tuple(intern_key(k) for k in key)
+    return key
+
+
+class ReferenceIndex(Mapping):
+    __slots__ = ("_ids",)
+
+    def __init__(self):
+        self._ids = {}
+
+    def __setitem__(self, key, resource_id):
+        self._ids[intern_key(key)] = sys.intern(resource_id)
+
+    def __getitem__(self, key):
+        return self._ids[key]
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
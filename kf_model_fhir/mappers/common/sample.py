@@ -0,0 +1,71 @@
+"""
+This module picks a deterministic sample of the participants of a study, so
+that a mapper can be tried on a small load of real data.
+
+A sample load builds the resources shared by the whole study and the
+referential closure of the sampled participants: their Patients, Conditions,
+Phenotypes and Specimens, the Groups of their families with only sampled
+members, and the relations between sampled participants. The filters are
+passed to every select, so a warehouse source only extracts the sample's rows.
+"""
+import zlib
+
+from kf_lib_data_ingest.common.concept_schema import CONCEPT
+
+from kf_model_fhir.mappers.common.utils import make_select, get
+
+
+class Sample:
+    """
+    A set of participant IDs, and the where filters of the mappers that
+    build what they reference
+    """
+
+    def __init__(self, participants):
+        self.participants = set(participants)
+
+    @classmethod
+    def first(cls, source, table, size):
+        """
+        Sample size participants of the table. Participants are ordered by a
+        stable hash of their ID, so the same ones are sampled every time, and
+        a bigger sample holds every smaller one.
+        """
+        participants = {
+            get(row, CONCEPT.PARTICIPANT.ID)
+            for row in make_select(
+                source,
+                table,
+                CONCEPT.PARTICIPANT.ID,
+                required=(CONCEPT.PARTICIPANT.ID,),
+            )
+        }
+        return cls(
+            sorted(
+                participants,
+                key=lambda p: (zlib.crc32(str(p).encode()), str(p)),
+            )[:size]
+        )
+
+    @classmethod
+    def read(cls, path):
+        """
+        Sample the participants listed in a file, one ID per line.
+        """
+        with open(path) as f:
+            return cls(line.strip() for line in f if line.strip())
+
+    def where(self, name):
+        return {
+            "participants": {CONCEPT.PARTICIPANT.ID: self.participants},
+            "patients": {CONCEPT.PARTICIPANT.ID: self.participants},
+            "groups": {CONCEPT.PARTICIPANT.ID: self.participants},
+            "sent_patients": {CONCEPT.PARTICIPANT.ID: self.participants},
+            "relations": {
+                CONCEPT.FAMILY_RELATIONSHIP.PERSON1.ID: self.participants,
+                CONCEPT.FAMILY_RELATIONSHIP.PERSON2.ID: self.participants,
+            },
+        }[name]
+
+    def __str__(self):
+        return f"{len(self.participants)} sampled participants"
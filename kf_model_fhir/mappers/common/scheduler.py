@@ -0,0 +1,41 @@
+"""
+This module runs load phases as a DAG of their reference dependencies.
+
+A phase starts as soon as all of the phases it requires have finished, so
+phases that don't depend on each other run concurrently.
+"""
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+def run_phases(phases):
+    """
+    Run phases given as (name, required phase names, function) tuples.
+
+    The first phase to fail stops any more phases from being started and its
+    exception is raised once the phases already running have returned.
+    """
+    functions = {name: func for name, _, func in phases}
+    requires = {name: set(required) for name, required, _ in phases}
+    for name, required in requires.items():
+        unknown = required - functions.keys()
+        if unknown:
+            raise ValueError(f"Phase {name} requires unknown phases {unknown}")
+
+    done = set()
+    running = {}
+    with ThreadPoolExecutor(max_workers=len(phases)) as pex:
+        while len(done) < len(phases):
+            started = done | set(running.values())
+            for name, required in requires.items():
+                if name not in started and required <= done:
+                    running[pex.submit(functions[name])] = name
+            if not running:
+                raise ValueError(
+                    "Cyclic phase dependencies among "
+                    f"{sorted(functions.keys() - done)}"
+                )
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                future.result()
+                done.add(name)
@@ -0,0 +1,299 @@
+"""
+This module holds the sinks that the loader sends FHIR resources to.
+
+Every sink takes single resources with send and Bundles of them with
+send_bundle, with their JSON serialization as data if they were serialized
+already, and returns a list of (success, result, payload) tuples for the
+resources it was given.
+"""
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from pprint import pformat
+
+from requests import RequestException
+
+from kf_model_fhir.common.metrics import serialize
+from kf_model_fhir.common.ndjson import NdjsonWriter
+from kf_model_fhir.common.retry import send_with_retries
+
+from kf_model_fhir.mappers.common.bundle import (
+    bundle_results,
+    bundle_resource_type,
+    retry_indices,
+    retry_bundle,
+)
+
+
+class HttpSink:
+    """
+    PUT resources to a FHIR server, or POST Bundles to its base URL, retrying
+    transient failures under the given policy and concurrency limiter.
+    Entries of a batch that fail on their own are retried in a new batch.
+    """
+
+    def __init__(self, client, policy, limiter, metrics=None):
+        self.client = client
+        self.policy = policy
+        self.limiter = limiter
+        self.metrics = metrics
+
+    def _send_request(
+        self, method, url, body, resource_type, count=1, data=None
+    ):
+        observe = None
+        if self.metrics:
+            observe = self.metrics.send_observer(
+                resource_type, f"{method} {url}", count
+            )
+        # Serialize once for every attempt, unless the body already is
+        if data is None:
+            data = serialize(body, self.metrics, resource_type, count)
+        return send_with_retries(
+            lambda: self.client.send_request(method, url, data=data),
+            self.policy,
+            self.limiter,
+            errors=(RequestException,),
+            observe=observe,
+        )
+
+    def send(self, payload, data=None):
+        """
+        data is the payload serialized to JSON, if it already is.
+        """
+        endpoint = (
+            f'{self.client.base_url}/{payload["resourceType"]}/{payload["id"]}'
+        )
+        success, result = self._send_request(
+            "PUT", endpoint, payload, payload["resourceType"], data=data
+        )
+        return [(success, result, payload)]
+
+    def _post_bundle(self, bundle, data=None):
+        success, result = self._send_request(
+            "POST",
+            self.client.base_url,
+            bundle,
+            bundle_resource_type(bundle),
+            len(bundle["entry"]),
+            data,
+        )
+        return bundle_results(bundle, success, result)
+
+    def send_bundle(self, bundle, data=None):
+        results = self._post_bundle(bundle, data)
+        for attempt in range(self.policy.retries):
+            indices = retry_indices(results)
+            if not indices:
+                break
+            time.sleep(self.policy.delay(attempt))
+            retried = self._post_bundle(retry_bundle(bundle, indices))
+            for i, result in zip(indices, retried):
+                results[i] = result
+        return results
+
+    def close(self):
+        pass
+
+
+class NdjsonSink:
+    """
+    Write resources as NDJSON, one set of files per resource type.
+
+    Files are named <resource type>.<shard number>.ndjson, with a .gz suffix
+    if compressed, and a new shard is started every shard_size resources.
+    """
+
+    def __init__(self, directory, shard_size=100000, compress=False):
+        self.directory = directory
+        self.writer = NdjsonWriter(directory, shard_size, compress)
+
+    def send(self, payload, data=None):
+        # The writer serializes resources compactly, one per line
+        return [(True, {"file": self.writer.write(payload)}, payload)]
+
+    def send_bundle(self, bundle, data=None):
+        results = []
+        for entry in bundle["entry"]:
+            results.extend(self.send(entry["resource"]))
+        return results
+
+    def close(self):
+        self.writer.close()
+
+
+class NullSink:
+    """
+    Serialize resources and count them without sending them anywhere
+    """
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self.counts = defaultdict(int)
+        self.bytes = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def send(self, payload, data=None):
+        if data is None:
+            data = serialize(payload, self.metrics, payload["resourceType"])
+        size = len(data)
+        with self._lock:
+            self.counts[payload["resourceType"]] += 1
+            self.bytes[payload["resourceType"]] += size
+        return [(True, {"bytes": size}, payload)]
+
+    def send_bundle(self, bundle, data=None):
+        results = []
+        for entry in bundle["entry"]:
+            results.extend(self.send(entry["resource"]))
+        return results
+
+    def close(self):
+        for resource_type, count in sorted(self.counts.items()):
+            print(
+                f"{resource_type}: {count} resources, "
+                f"{self.bytes[resource_type]} bytes"
+            )
+
+
+class TargetQueue:
+    """
+    Send resources and Bundles to one target of a MultiTargetSink from its
+    own worker threads, with at most buffer of them waiting or in flight.
+
+    The target stops at its first failed resource, and fails what is queued
+    for it from then on without sending it.
+    """
+
+    def __init__(self, sink, workers, buffer):
+        self.sink = sink
+        self.sent = 0
+        self.failure = None
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(buffer)
+        self._lock = threading.Lock()
+
+    def put(self, send, unit, data, payloads):
+        """
+        Queue a send of a resource or Bundle, and return a future of the
+        results of its payloads.
+        """
+        # Blocks while the buffer is full
+        self._slots.acquire()
+        return self._pool.submit(self._send, send, unit, data, payloads)
+
+    def _send(self, send, unit, data, payloads):
+        try:
+            if self.failure:
+                return [
+                    (False, {"error": "an earlier send failed"}, payload)
+                    for payload in payloads
+                ]
+            results = send(unit, data=data)
+        except Exception as e:
+            results = [(False, {"error": repr(e)}, p) for p in payloads]
+        finally:
+            self._slots.release()
+        with self._lock:
+            for success, result, payload in results:
+                if not success:
+                    self.failure = self.failure or (result, payload)
+                    continue
+                self.sent += 1
+        return results
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        self.sink.close()
+
+
+def key(payload):
+    return f'{payload["resourceType"]}/{payload["id"]}'
+
+
+class MultiTargetSink:
+    """
+    Send every resource or Bundle to several targets, serializing it once.
+
+    sinks maps the name of each target to the sink that sends to it. Each
+    target sends from its own TargetQueue, so it has its own concurrency,
+    retries and results, and takes up to buffer sends ahead of the slowest
+    one. submit and submit_bundle return a future of the results, which is
+    done once every target is. A resource succeeds if any target sent it,
+    and its result holds the result of each target, so that a failed target
+    only stops itself. close reports the failure of each target in failures
+    and in the summary it prints.
+    """
+
+    def __init__(self, sinks, workers=10, buffer=1000, metrics=None):
+        self.targets = {
+            name: TargetQueue(sink, workers, buffer)
+            for name, sink in sinks.items()
+        }
+        self.metrics = metrics
+        self.failures = {}
+
+    def _submit(self, method, unit, data, payloads, resource_type):
+        if data is None:
+            data = serialize(unit, self.metrics, resource_type, len(payloads))
+        done = Future()
+        results = {key(payload): {} for payload in payloads}
+        successes = {key(payload): False for payload in payloads}
+        pending = [len(self.targets)]
+        lock = threading.Lock()
+
+        def acknowledge(name, future):
+            with lock:
+                for success, result, payload in future.result():
+                    results[key(payload)][name] = result
+                    successes[key(payload)] |= success
+                pending[0] -= 1
+                if pending[0]:
+                    return
+            done.set_result(
+                [
+                    (successes[key(payload)], results[key(payload)], payload)
+                    for payload in payloads
+                ]
+            )
+
+        for name, target in self.targets.items():
+            target.put(
+                getattr(target.sink, method), unit, data, payloads
+            ).add_done_callback(partial(acknowledge, name))
+        return done
+
+    def submit(self, payload, data=None):
+        return self._submit(
+            "send", payload, data, [payload], payload["resourceType"]
+        )
+
+    def submit_bundle(self, bundle, data=None):
+        return self._submit(
+            "send_bundle",
+            bundle,
+            data,
+            [entry["resource"] for entry in bundle["entry"]],
+            bundle_resource_type(bundle),
+        )
+
+    def send(self, payload, data=None):
+        return self.submit(payload, data).result()
+
+    def send_bundle(self, bundle, data=None):
+        return self.submit_bundle(bundle, data).result()
+
+    def close(self):
+        for target in self.targets.values():
+            target.close()
+        for name, target in self.targets.items():
+            print(f"{name}: {target.sent} resources sent")
+            if target.failure:
+                result, payload = target.failure
+                self.failures[name] = (
+                    f"{name} failed to submit:\n{pformat(payload)}"
+                    f"\n{'-' * 80}\n{pformat(result)}"
+                )
+                print(self.failures[name])
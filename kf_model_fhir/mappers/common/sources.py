@@ -0,0 +1,402 @@
+"""
+This module holds the row sources that the yield_* mappers read from through
+make_select.
+
+A source knows the columns of its tables and can scan a table for a subset of
+its columns. Selecting from a source returns the distinct rows of the
+requested columns that exist in the table, which is what the mappers expect
+from SELECT DISTINCT on the warehouse. Rows with a null or empty value in a
+required column are dropped, and rows can be grouped on some of the columns
+with every other column aggregated into a list.
+
+Selects can also be filtered to rows whose value in some columns is one of a
+set of values, and sources that can tell changed rows apart (Postgres) to
+rows added or changed since a watermark, which is a (column, value) pair. The
+column is a timestamp or version column of the table or "xmin", the id of the
+Postgres transaction that last wrote the row.
+"""
+import csv
+import os
+import threading
+
+
+def quote(columns):
+    return ",".join(f'"{c}"' for c in columns)
+
+
+def watermark_sql(column):
+    if column == "xmin":
+        return "xmin::text::bigint"
+    return f'"{column}"'
+
+
+def shape(columns, rows, required=(), group_by=(), where=None):
+    """
+    Turn distinct tuples of column values into the row dicts of a select.
+    """
+    needed = [columns.index(c) for c in required]
+    allowed = [
+        (columns.index(c), set(values)) for c, values in (where or {}).items()
+    ]
+    rows = (
+        values
+        for values in rows
+        if all(values[i] not in (None, "") for i in needed)
+        and all(values[i] in values_in for i, values_in in allowed)
+    )
+    if not group_by:
+        for values in rows:
+            yield dict(zip(columns, values))
+        return
+
+    keys = [columns.index(c) for c in group_by]
+    others = [i for i in range(len(columns)) if i not in keys]
+    groups = {}
+    for values in rows:
+        aggregates = groups.setdefault(
+            tuple(values[i] for i in keys), [[] for _ in others]
+        )
+        for aggregate, i in zip(aggregates, others):
+            aggregate.append(values[i])
+    for key, aggregates in groups.items():
+        row = dict(zip(group_by, key))
+        row.update(zip((columns[i] for i in others), aggregates))
+        yield row
+
+
+class Source:
+    def columns(self, table):
+        raise NotImplementedError
+
+    def available(self, table, columns, required=(), group_by=(), where=None):
+        """
+        Return the requested columns that exist in the table, or None if a
+        required, grouping or filtered column doesn't exist or a filter
+        allows no values, so that no row can match.
+        """
+        where = where or {}
+        if not all(where.values()):
+            return None
+        existing = set(self.columns(table))
+        if not existing.issuperset(set(required) | set(group_by) | set(where)):
+            return None
+        return [c for c in dict.fromkeys(columns) if c in existing]
+
+    def scan(self, table, columns):
+        """
+        Yield a tuple of values for each row of the table, ordered like the
+        given columns.
+        """
+        raise NotImplementedError
+
+    def fingerprint(self, table):
+        """
+        Return a value that changes whenever the contents of the table do,
+        or None if the source can't tell.
+        """
+        return None
+
+    def watermark(self, table, column):
+        """
+        Return the highest value of a watermark column in the table, or None
+        if the table is empty.
+        """
+        raise NotImplementedError(
+            f"{type(self).__name__} can't tell changed rows apart"
+        )
+
+    def select(
+        self, table, columns, required=(), group_by=(), where=None, since=None
+    ):
+        if since is not None:
+            raise NotImplementedError(
+                f"{type(self).__name__} can't tell changed rows apart"
+            )
+        cols = self.available(table, columns, required, group_by, where)
+        if cols is None:
+            return
+        distinct = dict.fromkeys(self.scan(table, cols))
+        yield from shape(cols, distinct, required, group_by, where)
+
+    def count(self, table, columns, required=(), group_by=(), where=None):
+        """
+        Return the number of rows that select would yield, or None if the
+        source can't tell without reading them.
+        """
+        return None
+
+
+class PostgresSource(Source):
+    def __init__(self, eng):
+        self.eng = eng
+        self._columns = {}
+
+    def columns(self, table):
+        if table not in self._columns:
+            result = self.eng.execute(f"SELECT * FROM {table} LIMIT 0;")
+            self._columns[table] = list(result.keys())
+            result.close()
+        return self._columns[table]
+
+    def fingerprint(self, table):
+        result = self.eng.execute(
+            f"SELECT count(*), max(xmin::text::bigint) FROM {table};"
+        )
+        fingerprint = list(result.first())
+        result.close()
+        return fingerprint
+
+    def watermark(self, table, column):
+        result = self.eng.execute(
+            f"SELECT max({watermark_sql(column)}) FROM {table};"
+        )
+        value = result.scalar()
+        result.close()
+        return None if value is None else str(value)
+
+    def scan(self, table, columns):
+        sql = f"SELECT {quote(columns)} FROM {table};"
+        for row in self.eng.execute(sql):
+            yield tuple(row)
+
+    @staticmethod
+    def distinct_sql(table, columns, required=(), where=None, since=None):
+        """
+        Return the SELECT DISTINCT of a select and its psycopg2 parameters.
+        """
+        conditions = [
+            f"\"{c}\" IS NOT NULL AND \"{c}\"::text <> ''" for c in required
+        ]
+        params = {}
+        for i, (c, values) in enumerate((where or {}).items()):
+            conditions.append(f'"{c}"::text IN %(where_{i})s')
+            params[f"where_{i}"] = tuple(values)
+        if since is not None:
+            conditions.append(f"{watermark_sql(since[0])} > %(since)s")
+            params["since"] = since[1]
+        sql = f"SELECT DISTINCT {quote(columns)} FROM {table}"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        return sql, params
+
+    def select(
+        self, table, columns, required=(), group_by=(), where=None, since=None
+    ):
+        cols = self.available(table, columns, required, group_by, where)
+        if cols is None:
+            return
+        sql, params = self.distinct_sql(table, cols, required, where, since)
+        if group_by:
+            # Every aggregate is ordered by all of them, so that the lists of
+            # a group stay aligned and come out the same on every run
+            others = [c for c in cols if c not in group_by]
+            aggregates = [
+                f'array_agg("{c}" ORDER BY {quote(others)}) AS "{c}"'
+                for c in others
+            ]
+            sql = (
+                f"SELECT {','.join([quote(group_by)] + aggregates)} "
+                f"FROM ({sql}) AS projection GROUP BY {quote(group_by)}"
+            )
+        if params:
+            yield from self.eng.execute(f"{sql};", params)
+        else:
+            yield from self.eng.execute(f"{sql};")
+
+
+class CopySource(PostgresSource):
+    """
+    Read from Postgres with COPY (SELECT ...) TO STDOUT, which is several
+    times faster than iterating a cursor for bulk reads.
+
+    COPY writes CSV into a pipe from a separate thread while the rows are
+    parsed from the other end in chunks of chunk_size bytes, so tables of any
+    size stream through in constant memory. CSV can't tell NULL from an
+    empty string, which make_select treats the same anyway.
+    """
+
+    def __init__(self, eng, chunk_size=1024 * 1024):
+        super().__init__(eng)
+        self.chunk_size = chunk_size
+
+    def _copy(self, sql, params=None):
+        read_fd, write_fd = os.pipe()
+        errors = []
+
+        def copy():
+            connection = None
+            try:
+                with os.fdopen(write_fd, "wb", closefd=False) as stream:
+                    connection = self.eng.raw_connection()
+                    cursor = connection.cursor()
+                    query = sql
+                    if params:
+                        query = cursor.mogrify(sql, params).decode()
+                    cursor.copy_expert(
+                        f"COPY ({query}) TO STDOUT WITH (FORMAT csv)", stream
+                    )
+            except Exception as e:
+                errors.append(e)
+            finally:
+                # The reader only stops once the write end is closed
+                os.close(write_fd)
+                if connection is not None:
+                    connection.close()
+
+        thread = threading.Thread(target=copy, daemon=True)
+        thread.start()
+        with open(
+            read_fd, buffering=self.chunk_size, encoding="utf-8", newline=""
+        ) as stream:
+            for values in csv.reader(stream):
+                yield tuple(values)
+        thread.join()
+        if errors:
+            raise errors[0]
+
+    def scan(self, table, columns):
+        yield from self._copy(f"SELECT {quote(columns)} FROM {table}")
+
+    def select(
+        self, table, columns, required=(), group_by=(), where=None, since=None
+    ):
+        # Aggregated arrays come back as Postgres array literals in CSV, and
+        # grouped results are small, so those still go through a cursor
+        if group_by:
+            yield from super().select(
+                table, columns, required, group_by, where, since
+            )
+            return
+
+        cols = self.available(table, columns, required, where=where)
+        if cols is None:
+            return
+        sql, params = self.distinct_sql(table, cols, required, where, since)
+        for values in self._copy(sql, params):
+            yield dict(zip(cols, values))
+
+
+class FanOutSource(Source):
+    """
+    Serve the projections that the mappers need from one scan per table.
+
+    The first select on a table scans it once with the union of the columns
+    of every projection registered for it and keeps the distinct rows of each
+    projection, until release says that no phase will read it again. Selects
+    of the columns of a kept projection, or of some of them, are served from
+    its rows, and other selects go to the wrapped source.
+    """
+
+    def __init__(self, source, projections):
+        self.source = source
+        self.projections = {
+            table: list(
+                dict.fromkeys(
+                    tuple(dict.fromkeys(cols)) for cols in projection_list
+                )
+            )
+            for table, projection_list in projections.items()
+        }
+        self._rows = {}
+        self._lock = threading.Lock()
+
+    def columns(self, table):
+        return self.source.columns(table)
+
+    def fingerprint(self, table):
+        return self.source.fingerprint(table)
+
+    def watermark(self, table, column):
+        return self.source.watermark(table, column)
+
+    def scan(self, table, columns):
+        return self.source.scan(table, columns)
+
+    def _extract(self, table):
+        available = set(self.columns(table))
+        projections = {
+            cols: tuple(c for c in cols if c in available)
+            for cols in self.projections[table]
+        }
+        union = list(
+            dict.fromkeys(c for p in projections.values() for c in p)
+        )
+        positions = {
+            cols: [union.index(c) for c in projected]
+            for cols, projected in projections.items()
+        }
+        rows = {cols: {} for cols in projections}
+        for values in self.source.scan(table, union):
+            for cols, index in positions.items():
+                rows[cols][tuple(values[i] for i in index)] = None
+        return {
+            cols: (projections[cols], list(distinct))
+            for cols, distinct in rows.items()
+        }
+
+    def _projection(self, table, cols):
+        """
+        Return the existing columns of cols and the distinct rows of their
+        values from a kept projection, or None if no kept projection has
+        every one of them.
+        """
+        with self._lock:
+            if table not in self._rows:
+                if not self.projections.get(table):
+                    return None
+                self._rows[table] = self._extract(table)
+            kept = self._rows[table]
+            if cols in kept:
+                return kept[cols]
+            existing = set(self.columns(table))
+            wanted = [c for c in cols if c in existing]
+            for projected, rows in kept.values():
+                if set(wanted) <= set(projected):
+                    index = [projected.index(c) for c in wanted]
+                    return wanted, list(
+                        dict.fromkeys(
+                            tuple(values[i] for i in index) for values in rows
+                        )
+                    )
+        return None
+
+    def release(self, table, columns):
+        """
+        Drop the rows of a projection that no phase will read again, and the
+        table's once none of its projections are kept.
+        """
+        cols = tuple(dict.fromkeys(columns))
+        with self._lock:
+            if cols in self.projections.get(table, []):
+                self.projections[table].remove(cols)
+            self._rows.get(table, {}).pop(cols, None)
+            if not self.projections.get(table):
+                self._rows.pop(table, None)
+
+    def count(self, table, columns, required=(), group_by=(), where=None):
+        projection = self._projection(table, tuple(dict.fromkeys(columns)))
+        if projection is None:
+            return self.source.count(table, columns, required, group_by, where)
+        if self.available(table, columns, required, group_by, where) is None:
+            return 0
+        projected, rows = projection
+        return sum(
+            1 for _ in shape(list(projected), rows, required, group_by, where)
+        )
+
+    def select(
+        self, table, columns, required=(), group_by=(), where=None, since=None
+    ):
+        cols = tuple(dict.fromkeys(columns))
+        projection = None
+        if since is None:
+            projection = self._projection(table, cols)
+        if projection is None:
+            yield from self.source.select(
+                table, cols, required, group_by, where, since
+            )
+            return
+        if self.available(table, cols, required, group_by, where) is None:
+            return
+        projected, rows = projection
+        yield from shape(list(projected), rows, required, group_by, where)
@@ -1,16 +1,29 @@
 import re
 
+from kf_model_fhir.mappers.common.sources import Source, PostgresSource
+
 
 # http://hl7.org/fhir/R4/datatypes.html#id
 def make_identifier(*args):
     return re.sub(r"[^A-Za-z0-9\-\.]", "-", ".".join(str(a) for a in args))[:64]
 
 
-def make_select(eng, table, *args):
-    row = next(eng.execute(f"SELECT * FROM {table};"))
-    cols = {a for a in args} & set(row.keys())
-    colstr = '"' + '","'.join(cols) + '"'
-    yield from eng.execute(f"SELECT DISTINCT {colstr} FROM {table};")
+def make_select(
+    eng, table, *args, required=(), group_by=(), where=None, since=None
+):
+    """
+    Select the distinct rows of the given columns that exist in the table.
+
+    Rows with a null or empty value in any of the required columns are
+    dropped. where maps some of the given columns to the collection of
+    values allowed in them, and since is a (watermark column, value) pair
+    that only keeps rows added or changed after that value. If group_by
+    columns are given, one row is returned per distinct group_by value and
+    every other column holds the list of its values in that group.
+    """
+    if not isinstance(eng, Source):
+        eng = PostgresSource(eng)
+    yield from eng.select(table, args, required, group_by, where, since)
 
 
 def get(row, col):
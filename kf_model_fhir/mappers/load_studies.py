@@ -0,0 +1,242 @@
+"""
+Load several studies into a target service concurrently, with one cap on the
+requests in flight to the target across all of them.
+
+Studies are given as study_id[:ingest_package] arguments, or in a JSON config
+file together with loader.py options by their long names:
+
+{
+    "max_studies": 4,
+    "global_max_in_flight": 50,
+    "options": {"target_url": "http://localhost:8000", "bundle_type": "batch"},
+    "studies": [
+        "SD_PREASA7S",
+        {
+            "study_id": "SD_BHJXBDQK",
+            "ingest_package": "initial-ingest",
+            "options": {"max_workers": 20}
+        }
+    ]
+}
+
+Options for every study can also follow the studies on the command line in
+the same form as for loader.py (e.g. -t http://localhost:8000 -b batch), and
+override the config file, even when given their default value. String
+options may hold {study_id} and {ingest_package} placeholders (e.g.
+"metrics": "metrics/{study_id}.json"), and each study writes NDJSON files
+to its own subdirectory of --output_dir.
+
+Each study gets its own warehouse engine and adaptive concurrency, which
+only the threads engine can share a cap with, and studies loaded into the
+same target share its client. A summary of every load is printed at the
+end, and written to --summary if given.
+
+Usage:
+    python load_studies.py [--config config.json] [study_id ...] [options]
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from kf_model_fhir.mappers.loader import (
+    parser as loader_parser,
+    validate,
+    StudyLoader,
+)
+
+from kf_model_fhir.common.retry import ConcurrencyLimiter, FixedLimit
+
+DEFAULT_INGEST_PACKAGE = loader_parser.get_default("ingest_package")
+STUDY_OPTIONS = ("study_id", "ingest_package")
+
+
+def study_entries(config, studies):
+    """
+    Return the (study_id, ingest_package, options) of every study to load.
+    """
+    entries = []
+    for study in config.get("studies", []):
+        if isinstance(study, str):
+            study = {"study_id": study}
+        entries.append(
+            (
+                study["study_id"],
+                study.get("ingest_package", DEFAULT_INGEST_PACKAGE),
+                study.get("options", {}),
+            )
+        )
+    for study in studies:
+        study_id, _, ingest_package = study.partition(":")
+        ingest_package = ingest_package or DEFAULT_INGEST_PACKAGE
+        entries.append((study_id, ingest_package, {}))
+    return entries
+
+
+def study_args(study_id, ingest_package, option_sets):
+    """
+    Return the loader arguments of a study with the option sets applied in
+    order.
+    """
+    args = loader_parser.parse_args([study_id, "-i", ingest_package])
+    templated = set()
+    for options in option_sets:
+        for name, value in options.items():
+            if name in STUDY_OPTIONS or not hasattr(args, name):
+                loader_parser.error(f"unknown loader option {name}")
+            if isinstance(value, str) and "{" in value:
+                value = value.replace("{study_id}", study_id).replace(
+                    "{ingest_package}", ingest_package
+                )
+                templated.add(name)
+            setattr(args, name, value)
+    if "output_dir" not in templated:
+        args.output_dir = os.path.join(args.output_dir, study_id)
+    return validate(args)
+
+
+def cli_options(study_id, argv):
+    """
+    Return the loader options given in argv, by name.
+    """
+    # Without defaults, only the options that are given are parsed, even
+    # those given their default value
+    defaults = {a: a.default for a in loader_parser._actions}
+    try:
+        for action in defaults:
+            action.default = argparse.SUPPRESS
+        given = vars(loader_parser.parse_args([study_id, *argv]))
+    finally:
+        for action, default in defaults.items():
+            action.default = default
+    return {n: v for n, v in given.items() if n not in STUDY_OPTIONS}
+
+
+def study_loads(config, studies, argv):
+    """
+    Return the loader arguments of every study to load, with the options of
+    the config file overridden by those of the study and then by the loader
+    options given in argv.
+    """
+    entries = study_entries(config, studies)
+    if not entries:
+        return []
+    options = cli_options(entries[0][0], argv)
+    return [
+        study_args(
+            study_id,
+            ingest_package,
+            [config.get("options", {}), study_options, options],
+        )
+        for study_id, ingest_package, study_options in entries
+    ]
+
+
+def load_study(study_loader, args):
+    started = time.monotonic()
+    try:
+        summary = study_loader.load(args)
+        summary["status"] = "loaded"
+    except Exception as e:
+        logging.exception(f"Failed to load {args.study_id}")
+        summary = {
+            "study_id": args.study_id,
+            "ingest_package": args.ingest_package,
+            "target_url": args.target_url,
+            "status": "failed",
+            "error": repr(e),
+            "seconds": round(time.monotonic() - started, 3),
+        }
+    return summary
+
+
+def report(summaries, elapsed):
+    for summary in summaries:
+        print(
+            f'{summary["study_id"]} ({summary["ingest_package"]}): '
+            f'{summary["status"]}, {summary.get("resources", 0)} resources '
+            f'in {summary["seconds"]}s'
+            + (f', {summary["error"]}' if "error" in summary else "")
+        )
+    failed = sum(1 for s in summaries if s["status"] == "failed")
+    total = sum(s.get("resources", 0) for s in summaries)
+    print(
+        f"Loaded {len(summaries) - failed} of {len(summaries)} studies, "
+        f"{total} resources in {elapsed:.1f}s"
+    )
+    return {
+        "studies": summaries,
+        "resources": total,
+        "failed": failed,
+        "seconds": round(elapsed, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load several studies concurrently. Any other options "
+        "are loader.py options for every study."
+    )
+    parser.add_argument(
+        "studies",
+        nargs="*",
+        help="Kids First study IDs, optionally with :<ingest package>",
+    )
+    parser.add_argument("--config", help="a JSON config file")
+    parser.add_argument(
+        "-n",
+        "--max_studies",
+        type=int,
+        help="the number of studies to load at the same time (default 4)",
+    )
+    parser.add_argument(
+        "--global_max_in_flight",
+        type=int,
+        help="the maximum number of requests in flight to the target across "
+        "all studies (default 50)",
+    )
+    parser.add_argument(
+        "--summary", help="write the summary of every load to this JSON file"
+    )
+    args, loader_argv = parser.parse_known_args()
+
+    config = {}
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+    max_studies = args.max_studies or config.get("max_studies", 4)
+    max_in_flight = args.global_max_in_flight or config.get(
+        "global_max_in_flight", 50
+    )
+    loads = study_loads(config, args.studies, loader_argv)
+    if not loads:
+        parser.error("no studies to load")
+    for loader_args in loads:
+        if loader_args.engine == "asyncio":
+            parser.error(
+                "only the threads engine shares --global_max_in_flight"
+            )
+        if loader_args.bulk_import and max_studies > 1:
+            parser.error("--bulk_import serves files from one port at a time")
+
+    logging.basicConfig(level=loads[0].log_level, format="%(message)s")
+    global_limiter = ConcurrencyLimiter(FixedLimit(max_in_flight))
+    started = time.monotonic()
+    with StudyLoader(global_limiter=global_limiter) as study_loader:
+        with ThreadPoolExecutor(max_workers=max_studies) as tpex:
+            summaries = list(
+                tpex.map(lambda a: load_study(study_loader, a), loads)
+            )
+    summary = report(summaries, time.monotonic() - started)
+    if args.summary:
+        with open(args.summary, "w") as f:
+            json.dump(summary, f, indent=2)
+    if summary["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,13 @@
 """
 Quickstart
 
-1. Pip-install the following dependencies:
+1. Pip-install this repository (pip install -e . from its root) and the
+following dependencies:
 
 - sqlalchemy
 - psycopg2
+- aiohttp
+- pyarrow (only to use --cache_dir)
 - -e git+https://github.com/kids-first/kf-lib-data-ingest#egg=kf-lib-data-ingest
 
 2. Export the following environmental variables:
@@ -16,9 +19,26 @@ Quickstart
 3. Tunnel to Bastion dev and run.
 
 For the detailed explanaion of arguments, please execute python loader.py -h.
+To load several studies at once, see python load_studies.py -h.
+
+To load studies from another program, reuse one StudyLoader for all of them,
+which keeps its warehouse connections open between loads, and with the
+asyncio engine the HTTP session and connections of every target:
+
+    from kf_model_fhir.mappers.loader import StudyLoader
+
+    with StudyLoader() as study_loader:
+        for study_id in study_ids:
+            study_loader.load(
+                study_loader.options(study_id, target_url=target_url)
+            )
 """
 import os
+import threading
 import argparse
+import logging
+from collections import Counter
+from functools import partial
 from urllib.parse import urlparse
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from pprint import pformat
@@ -27,46 +47,163 @@ import sqlalchemy as sa
 
 from ncpi_fhir_utility.client import FhirApiClient
 
-from resources.practitioner import yield_practitioners
-from resources.organization import yield_organizations
-from resources.practitioner_role import yield_practitioner_roles
-from resources.kfdrc_research_study import yield_kfdrc_research_studies
-from resources.kfdrc_patient import yield_kfdrc_patients
-from resources.group import yield_groups
-from resources.kfdrc_patient_relations import yield_kfdrc_patient_relations
-from resources.kfdrc_condition import yield_kfdrc_conditions
-from resources.kfdrc_phenotype import yield_kfdrc_phenotypes
+from kf_model_fhir.mappers.resources.practitioner import yield_practitioners
+from kf_model_fhir.mappers.resources.organization import yield_organizations
+from kf_model_fhir.mappers.resources.practitioner_role import (
+    yield_practitioner_roles,
+)
+from kf_model_fhir.mappers.resources.kfdrc_research_study import (
+    yield_kfdrc_research_studies,
+)
+from kf_model_fhir.mappers.resources.kfdrc_patient import yield_kfdrc_patients
+from kf_model_fhir.mappers.resources.group import yield_groups, yield_group_ids
+from kf_model_fhir.mappers.resources.kfdrc_patient_relations import (
+    yield_kfdrc_patient_relations,
+)
+from kf_model_fhir.mappers.resources.kfdrc_condition import (
+    yield_kfdrc_conditions,
+)
+from kf_model_fhir.mappers.resources.kfdrc_phenotype import (
+    yield_kfdrc_phenotypes,
+)
 
-# from resources.kfdrc_vital_status import yield_kfdrc_vital_statuses
-from resources.kfdrc_specimen import yield_kfdrc_specimens
+# from kf_model_fhir.mappers.resources.kfdrc_vital_status import (
+#     yield_kfdrc_vital_statuses,
+# )
+from kf_model_fhir.mappers.resources.kfdrc_specimen import (
+    yield_kfdrc_specimens,
+)
+from kf_model_fhir.mappers.resources import (
+    practitioner,
+    organization,
+    practitioner_role,
+    kfdrc_research_study,
+    kfdrc_patient,
+    group,
+    kfdrc_patient_relations,
+    kfdrc_condition,
+    kfdrc_phenotype,
+    kfdrc_specimen,
+)
 
-quit = False
+from kf_model_fhir.mappers.common.bundle import BUNDLE_TYPES, yield_bundles
+from kf_model_fhir.mappers.common.sinks import (
+    HttpSink,
+    MultiTargetSink,
+    NdjsonSink,
+    NullSink,
+)
+from kf_model_fhir.mappers.common.async_engine import (
+    AsyncSender,
+    AsyncSession,
+)
+from kf_model_fhir.mappers.common.scheduler import run_phases
+from kf_model_fhir.mappers.common.refindex import ReferenceIndex
+from kf_model_fhir.mappers.common.sources import (
+    PostgresSource,
+    CopySource,
+    FanOutSource,
+)
+from kf_model_fhir.mappers.common.cache import CachedSource
+from kf_model_fhir.mappers.common.file_sources import FILE_SOURCES
+from kf_model_fhir.mappers.common.delta import (
+    WatermarkStore,
+    Changes,
+    high_watermarks,
+)
+from kf_model_fhir.mappers.common.journal import Journal
+from kf_model_fhir.mappers.common.sample import Sample
+from kf_model_fhir.mappers.common.instrument import (
+    MeteredSource,
+    meter_payloads,
+)
+from kf_model_fhir.mappers.common.progress import Progress
+from kf_model_fhir.mappers.common.preflight import check_references
+from kf_model_fhir.mappers.common.parallel import (
+    ShardedSource,
+    map_in_processes,
+    serialized,
+)
+
+from kf_model_fhir.common.bulk_import import bulk_import, report
+from kf_model_fhir.common.ndjson import resource_files
+from kf_model_fhir.common.manifest import ResourceManifest
+from kf_model_fhir.common.metrics import Metrics
+from kf_model_fhir.common.profiling import Profiler
+from kf_model_fhir.common.sharding import OWNER, parse_shard
+from kf_model_fhir.common.retry import (
+    RetryPolicy,
+    Aimd,
+    FixedLimit,
+    ConcurrencyLimiter,
+    AsyncConcurrencyLimiter,
+)
+
+logger = logging.getLogger(__name__)
+
+# The where filter of the rows of each phase that a delta or sample load
+# filters
+PHASE_ROWS = {
+    "kfdrc_patients": "patients",
+    "groups": "groups",
+    "kfdrc_patient_relations": "relations",
+    "kfdrc_conditions": "participants",
+    "kfdrc_phenotypes": "participants",
+    "kfdrc_specimens": "participants",
+}
+
+# The projections of the tables that each phase reads, which a fan-out
+# extracts in one pass per table: (table name, columns)
+PHASE_PROJECTIONS = {
+    "practitioners": [("default", practitioner.COLUMNS)],
+    "organizations": [("default", organization.COLUMNS)],
+    "practitioner_roles": [("default", practitioner_role.COLUMNS)],
+    "kfdrc_patients": [("default", kfdrc_patient.COLUMNS)],
+    "groups": [("default", group.COLUMNS)],
+    "kfdrc_research_studies": [("default", kfdrc_research_study.COLUMNS)],
+    "kfdrc_patient_relations": [
+        ("family_relationship", kfdrc_patient_relations.COLUMNS),
+        ("default", kfdrc_patient.COLUMNS),
+    ],
+    "kfdrc_conditions": [("default", kfdrc_condition.COLUMNS)],
+    "kfdrc_phenotypes": [("default", kfdrc_phenotype.COLUMNS)],
+    "kfdrc_specimens": [("default", kfdrc_specimen.COLUMNS)],
+}
+
+SHARED_PHASES = {
+    "practitioners",
+    "organizations",
+    "practitioner_roles",
+    "groups",
+    "kfdrc_research_studies",
+}
 
 
 def db_study_url(db_maintenance_url, study_id):
     return urlparse(db_maintenance_url)._replace(path=f"/{study_id}").geturl()
 
 
-def send_resource(payload):
-    if quit:
-        return
-    endpoint = f'{client.base_url}/{payload["resourceType"]}/{payload["id"]}'
-    success, result = client.send_request("PUT", endpoint, json=payload)
-    return success, result, payload
-
-
-def consume_futures(futures):
-    global quit
-    for future in as_completed(futures):
-        success, result, payload = future.result()
-        print(f'Sent {payload["id"]}')
-        if not success:
-            quit = True
-            raise Exception(
-                f"""
-                Failed to submit:\n{pformat(payload)}\n{'-'*80}\n{pformat(result)}
-                """
-            )
+def create_client(target_url):
+    return FhirApiClient(base_url=target_url, auth=(FHIR_USER, FHIR_PASS))
+
+
+def create_engine(db_maintenance_url, study_id):
+    return sa.create_engine(
+        db_study_url(db_maintenance_url, study_id),
+        connect_args={"connect_timeout": 5},
+        server_side_cursors=True,
+    )
+
+
+def record(pairs, index):
+    for payload, key in pairs:
+        index[key] = payload["id"]
+        yield payload
+
+
+def yield_payloads(pairs):
+    for payload, _ in pairs:
+        yield payload
 
 
 # Read in evironmental variables
@@ -83,124 +220,1206 @@ parser.add_argument(
     default="http://localhost:8000",
     help="a target service URL where data will be loaded into",
 )
+parser.add_argument(
+    "--extra_target_url",
+    action="append",
+    help="also load the resources into this target service, building and "
+    "serializing them once for every target (can be repeated)",
+)
+parser.add_argument(
+    "--target_buffer",
+    type=int,
+    default=1000,
+    help="the number of resources or Bundles that the other targets of "
+    "several can send ahead of the slowest one before it holds them up",
+)
 parser.add_argument(
     "-i",
     "--ingest_package",
     default="initial-ingest",
     help="an ingest package name that data will be pulled from",
 )
+parser.add_argument(
+    "-o",
+    "--sink",
+    choices=("http", "ndjson", "null"),
+    default="http",
+    help="send resources to the target service, write them to NDJSON files "
+    "or only serialize and count them",
+)
+parser.add_argument(
+    "--output_dir",
+    default="output",
+    help="the directory that the ndjson sink writes to",
+)
+parser.add_argument(
+    "--shard_size",
+    type=int,
+    default=100000,
+    help="the maximum number of resources per NDJSON file",
+)
+parser.add_argument(
+    "-z",
+    "--compress",
+    action="store_true",
+    help="gzip the NDJSON files",
+)
+parser.add_argument(
+    "--bulk_import",
+    action="store_true",
+    help="write resources to NDJSON files in the output directory, serve "
+    "them over HTTP and load them into the target service with $import",
+)
+parser.add_argument(
+    "--file_server_port",
+    type=int,
+    default=8080,
+    help="the port of the file server that serves NDJSON files to $import",
+)
+parser.add_argument(
+    "--file_server_url",
+    help="the URL that the target service reaches the file server at "
+    "(default: http://<this host's name>:<file server port>)",
+)
+parser.add_argument(
+    "--import_poll_interval",
+    type=float,
+    default=10,
+    help="seconds between polls of the $import status endpoint, unless the "
+    "target service asks for another interval with Retry-After",
+)
+parser.add_argument(
+    "--import_timeout",
+    type=float,
+    help="give up on an $import job after this many seconds",
+)
+parser.add_argument(
+    "-b",
+    "--bundle_type",
+    choices=BUNDLE_TYPES,
+    help="submit resources in FHIR Bundles of this type instead of one by one",
+)
+parser.add_argument(
+    "--bundle_max_entries",
+    type=int,
+    default=500,
+    help="the maximum number of entries in a Bundle",
+)
+parser.add_argument(
+    "--bundle_max_bytes",
+    type=int,
+    default=5 * 1024 * 1024,
+    help="the maximum serialized size of the entries in a Bundle",
+)
+parser.add_argument(
+    "-e",
+    "--engine",
+    choices=("threads", "asyncio"),
+    default="threads",
+    help="send resources from a thread pool or from an asyncio event loop",
+)
+parser.add_argument(
+    "-w",
+    "--max_workers",
+    type=int,
+    default=10,
+    help="the number of send threads shared by all running phases, which "
+    "bounds the concurrency of the threads engine",
+)
+parser.add_argument(
+    "--map_processes",
+    type=int,
+    default=0,
+    help="build the resources of participant-level phases in this many "
+    "forked processes, sharded by participant, instead of in the phase's "
+    "thread",
+)
+parser.add_argument(
+    "--shard",
+    type=parse_shard,
+    help="only load shard i of N (given as i/N, from 0): the resources of "
+    "the participants whose ID hashes to it, and the resources shared by "
+    "every participant if i is 0",
+)
+parser.add_argument(
+    "--max_in_flight",
+    type=int,
+    default=200,
+    help="the maximum number of concurrent requests of the asyncio engine",
+)
+parser.add_argument(
+    "-r",
+    "--retries",
+    type=int,
+    default=8,
+    help="how many times to retry a request that failed for a transient "
+    "reason (408, 425, 429, 500, 502, 503, 504 or no response)",
+)
+parser.add_argument(
+    "--latency_target",
+    type=float,
+    help="reduce concurrency when a request takes longer than this many "
+    "seconds, as well as when one fails for a transient reason",
+)
+parser.add_argument(
+    "--fixed_concurrency",
+    action="store_true",
+    help="always use --max_workers threads or --max_in_flight requests "
+    "instead of adapting concurrency to the target service",
+)
+parser.add_argument(
+    "-x",
+    "--extract_with",
+    choices=("copy", "cursor"),
+    default="copy",
+    help="read the warehouse with COPY ... TO STDOUT or a server side cursor",
+)
+parser.add_argument(
+    "-s",
+    "--source_dir",
+    help="read the tables from <table name>.<source format> files in this "
+    "directory instead of the warehouse",
+)
+parser.add_argument(
+    "--source_format",
+    choices=FILE_SOURCES.keys(),
+    default="tsv",
+    help="the format of the files in the source directory",
+)
+parser.add_argument(
+    "-c",
+    "--cache_dir",
+    help="cache the warehouse columns read by the mappers in this directory "
+    "and reuse them on later runs without connecting to the warehouse",
+)
+parser.add_argument(
+    "--verify_cache",
+    action="store_true",
+    help="drop cached tables whose row count or max xmin has changed",
+)
+parser.add_argument(
+    "--refresh",
+    action="store_true",
+    help="ignore and replace any cached warehouse columns",
+)
+parser.add_argument(
+    "--no_fan_out",
+    action="store_true",
+    help="query the warehouse once per mapper instead of scanning each "
+    "table once for all of them",
+)
+parser.add_argument(
+    "--no_preflight",
+    action="store_true",
+    help="don't check that every resource that the study's rows reference "
+    "is built before loading any",
+)
+parser.add_argument(
+    "-d",
+    "--delta",
+    help="only rebuild resources that depend on warehouse rows changed since "
+    "the last successful load into the target, whose watermarks are kept in "
+    "this JSON file",
+)
+parser.add_argument(
+    "--sample",
+    type=int,
+    help="only load this many participants, picked by a stable hash of their "
+    "IDs, with what they reference and the resources of the whole study",
+)
+parser.add_argument(
+    "--participants",
+    help="only load the participants listed in this file, one ID per line, "
+    "with what they reference and the resources of the whole study",
+)
+parser.add_argument(
+    "--watermark_column",
+    default="xmin",
+    help="a timestamp or version column of the warehouse tables that "
+    "increases whenever a row changes, or xmin for Postgres transaction ids",
+)
+parser.add_argument(
+    "--metrics",
+    help="write counts, bytes, latency percentiles, retries and the slowest "
+    "requests of extraction, mapping, serialization and sending per resource "
+    "type to this JSON file",
+)
+parser.add_argument(
+    "--prometheus",
+    help="also write the metrics to this file in the Prometheus text format",
+)
+parser.add_argument(
+    "--metrics_interval",
+    type=float,
+    help="rewrite the metrics files every this many seconds during the load",
+)
+parser.add_argument(
+    "-q",
+    "--quiet",
+    action="store_true",
+    help="only report each phase once it is done instead of its progress",
+)
+parser.add_argument(
+    "--progress_interval",
+    type=float,
+    default=10.0,
+    help="report the progress of running phases at most every this many "
+    "seconds",
+)
+parser.add_argument(
+    "--log_level",
+    choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+    default="INFO",
+    help="logging level; DEBUG logs the id of every resource sent",
+)
+parser.add_argument(
+    "--profile",
+    nargs="?",
+    const="profiles",
+    help="profile each phase with cProfile and tracemalloc and write the "
+    "pstats and top allocations to this directory (default: profiles)",
+)
+parser.add_argument(
+    "-j",
+    "--journal",
+    help="record completed phases and acknowledged resources in this SQLite "
+    "file so that a failed load can be resumed",
+)
+parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="resume the last load of the study into the target from the "
+    "journal instead of starting over",
+)
+parser.add_argument(
+    "-m",
+    "--manifest",
+    help="skip resources whose content is the same as when they were last "
+    "sent to the target service, according to this SQLite file",
+)
+parser.add_argument(
+    "-f",
+    "--force",
+    action="store_true",
+    help="send every resource even if the manifest says it is unchanged",
+)
 
-# Parse arguments
-args = parser.parse_args()
-study_id = args.study_id
-target_url = args.target_url
-ingest_package = args.ingest_package
 
-# Create DB engine connection
-engine = sa.create_engine(
-    db_study_url(KF_WAREHOUSE_DB_URL, study_id),
-    connect_args={"connect_timeout": 5},
-    server_side_cursors=True,
-)
-schema = f"Ingest:{ingest_package}:GuidedTransformStage"
+def validate(args):
+    """
+    Check the arguments of a load and return them.
+    """
+    if args.bulk_import:
+        if args.sink == "null":
+            parser.error("--bulk_import writes to the ndjson sink")
+        if args.compress:
+            parser.error("--bulk_import serves uncompressed NDJSON files")
+        if os.path.isdir(args.output_dir) and resource_files(args.output_dir):
+            parser.error(
+                f"{args.output_dir} already holds NDJSON files that "
+                "--bulk_import would import too"
+            )
+        args.sink = "ndjson"
+    if args.engine == "asyncio" and args.sink != "http":
+        parser.error("the asyncio engine only sends to the http sink")
+    if args.delta and (args.source_dir or args.cache_dir):
+        parser.error("--delta reads changed rows from the warehouse")
+    if args.sample is not None and args.participants:
+        parser.error("sample either --sample participants or --participants")
+    if args.delta and (args.sample is not None or args.participants):
+        parser.error("a sample load can't be a --delta load")
+    if args.resume and not args.journal:
+        parser.error("--resume needs the --journal of the load to resume")
+    if args.journal and args.sink != "http":
+        parser.error("the journal only tracks resources sent to the http sink")
+    if args.manifest and args.sink != "http":
+        parser.error(
+            "the manifest only tracks resources sent to the http sink"
+        )
+    if args.extra_target_url:
+        if args.sink != "http" or args.engine != "threads":
+            parser.error(
+                "--extra_target_url sends to the http sink from threads"
+            )
+        if args.journal or args.manifest:
+            parser.error(
+                "the journal and manifest only track one target, not "
+                "--extra_target_url"
+            )
+    return args
+
+
+def load(
+    args,
+    global_limiter=None,
+    engine=None,
+    client_for=None,
+    source=None,
+    sink=None,
+    async_session=None,
+):
+    """
+    Load a study into the target with the parsed loader arguments and
+    return a summary of the load. global_limiter, if given, caps the
+    requests in flight of this load together with other loads.
+
+    The warehouse engine is created for the load unless given, and so are
+    the FHIR clients of the targets unless client_for is given to return
+    the client of a target URL. A source can be given to read instead of
+    the warehouse or --source_dir tables, and a sink to send to instead of
+    the --sink, which the load closes when it is done. The asyncio engine
+    sends from its own AsyncSession unless async_session is given.
+    """
+    study_id = args.study_id
+    target_url = args.target_url
+    extra_target_urls = args.extra_target_url or []
+    target_buffer = args.target_buffer
+    ingest_package = args.ingest_package
+    sink_type = args.sink
+    output_dir = args.output_dir
+    shard_size = args.shard_size
+    compress = args.compress
+    import_bulk = args.bulk_import
+    file_server_port = args.file_server_port
+    file_server_url = args.file_server_url
+    import_poll_interval = args.import_poll_interval
+    import_timeout = args.import_timeout
+    bundle_type = args.bundle_type
+    bundle_max_entries = args.bundle_max_entries
+    bundle_max_bytes = args.bundle_max_bytes
+    engine_type = args.engine
+    max_workers = args.max_workers
+    map_processes = args.map_processes
+    shard = args.shard
+    max_in_flight = args.max_in_flight
+    retries = args.retries
+    latency_target = args.latency_target
+    fixed_concurrency = args.fixed_concurrency
+    source_dir = args.source_dir
+    source_format = args.source_format
+    extract_with = args.extract_with
+    cache_dir = args.cache_dir
+    verify_cache = args.verify_cache
+    refresh = args.refresh
+    delta_path = args.delta
+    watermark_column = args.watermark_column
+    sample_size = args.sample
+    participants_path = args.participants
+    sampled = sample_size is not None or bool(participants_path)
+    fan_out = not args.no_fan_out and not delta_path and not sampled
+    preflight = not args.no_preflight
+    metrics_path = args.metrics
+    prometheus_path = args.prometheus
+    metrics_interval = args.metrics_interval
+    quiet = args.quiet
+    progress_interval = args.progress_interval
+    profile_dir = args.profile
+    journal_path = args.journal
+    resume = args.resume
+    manifest_path = args.manifest
+    force = args.force
+
+    schema = f"Ingest:{ingest_package}:GuidedTransformStage"
+
+    tables = {
+        "default": f'"{schema}".default',
+        "family_relationship": f'"{schema}".family_relationship',
+    }
+
+    # Read the tables from exported files or from the warehouse
+    if source is None and source_dir:
+        source = FILE_SOURCES[source_format](
+            {
+                table: os.path.join(source_dir, f"{name}.{source_format}")
+                for name, table in tables.items()
+            }
+        )
+    elif source is None:
+        if engine is None:
+            engine = create_engine(KF_WAREHOUSE_DB_URL, study_id)
+        if extract_with == "copy":
+            source = CopySource(engine)
+        else:
+            source = PostgresSource(engine)
+
+    # The preflight check only selects key columns, which it reads from here
+    # rather than from the fan-out or cache, which would extract every
+    # column of the tables first
+    key_source = source
+
+    # Pick the participants of a sample load before rows are extracted, so
+    # that only theirs are
+    sample = None
+    if participants_path:
+        sample = Sample.read(participants_path)
+    elif sample_size is not None:
+        sample = Sample.first(source, tables["default"], sample_size)
+    if sample:
+        print(f"Sample load: {sample}")
+
+    # Extract every projection the mappers need in one pass per table
+    if cache_dir:
+        source = CachedSource(
+            source, cache_dir, study_id, ingest_package, verify_cache, refresh
+        )
+    fan_out_source = None
+    if fan_out:
+        projections = {}
+        for reads in PHASE_PROJECTIONS.values():
+            for name, columns in reads:
+                projections.setdefault(tables[name], []).append(columns)
+        source = fan_out_source = FanOutSource(source, projections)
+
+    # Time extraction, mapping, serialization and sending
+    metrics = None
+    if metrics_path or prometheus_path:
+        metrics = Metrics()
+        source = MeteredSource(source, metrics)
+
+    # Each shard only reads the rows of its participants, and keeps its own
+    # journal and watermarks
+    participant_source = source
+    shard_key = ""
+    if shard:
+        participant_source = ShardedSource(source, *shard)
+        shard_key = f"|shard {shard[0]}/{shard[1]}"
+
+    # Find what changed since the last load, before anything else can change
+    changes = None
+    if delta_path:
+        watermarks = WatermarkStore(delta_path)
+        watermark_key = (
+            WatermarkStore.key(target_url, study_id, ingest_package)
+            + shard_key
+        )
+        new_watermarks = high_watermarks(source, tables, watermark_column)
+        old_watermarks = watermarks.get(watermark_key)
+        if old_watermarks is None:
+            print("No watermarks from a previous load, loading everything")
+        else:
+            changes = Changes(source, tables, watermark_column, old_watermarks)
+            print(f"Delta load: {changes}")
+
+    # Only rebuild what changed, or the closure of the sampled participants
+    filters = changes or sample
+
+    def rows_where(name):
+        return filters.where(name) if filters else None
+
+    # Instantiate FHIR API client
+    client_for = client_for or create_client
+    client = client_for(target_url)
+    retry_policy = RetryPolicy(retries)
+    max_concurrency = (
+        max_in_flight if engine_type == "asyncio" else max_workers
+    )
+
+    def create_limiter():
+        if fixed_concurrency:
+            concurrency = FixedLimit(max_concurrency)
+        else:
+            concurrency = Aimd(max_concurrency, latency_target=latency_target)
+        if engine_type == "asyncio":
+            return AsyncConcurrencyLimiter(concurrency)
+        return ConcurrencyLimiter(concurrency, global_limiter)
+
+    limiter = create_limiter()
+    if sink is None and sink_type == "ndjson":
+        sink = NdjsonSink(output_dir, shard_size, compress)
+    elif sink is None and sink_type == "null":
+        sink = NullSink(metrics)
+    elif sink is None and extra_target_urls:
+        # Every target retries and adapts its concurrency on its own
+        sink = MultiTargetSink(
+            {
+                target_url: HttpSink(client, retry_policy, limiter, metrics),
+                **{
+                    url: HttpSink(
+                        client_for(url),
+                        RetryPolicy(retries),
+                        create_limiter(),
+                        metrics,
+                    )
+                    for url in extra_target_urls
+                },
+            },
+            max_workers,
+            target_buffer,
+            metrics,
+        )
+    elif sink is None:
+        sink = HttpSink(client, retry_policy, limiter, metrics)
+    manifest = None
+    if manifest_path:
+        manifest = ResourceManifest(manifest_path)
+    journal = None
+    completed_phases = set()
+    acked = set()
+    if journal_path:
+        journal = Journal(
+            journal_path,
+            f"{target_url}|{study_id}|{ingest_package}{shard_key}",
+            resume,
+        )
+        completed_phases = journal.completed()
+        acked = journal.acked()
+        if resume:
+            print(
+                f"Resuming after {len(completed_phases)} completed phases and "
+                f"{len(acked)} acknowledged resources"
+            )
+    # Every phase sends from the same event loop and session
+    async_sender = None
+    if engine_type == "asyncio":
+        async_sender = AsyncSender(
+            client.base_url,
+            (FHIR_USER, FHIR_PASS),
+            client._fhir_version_headers(),
+            max_in_flight,
+            retry_policy,
+            limiter,
+            metrics,
+            async_session,
+        )
+
+    progress = Progress(progress_interval, quiet, partial(print, study_id))
+    quit = False
+
+    def stop_if_quit():
+        # A phase that stops early must fail too, so that it isn't recorded
+        # as complete
+        if quit:
+            raise Exception("Stopped after another phase failed")
+
+    def send_resource(payload):
+        stop_if_quit()
+        return sink.send(payload, serialized(payload))
+
+    def send_bundle(bundle):
+        stop_if_quit()
+        return sink.send_bundle(bundle)
+
+    def check_results(results, phase):
+        nonlocal quit
+        for success, result, payload in results:
+            if not success:
+                quit = True
+                raise Exception(
+                    f"""
+                    Failed to submit:\n{pformat(payload)}\n{'-'*80}\n{pformat(result)}
+                    """
+                )
+            if manifest:
+                manifest.record(client.base_url, payload)
+            if journal:
+                journal.ack(payload)
+            logger.debug("Sent %s", payload["id"])
+            progress.advance(phase)
+
+    def consume_futures(futures, phase):
+        for future in as_completed(futures):
+            check_results(future.result(), phase)
+
+    def skip_unchanged(payloads, phase):
+        for payload in payloads:
+            if manifest.unchanged(client.base_url, payload):
+                logger.debug("Skipped unchanged %s", payload["id"])
+                progress.advance(phase)
+                continue
+            yield payload
+
+    def skip_acked(payloads, phase):
+        for payload in payloads:
+            if f'{payload["resourceType"]}/{payload["id"]}' in acked:
+                progress.advance(phase)
+                continue
+            yield payload
+
+    def until_quit(units):
+        for unit in units:
+            stop_if_quit()
+            yield unit
+
+    def send_all(tpex, payloads, phase):
+        if metrics:
+            payloads = meter_payloads(payloads, metrics)
+        if acked:
+            payloads = skip_acked(payloads, phase)
+        if manifest and not force:
+            payloads = skip_unchanged(payloads, phase)
+        units = payloads
+        if bundle_type:
+            units = yield_bundles(
+                payloads, bundle_type, bundle_max_entries, bundle_max_bytes
+            )
+        units = until_quit(units)
+
+        if async_sender:
+            if bundle_type:
+                request = async_sender.post_bundle
+            else:
+                # Resources mapped in worker processes are sent as they
+                # were serialized there
+                def request(payload):
+                    return async_sender.put_resource(
+                        payload, serialized(payload)
+                    )
+
+            async_sender.send_all(
+                units, request, partial(check_results, phase=phase)
+            )
+        elif isinstance(sink, MultiTargetSink):
+            # The targets send from their own queues, which hold up the
+            # phase only when the slowest one is a buffer behind
+            submit = sink.submit_bundle if bundle_type else sink.submit
+            consume_futures(
+                [submit(unit, serialized(unit)) for unit in units], phase
+            )
+        else:
+            send = send_bundle if bundle_type else send_resource
+            consume_futures([tpex.submit(send, unit) for unit in units], phase)
+        stop_if_quit()
+
+    def mapped(mapper, *mapper_args, pairs=False, sharded=False):
+        """
+        Run a yield_* mapper on the source, in --map_processes worker processes
+        if that is set. pairs tells whether it yields (payload, key) pairs,
+        and sharded whether it only maps the participants of the --shard.
+        """
+        eng = participant_source if sharded else source
+        if map_processes:
+            return map_in_processes(
+                map_processes, mapper, eng, *mapper_args, pairs=pairs
+            )
+        return mapper(eng, *mapper_args)
+
+    # Load resources
+    practitioners = ReferenceIndex()
+    organizations = ReferenceIndex()
+    practitioner_roles = ReferenceIndex()
+    kfdrc_patients = ReferenceIndex()
+    groups = ReferenceIndex()
+    kfdrc_specimens = ReferenceIndex()
+
+    def load_practitioners():
+        send_all(
+            tpex,
+            record(
+                yield_practitioners(source, tables["default"]), practitioners
+            ),
+            "practitioners",
+        )
+
+    def load_organizations():
+        send_all(
+            tpex,
+            record(
+                yield_organizations(source, tables["default"]), organizations
+            ),
+            "organizations",
+        )
+
+    def load_practitioner_roles():
+        send_all(
+            tpex,
+            record(
+                yield_practitioner_roles(
+                    source, tables["default"], practitioners, organizations
+                ),
+                practitioner_roles,
+            ),
+            "practitioner_roles",
+        )
+
+    def load_kfdrc_patients():
+        # Only indexes the Patients, which the relations phase sends
+        pairs = mapped(
+            yield_kfdrc_patients,
+            tables["default"],
+            study_id,
+            rows_where("patients"),
+            pairs=True,
+        )
+        if metrics:
+            pairs = meter_payloads(pairs, metrics)
+        for payload, kfdrc_patient_id in pairs:
+            kfdrc_patients[kfdrc_patient_id] = payload["id"]
+
+    def load_groups():
+        send_all(
+            tpex,
+            record(
+                mapped(
+                    yield_groups,
+                    tables["default"],
+                    study_id,
+                    kfdrc_patients,
+                    rows_where("groups"),
+                    pairs=True,
+                ),
+                groups,
+            ),
+            "groups",
+        )
+        # The research study enrolls every Group, not only the rebuilt ones
+        if changes:
+            for group_id, family_id in yield_group_ids(
+                source, tables["default"], study_id
+            ):
+                groups[family_id] = group_id
+
+    def load_kfdrc_research_studies():
+        send_all(
+            tpex,
+            yield_kfdrc_research_studies(
+                source,
+                tables["default"],
+                study_id,
+                organizations,
+                practitioner_roles,
+                groups,
+            ),
+            "kfdrc_research_studies",
+        )
+
+    def load_kfdrc_patient_relations():
+        send_all(
+            tpex,
+            yield_payloads(
+                mapped(
+                    yield_kfdrc_patient_relations,
+                    tables["family_relationship"],
+                    tables["default"],
+                    study_id,
+                    kfdrc_patients,
+                    rows_where("relations"),
+                    rows_where("sent_patients"),
+                    pairs=True,
+                    sharded=True,
+                )
+            ),
+            "kfdrc_patient_relations",
+        )
+
+    def load_kfdrc_conditions():
+        send_all(
+            tpex,
+            mapped(
+                yield_kfdrc_conditions,
+                tables["default"],
+                study_id,
+                kfdrc_patients,
+                rows_where("participants"),
+                sharded=True,
+            ),
+            "kfdrc_conditions",
+        )
+
+    def load_kfdrc_phenotypes():
+        send_all(
+            tpex,
+            mapped(
+                yield_kfdrc_phenotypes,
+                tables["default"],
+                study_id,
+                kfdrc_patients,
+                rows_where("participants"),
+                sharded=True,
+            ),
+            "kfdrc_phenotypes",
+        )
+
+    def load_kfdrc_specimens():
+        send_all(
+            tpex,
+            record(
+                mapped(
+                    yield_kfdrc_specimens,
+                    tables["default"],
+                    study_id,
+                    kfdrc_patients,
+                    rows_where("participants"),
+                    pairs=True,
+                    sharded=True,
+                ),
+                kfdrc_specimens,
+            ),
+            "kfdrc_specimens",
+        )
+
+    # Each phase starts as soon as the reference maps it reads are complete
+    phases = [
+        ("practitioners", (), load_practitioners),
+        ("organizations", (), load_organizations),
+        (
+            "practitioner_roles",
+            ("practitioners", "organizations"),
+            load_practitioner_roles,
+        ),
+        ("kfdrc_patients", (), load_kfdrc_patients),
+        ("groups", ("kfdrc_patients",), load_groups),
+        (
+            "kfdrc_research_studies",
+            ("organizations", "practitioner_roles", "groups"),
+            load_kfdrc_research_studies,
+        ),
+        (
+            "kfdrc_patient_relations",
+            ("kfdrc_patients",),
+            load_kfdrc_patient_relations,
+        ),
+        ("kfdrc_conditions", ("kfdrc_patients",), load_kfdrc_conditions),
+        ("kfdrc_phenotypes", ("kfdrc_patients",), load_kfdrc_phenotypes),
+        ("kfdrc_specimens", ("kfdrc_patients",), load_kfdrc_specimens),
+    ]
+
+    # Resources shared by every participant are only loaded by one shard.
+    # Every shard indexes all patients, which related patients reference.
+    if shard and shard[0] != OWNER:
+        phases = [
+            (name, requires, load)
+            for name, requires, load in phases
+            if name not in SHARED_PHASES
+        ]
+
+    # Drop the rows of each fanned-out projection once the last phase that
+    # reads it has finished, and those that no phase to run reads right away
+    if fan_out_source:
+        readers = Counter(
+            (tables[table_name], columns)
+            for name, _, _ in phases
+            if name not in completed_phases
+            for table_name, columns in PHASE_PROJECTIONS[name]
+        )
+        for reads in PHASE_PROJECTIONS.values():
+            for table_name, columns in reads:
+                if not readers[(tables[table_name], columns)]:
+                    fan_out_source.release(tables[table_name], columns)
+        readers_lock = threading.Lock()
+
+        def releasing(name, load):
+            def run():
+                load()
+                for table_name, columns in PHASE_PROJECTIONS[name]:
+                    key = (tables[table_name], columns)
+                    with readers_lock:
+                        readers[key] -= 1
+                        last = not readers[key]
+                    if last:
+                        fan_out_source.release(*key)
+
+            return run
+
+        phases = [
+            (
+                name,
+                requires,
+                load
+                if name in completed_phases
+                else releasing(name, load),
+            )
+            for name, requires, load in phases
+        ]
+
+    def count(module, table, where=None, group_by=(), sharded=False):
+        eng = participant_source if sharded else source
+        return eng.count(
+            table, module.COLUMNS, module.REQUIRED, group_by, where
+        )
+
+    # Counts of the resources that each phase will build, which are upper
+    # bounds for the mappers that skip some rows. Only fanned-out rows are
+    # counted, and phases of other sources report progress without a total.
+    phase_totals = {
+        "practitioners": lambda: count(practitioner, tables["default"]),
+        "organizations": lambda: count(organization, tables["default"]),
+        "practitioner_roles": lambda: count(
+            practitioner_role, tables["default"]
+        ),
+        "groups": lambda: count(
+            group, tables["default"], rows_where("groups"), group.GROUP_BY
+        ),
+        "kfdrc_research_studies": lambda: count(
+            kfdrc_research_study, tables["default"]
+        ),
+        "kfdrc_patient_relations": lambda: count(
+            kfdrc_patient,
+            tables["default"],
+            rows_where("sent_patients"),
+            sharded=True,
+        ),
+        "kfdrc_conditions": lambda: count(
+            kfdrc_condition,
+            tables["default"],
+            rows_where("participants"),
+            sharded=True,
+        ),
+        "kfdrc_phenotypes": lambda: count(
+            kfdrc_phenotype,
+            tables["default"],
+            rows_where("participants"),
+            sharded=True,
+        ),
+        "kfdrc_specimens": lambda: count(
+            kfdrc_specimen,
+            tables["default"],
+            rows_where("participants"),
+            sharded=True,
+        ),
+    }
+
+    def tracked(name, load):
+        def run():
+            progress.start(name, phase_totals[name]())
+            load()
+            progress.finish(name)
+
+        return run
+
+    phases = [
+        (name, requires, tracked(name, load) if name in phase_totals else load)
+        for name, requires, load in phases
+    ]
+
+    # The resource type that each phase builds, for profile file names
+    phase_resource_types = {
+        "practitioners": practitioner.RESOURCE_TYPE,
+        "organizations": organization.RESOURCE_TYPE,
+        "practitioner_roles": practitioner_role.RESOURCE_TYPE,
+        "kfdrc_patients": kfdrc_patient.RESOURCE_TYPE,
+        "groups": group.RESOURCE_TYPE,
+        "kfdrc_research_studies": kfdrc_research_study.RESOURCE_TYPE,
+        "kfdrc_patient_relations": kfdrc_patient_relations.RESOURCE_TYPE,
+        "kfdrc_conditions": kfdrc_condition.RESOURCE_TYPE,
+        "kfdrc_phenotypes": kfdrc_phenotype.RESOURCE_TYPE,
+        "kfdrc_specimens": kfdrc_specimen.RESOURCE_TYPE,
+    }
+
+    def profiled(name, load):
+        def run():
+            with profiler.phase(f"{phase_resource_types[name]}.{name}"):
+                load()
+
+        return run
+
+    if profile_dir:
+        profiler = Profiler(profile_dir, study_id)
+        phases = [
+            (name, requires, profiled(name, load))
+            for name, requires, load in phases
+        ]
+
+    # The reference index that each phase builds, for the journal
+    phase_indexes = {
+        "practitioners": practitioners,
+        "organizations": organizations,
+        "practitioner_roles": practitioner_roles,
+        "kfdrc_patients": kfdrc_patients,
+        "groups": groups,
+        "kfdrc_specimens": kfdrc_specimens,
+    }
+
+    def checkpointed(name, load):
+        def run():
+            index = phase_indexes.get(name)
+            if name in completed_phases:
+                if index is not None:
+                    journal.restore(name, index)
+                print(f"Skipped completed phase {name}")
+                return
+            nonlocal quit
+            try:
+                load()
+            except Exception:
+                quit = True
+                raise
+            # Another phase may have failed while this one finished
+            if not quit:
+                journal.complete(name, index)
+
+        return run
+
+    if journal:
+        phases = [
+            (name, requires, checkpointed(name, load))
+            for name, requires, load in phases
+        ]
+
+    stop_metrics = None
+    if metrics and metrics_interval:
+        stop_metrics = metrics.start(
+            metrics_interval, metrics_path, prometheus_path
+        )
+
+    try:
+        # Fail on dangling references before anything is sent or extracted
+        if preflight:
+            violations = check_references(
+                key_source,
+                tables,
+                {
+                    name
+                    for name, _, _ in phases
+                    if name not in completed_phases
+                },
+                {
+                    phase: rows_where(rows)
+                    for phase, rows in PHASE_ROWS.items()
+                },
+            )
+            if violations:
+                raise Exception(
+                    "Dangling references:\n" + "\n".join(violations)
+                )
+        with ThreadPoolExecutor(max_workers=max_workers) as tpex:
+            run_phases(phases)
+    finally:
+        if metrics:
+            if stop_metrics:
+                stop_metrics.set()
+            metrics.write(metrics_path, prometheus_path)
+        if async_sender:
+            async_sender.close()
+        sink.close()
+        if manifest:
+            manifest.close()
+        if journal:
+            journal.close()
+    progress.summary()
+
+    # A target that failed only stopped itself, but the load still fails
+    if isinstance(sink, MultiTargetSink) and sink.failures:
+        raise Exception(f"Failed to load into {', '.join(sink.failures)}")
+
+    if import_bulk:
+        report(
+            bulk_import(
+                output_dir,
+                client.base_url,
+                (FHIR_USER, FHIR_PASS),
+                client._fhir_version_headers(),
+                file_server_port,
+                file_server_url,
+                import_poll_interval,
+                import_timeout,
+            )
+        )
+
+    # Only a load into the target moves the watermarks on
+    if delta_path and (sink_type == "http" or import_bulk):
+        watermarks.set(watermark_key, new_watermarks)
+
+    return {
+        "study_id": study_id,
+        "ingest_package": ingest_package,
+        "target_url": target_url,
+        "extra_target_urls": extra_target_urls,
+        "resources": progress.done,
+        "seconds": round(progress.elapsed(), 3),
+        "phases": progress.finished,
+    }
+
+
+class StudyLoader:
+    """
+    Load studies one after another or concurrently, reusing one warehouse
+    engine per study database and one FHIR client per target across loads,
+    and for the asyncio engine one AsyncSession per target, so that a
+    long-running process only connects once.
+
+    global_limiter, if given, caps the requests in flight of every load
+    together. Close the loader, or use it as a context manager, to close
+    the warehouse connections and HTTP sessions.
+    """
+
+    def __init__(self, db_maintenance_url=None, global_limiter=None):
+        self.db_maintenance_url = db_maintenance_url or KF_WAREHOUSE_DB_URL
+        self.global_limiter = global_limiter
+        self._engines = {}
+        self._clients = {}
+        self._async_sessions = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def options(self, study_id, **options):
+        """
+        Return the loader arguments of a study, with the given options by
+        their long names (e.g. target_url, max_workers) and the defaults of
+        python loader.py for the others.
+        """
+        args = parser.parse_args([study_id])
+        for name, value in options.items():
+            if not hasattr(args, name):
+                raise ValueError(f"unknown loader option {name}")
+            setattr(args, name, value)
+        return validate(args)
+
+    def engine(self, study_id):
+        with self._lock:
+            if study_id not in self._engines:
+                self._engines[study_id] = create_engine(
+                    self.db_maintenance_url, study_id
+                )
+            return self._engines[study_id]
+
+    def client(self, target_url):
+        with self._lock:
+            if target_url not in self._clients:
+                self._clients[target_url] = create_client(target_url)
+            return self._clients[target_url]
+
+    def async_session(self, target_url, max_connections):
+        """
+        Return the AsyncSession of a target, which opens at most the
+        max_connections of the load it's made for.
+        """
+        with self._lock:
+            if target_url not in self._async_sessions:
+                self._async_sessions[target_url] = AsyncSession(
+                    (FHIR_USER, FHIR_PASS), max_connections
+                )
+            return self._async_sessions[target_url]
+
+    def load(self, args, source=None, sink=None):
+        """
+        Load a study with loader arguments from options, or parsed from the
+        command line, and return a summary of the load. See load for source
+        and sink.
+        """
+        return load(
+            args,
+            self.global_limiter,
+            engine=(
+                None
+                if args.source_dir or source is not None
+                else self.engine(args.study_id)
+            ),
+            client_for=self.client,
+            source=source,
+            sink=sink,
+            async_session=(
+                self.async_session(args.target_url, args.max_in_flight)
+                if args.engine == "asyncio"
+                else None
+            ),
+        )
+
+    def close(self):
+        with self._lock:
+            for engine in self._engines.values():
+                engine.dispose()
+            self._engines.clear()
+            for async_session in self._async_sessions.values():
+                async_session.close()
+            self._async_sessions.clear()
 
-tables = {
-    "default": f'"{schema}".default',
-    "family_relationship": f'"{schema}".family_relationship',
-}
 
-# Instantiate FHIR API client
-client = FhirApiClient(base_url=target_url, auth=(FHIR_USER, FHIR_PASS))
-
-# Load resources
-with ThreadPoolExecutor(max_workers=10) as tpex:
-    # Practitioners
-    practitioners = {}
-    futures = []
-    for payload, name in yield_practitioners(engine, tables["default"]):
-        futures.append(tpex.submit(send_resource, payload))
-        practitioners[name] = payload
-    consume_futures(futures)
-
-    # Organizations
-    organizations = {}
-    futures = []
-    for payload, institution in yield_organizations(engine, tables["default"]):
-        futures.append(tpex.submit(send_resource, payload))
-        organizations[institution] = payload
-    consume_futures(futures)
-
-    # PractitionerRoles
-    practitioner_roles = {}
-    for payload, (institution, name) in yield_practitioner_roles(
-        engine, tables["default"], practitioners, organizations
-    ):
-        futures.append(tpex.submit(send_resource, payload))
-        practitioner_roles[(institution, name)] = payload
-    consume_futures(futures)
-
-    # KF DRC Patients
-    kfdrc_patients = {}
-    futures = []
-    for payload, kfdrc_patient_id in yield_kfdrc_patients(
-        engine, tables["default"], study_id
-    ):
-        # futures.append(tpex.submit(send_resource, payload))
-        kfdrc_patients[kfdrc_patient_id] = payload
-    # consume_futures(futures)
-
-    # KF DRC Groups
-    groups = {}
-    futures = []
-    for payload, family_id in yield_groups(
-        engine, tables["default"], study_id, kfdrc_patients
-    ):
-        futures.append(tpex.submit(send_resource, payload))
-        groups[family_id] = payload
-    consume_futures(futures)
-
-    # KF DRC ResearchStudies
-    for payload in yield_kfdrc_research_studies(
-        engine,
-        tables["default"],
-        study_id,
-        organizations,
-        practitioner_roles,
-        groups,
-    ):
-        futures.append(tpex.submit(send_resource, payload))
-    consume_futures(futures)
-
-    # KF DRC Patient relations
-    for payload, kfdrc_patient_id in yield_kfdrc_patient_relations(
-        engine, tables["family_relationship"], kfdrc_patients
-    ):
-        futures.append(tpex.submit(send_resource, payload))
-        kfdrc_patients[kfdrc_patient_id] = payload
-    consume_futures(futures)
-
-    # KF DRC Conditions
-    futures = []
-    for payload in yield_kfdrc_conditions(
-        engine, tables["default"], study_id, kfdrc_patients
-    ):
-        futures.append(tpex.submit(send_resource, payload))
-    consume_futures(futures)
-
-    # KF DRC phenotypes
-    futures = []
-    for payload in yield_kfdrc_phenotypes(
-        engine, tables["default"], study_id, kfdrc_patients
-    ):
-        futures.append(tpex.submit(send_resource, payload))
-    consume_futures(futures)
-
-    # KF DRC Specimens
-    kfdrc_specimens = {}
-    futures = []
-    for payload, kfdrc_specimen_id in yield_kfdrc_specimens(
-        engine, tables["default"], study_id, kfdrc_patients
-    ):
-        futures.append(tpex.submit(send_resource, payload))
-        kfdrc_specimens[kfdrc_specimen_id] = payload
-    consume_futures(futures)
+if __name__ == "__main__":
+    args = validate(parser.parse_args())
+    logging.basicConfig(level=args.log_level, format="%(message)s")
+    load(args)
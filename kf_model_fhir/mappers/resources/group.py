@@ -1,13 +1,22 @@
 """
 This module converts Kids First families to FHIR Groups.
 """
-import pandas as pd
-
 from kf_lib_data_ingest.common import constants
 from kf_lib_data_ingest.common.concept_schema import CONCEPT
-from common.utils import make_identifier, make_select, get
+from kf_model_fhir.mappers.common.utils import (
+    make_identifier,
+    make_select,
+    get,
+)
 
 RESOURCE_TYPE = "Group"
+COLUMNS = (
+    CONCEPT.FAMILY.ID,
+    CONCEPT.PARTICIPANT.SPECIES,
+    CONCEPT.PARTICIPANT.ID,
+)
+REQUIRED = (CONCEPT.FAMILY.ID, CONCEPT.PARTICIPANT.ID)
+GROUP_BY = (CONCEPT.FAMILY.ID,)
 
 
 group_type = {
@@ -16,23 +25,18 @@ group_type = {
 }
 
 
-def yield_groups(eng, table, study_id, kfdrc_patients):
-    df = pd.DataFrame(
-        [
-            dict(row)
-            for row in make_select(
-                eng,
-                table,
-                CONCEPT.FAMILY.ID,
-                CONCEPT.PARTICIPANT.SPECIES,
-                CONCEPT.PARTICIPANT.ID,
-            )
-        ]
-    )
-
-    for family_id, group in df.groupby(CONCEPT.FAMILY.ID):
-        if not family_id:
-            continue
+def yield_groups(eng, table, study_id, kfdrc_patients, where=None):
+    for row in make_select(
+        eng,
+        table,
+        *COLUMNS,
+        required=REQUIRED,
+        group_by=GROUP_BY,
+        where=where,
+    ):
+        family_id = get(row, CONCEPT.FAMILY.ID)
+        species = get(row, CONCEPT.PARTICIPANT.SPECIES) or [None]
+        participant_ids = get(row, CONCEPT.PARTICIPANT.ID)
 
         retval = {
             "resourceType": RESOURCE_TYPE,
@@ -47,25 +51,34 @@ def yield_groups(eng, table, study_id, kfdrc_patients):
                 }
             ],
             "actual": True,
-        }
-
-        for _, row in group.iterrows():
-            species = get(row, CONCEPT.PARTICIPANT.SPECIES)
-            participant_id = get(row, CONCEPT.PARTICIPANT.ID)
-
-            if not participant_id:
-                continue
-
-            retval["type"] = group_type.get(species) or "person"
-            retval.setdefault("member", []).append(
+            "type": group_type.get(species[-1]) or "person",
+            "member": [
                 {
                     "entity": {
-                        "reference": f'Patient/{kfdrc_patients[participant_id]["id"]}'
+                        "reference": f"Patient/{kfdrc_patients[participant_id]}"
                     }
                 }
-            )
-
-        if not isinstance(retval.get("member"), list):
-            continue
+                for participant_id in participant_ids
+            ],
+        }
 
         yield retval, family_id
+
+
+def yield_group_ids(eng, table, study_id):
+    """
+    Yield the id and family ID of every Group without reading its members.
+    """
+    family_ids = set()
+    for row in make_select(
+        eng,
+        table,
+        CONCEPT.FAMILY.ID,
+        CONCEPT.PARTICIPANT.ID,
+        required=(CONCEPT.FAMILY.ID, CONCEPT.PARTICIPANT.ID),
+    ):
+        family_id = get(row, CONCEPT.FAMILY.ID)
+        if family_id in family_ids:
+            continue
+        family_ids.add(family_id)
+        yield make_identifier(RESOURCE_TYPE, study_id, family_id), family_id
@@ -3,21 +3,31 @@ This module converts Kids First diagnoses to FHIR kfdrc-condition
 (derived from FHIR Condition).
 """
 from kf_lib_data_ingest.common.concept_schema import CONCEPT
-from common.utils import make_identifier, make_select, get
+from kf_model_fhir.mappers.common.utils import (
+    make_identifier,
+    make_select,
+    get,
+)
 
 RESOURCE_TYPE = "Condition"
+COLUMNS = (
+    CONCEPT.PARTICIPANT.ID,
+    CONCEPT.DIAGNOSIS.NAME,
+    CONCEPT.DIAGNOSIS.EVENT_AGE_DAYS,
+    CONCEPT.DIAGNOSIS.MONDO_ID,
+    CONCEPT.DIAGNOSIS.NCIT_ID,
+    CONCEPT.DIAGNOSIS.ICD_ID,
+)
+REQUIRED = (CONCEPT.PARTICIPANT.ID, CONCEPT.DIAGNOSIS.NAME)
 
 
-def yield_kfdrc_conditions(eng, table, study_id, kfdrc_patients):
+def yield_kfdrc_conditions(eng, table, study_id, kfdrc_patients, where=None):
     for row in make_select(
         eng,
         table,
-        CONCEPT.PARTICIPANT.ID,
-        CONCEPT.DIAGNOSIS.NAME,
-        CONCEPT.DIAGNOSIS.EVENT_AGE_DAYS,
-        CONCEPT.DIAGNOSIS.MONDO_ID,
-        CONCEPT.DIAGNOSIS.NCIT_ID,
-        CONCEPT.DIAGNOSIS.ICD_ID,
+        *COLUMNS,
+        required=REQUIRED,
+        where=where,
     ):
         participant_id = get(row, CONCEPT.PARTICIPANT.ID)
         name = get(row, CONCEPT.DIAGNOSIS.NAME)
@@ -26,9 +36,6 @@ def yield_kfdrc_conditions(eng, table, study_id, kfdrc_patients):
         ncit = get(row, CONCEPT.DIAGNOSIS.NCIT_ID)
         icd = get(row, CONCEPT.DIAGNOSIS.ICD_ID)
 
-        if not all((participant_id, name)):
-            continue
-
         retval = {
             "resourceType": RESOURCE_TYPE,
             "id": make_identifier(
@@ -52,7 +59,7 @@ def yield_kfdrc_conditions(eng, table, study_id, kfdrc_patients):
             ],
             "code": {"text": name},
             "subject": {
-                "reference": f'Patient/{kfdrc_patients[participant_id]["id"]}'
+                "reference": f"Patient/{kfdrc_patients[participant_id]}"
             },
         }
 
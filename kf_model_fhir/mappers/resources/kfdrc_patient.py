@@ -4,9 +4,21 @@ This module converts Kids First participants to FHIR kfdrc-patient
 """
 from kf_lib_data_ingest.common import constants
 from kf_lib_data_ingest.common.concept_schema import CONCEPT
-from common.utils import make_identifier, make_select, get
+from kf_model_fhir.mappers.common.utils import (
+    make_identifier,
+    make_select,
+    get,
+)
 
 RESOURCE_TYPE = "Patient"
+COLUMNS = (
+    CONCEPT.PARTICIPANT.ID,
+    CONCEPT.PARTICIPANT.ETHNICITY,
+    CONCEPT.PARTICIPANT.RACE,
+    CONCEPT.PARTICIPANT.SPECIES,
+    CONCEPT.PARTICIPANT.GENDER,
+)
+REQUIRED = (CONCEPT.PARTICIPANT.ID,)
 
 
 # https://hl7.org/fhir/us/core/ValueSet-omb-ethnicity-category.html
@@ -111,15 +123,9 @@ administrative_gender = {
 }
 
 
-def yield_kfdrc_patients(eng, table, study_id):
+def yield_kfdrc_patients(eng, table, study_id, where=None):
     for row in make_select(
-        eng,
-        table,
-        CONCEPT.PARTICIPANT.ID,
-        CONCEPT.PARTICIPANT.ETHNICITY,
-        CONCEPT.PARTICIPANT.RACE,
-        CONCEPT.PARTICIPANT.SPECIES,
-        CONCEPT.PARTICIPANT.GENDER,
+        eng, table, *COLUMNS, required=REQUIRED, where=where
     ):
         participant_id = get(row, CONCEPT.PARTICIPANT.ID)
         ethnicity = get(row, CONCEPT.PARTICIPANT.ETHNICITY)
@@ -127,9 +133,6 @@ def yield_kfdrc_patients(eng, table, study_id):
         species = get(row, CONCEPT.PARTICIPANT.SPECIES)
         gender = get(row, CONCEPT.PARTICIPANT.GENDER)
 
-        if not participant_id:
-            continue
-
         retval = {
             "resourceType": RESOURCE_TYPE,
             "id": make_identifier(RESOURCE_TYPE, study_id, participant_id),
@@ -1,13 +1,19 @@
 """
 This module converts Kids First family relationships to FHIR kfdrc-patient relations.
 """
-import pandas as pd
-
 from kf_lib_data_ingest.common import constants
 from kf_lib_data_ingest.common.concept_schema import CONCEPT
-from common.utils import make_select, get
+from kf_model_fhir.mappers.common.utils import make_select, get
+from kf_model_fhir.mappers.resources.kfdrc_patient import yield_kfdrc_patients
 
 RESOURCE_TYPE = "Patient"
+COLUMNS = (
+    CONCEPT.FAMILY_RELATIONSHIP.PERSON1.ID,
+    CONCEPT.FAMILY_RELATIONSHIP.PERSON2.ID,
+    CONCEPT.FAMILY_RELATIONSHIP.RELATION_FROM_1_TO_2,
+)
+REQUIRED = (CONCEPT.FAMILY_RELATIONSHIP.PERSON2.ID,)
+GROUP_BY = (CONCEPT.FAMILY_RELATIONSHIP.PERSON2.ID,)
 
 
 # https://www.hl7.org/fhir/v3/FamilyMember/vs.html
@@ -54,31 +60,42 @@ relation_dict = {
 }
 
 
-def yield_kfdrc_patient_relations(eng, table, kfdrc_patients):
-    df = pd.DataFrame(
-        [
-            dict(row)
-            for row in make_select(
-                eng,
-                table,
-                CONCEPT.FAMILY_RELATIONSHIP.PERSON1.ID,
-                CONCEPT.FAMILY_RELATIONSHIP.PERSON2.ID,
-                CONCEPT.FAMILY_RELATIONSHIP.RELATION_FROM_1_TO_2,
-            )
-        ]
-    )
+def yield_kfdrc_patient_relations(
+    eng,
+    table,
+    patients_table,
+    study_id,
+    kfdrc_patients,
+    where=None,
+    patients_where=None,
+):
+    relations = {
+        get(row, CONCEPT.FAMILY_RELATIONSHIP.PERSON2.ID): row
+        for row in make_select(
+            eng,
+            table,
+            *COLUMNS,
+            required=REQUIRED,
+            group_by=GROUP_BY,
+            where=where,
+        )
+    }
 
-    for person2_id, group in df.groupby(CONCEPT.FAMILY_RELATIONSHIP.PERSON2.ID):
-        retval = kfdrc_patients.get(person2_id)
-        if not retval:
+    # Only the reference index of patients is kept by the loader, so every
+    # patient is built here, and extended with the relations that pass the
+    # where filter. patients_where filters the patients that are built.
+    for retval, person2_id in yield_kfdrc_patients(
+        eng, patients_table, study_id, patients_where
+    ):
+        row = relations.get(person2_id)
+        if row is None:
+            yield retval, person2_id
             continue
 
-        for _, row in group.iterrows():
-            person1_id = get(row, CONCEPT.FAMILY_RELATIONSHIP.PERSON1.ID)
-            relation = get(
-                row, CONCEPT.FAMILY_RELATIONSHIP.RELATION_FROM_1_TO_2
-            )
-
+        for person1_id, relation in zip(
+            get(row, CONCEPT.FAMILY_RELATIONSHIP.PERSON1.ID),
+            get(row, CONCEPT.FAMILY_RELATIONSHIP.RELATION_FROM_1_TO_2),
+        ):
             retval.setdefault("extension", []).append(
                 {
                     "url": "http://fhir.kids-first.io/StructureDefinition/relation",
@@ -86,7 +103,7 @@ def yield_kfdrc_patient_relations(eng, table, kfdrc_patients):
                         {
                             "url": "subject",
                             "valueReference": {
-                                "reference": f'{RESOURCE_TYPE}/{kfdrc_patients[person1_id]["id"]}'
+                                "reference": f"{RESOURCE_TYPE}/{kfdrc_patients[person1_id]}"
                             },
                         },
                         relation_dict[relation],
@@ -4,9 +4,25 @@ This module converts Kids First phenotypes to FHIR kfdrc-phenotype
 """
 from kf_lib_data_ingest.common import constants
 from kf_lib_data_ingest.common.concept_schema import CONCEPT
-from common.utils import make_identifier, make_select, get
+from kf_model_fhir.mappers.common.utils import (
+    make_identifier,
+    make_select,
+    get,
+)
 
 RESOURCE_TYPE = "Observation"
+COLUMNS = (
+    CONCEPT.PARTICIPANT.ID,
+    CONCEPT.PHENOTYPE.NAME,
+    CONCEPT.PHENOTYPE.HPO_ID,
+    CONCEPT.PHENOTYPE.EVENT_AGE_DAYS,
+    CONCEPT.PHENOTYPE.OBSERVED,
+)
+REQUIRED = (
+    CONCEPT.PARTICIPANT.ID,
+    CONCEPT.PHENOTYPE.NAME,
+    CONCEPT.PHENOTYPE.HPO_ID,
+)
 
 
 # https://www.hl7.org/fhir/valueset-observation-interpretation.html
@@ -24,15 +40,13 @@ interpretation = {
 }
 
 
-def yield_kfdrc_phenotypes(eng, table, study_id, kfdrc_patients):
+def yield_kfdrc_phenotypes(eng, table, study_id, kfdrc_patients, where=None):
     for row in make_select(
         eng,
         table,
-        CONCEPT.PARTICIPANT.ID,
-        CONCEPT.PHENOTYPE.NAME,
-        CONCEPT.PHENOTYPE.HPO_ID,
-        CONCEPT.PHENOTYPE.EVENT_AGE_DAYS,
-        CONCEPT.PHENOTYPE.OBSERVED,
+        *COLUMNS,
+        required=REQUIRED,
+        where=where,
     ):
         participant_id = get(row, CONCEPT.PARTICIPANT.ID)
         name = get(row, CONCEPT.PHENOTYPE.NAME)
@@ -40,9 +54,7 @@ def yield_kfdrc_phenotypes(eng, table, study_id, kfdrc_patients):
         event_age_days = get(row, CONCEPT.PHENOTYPE.EVENT_AGE_DAYS)
         observed = get(row, CONCEPT.PHENOTYPE.OBSERVED)
 
-        if not all((participant_id, name, hpo)) or not interpretation.get(
-            observed
-        ):
+        if not interpretation.get(observed):
             continue
 
         retval = {
@@ -63,7 +75,7 @@ def yield_kfdrc_phenotypes(eng, table, study_id, kfdrc_patients):
             "status": "preliminary",
             "code": {"coding": [{"code": hpo}], "text": name},
             "subject": {
-                "reference": f'Patient/{kfdrc_patients[participant_id]["id"]}'
+                "reference": f"Patient/{kfdrc_patients[participant_id]}"
             },
             "interpretation": [
                 {"coding": [interpretation[observed]], "text": observed}
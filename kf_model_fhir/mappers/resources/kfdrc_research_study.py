@@ -3,9 +3,28 @@ This module converts Kids First studies to FHIR kfdrc-research-study
 (derived from FHIR ResearchStudy).
 """
 from kf_lib_data_ingest.common.concept_schema import CONCEPT
-from common.utils import make_identifier, make_select, get
+from kf_model_fhir.mappers.common.utils import (
+    make_identifier,
+    make_select,
+    get,
+)
 
 RESOURCE_TYPE = "ResearchStudy"
+COLUMNS = (
+    CONCEPT.STUDY.ID,
+    CONCEPT.INVESTIGATOR.INSTITUTION,
+    CONCEPT.INVESTIGATOR.NAME,
+    CONCEPT.STUDY.ATTRIBUTION,
+    CONCEPT.STUDY.SHORT_NAME,
+    CONCEPT.STUDY.AUTHORITY,
+    CONCEPT.STUDY.NAME,
+)
+REQUIRED = (
+    CONCEPT.STUDY.ID,
+    CONCEPT.INVESTIGATOR.INSTITUTION,
+    CONCEPT.INVESTIGATOR.NAME,
+    CONCEPT.STUDY.NAME,
+)
 
 
 def yield_kfdrc_research_studies(
@@ -14,13 +33,8 @@ def yield_kfdrc_research_studies(
     for row in make_select(
         eng,
         table,
-        CONCEPT.STUDY.ID,
-        CONCEPT.INVESTIGATOR.INSTITUTION,
-        CONCEPT.INVESTIGATOR.NAME,
-        CONCEPT.STUDY.ATTRIBUTION,
-        CONCEPT.STUDY.SHORT_NAME,
-        CONCEPT.STUDY.AUTHORITY,
-        CONCEPT.STUDY.NAME,
+        *COLUMNS,
+        required=REQUIRED,
     ):
         study_id = get(row, CONCEPT.STUDY.ID)
         institution = get(row, CONCEPT.INVESTIGATOR.INSTITUTION)
@@ -29,9 +43,6 @@ def yield_kfdrc_research_studies(
         attribution = get(row, CONCEPT.STUDY.ATTRIBUTION)
         short_name = get(row, CONCEPT.STUDY.SHORT_NAME)
 
-        if not all((study_id, institution, investigator_name, study_name)):
-            continue
-
         retval = {
             "resourceType": RESOURCE_TYPE,
             "id": make_identifier(RESOURCE_TYPE, study_id),
@@ -57,7 +68,7 @@ def yield_kfdrc_research_studies(
                         {
                             "url": "organization",
                             "valueReference": {
-                                "reference": f'Organization/{organizations[institution]["id"]}'
+                                "reference": f"Organization/{organizations[institution]}"
                             },
                         }
                     ],
@@ -66,7 +77,7 @@ def yield_kfdrc_research_studies(
             "title": study_name,
             "status": "completed",
             "principalInvestigator": {
-                "reference": f'PractitionerRole/{practitioner_roles[(institution, investigator_name)]["id"]}'
+                "reference": f"PractitionerRole/{practitioner_roles[(institution, investigator_name)]}"
             },
         }
 
@@ -81,10 +92,11 @@ def yield_kfdrc_research_studies(
                 }
             )
 
+        # Sorted, since the Groups are indexed in the order they were built
         if groups:
             retval["enrollment"] = [
-                {"reference": f'Group/{group["id"]}'}
-                for group in groups.values()
+                {"reference": f"Group/{group_id}"}
+                for group_id in sorted(groups.values())
             ]
 
         yield retval
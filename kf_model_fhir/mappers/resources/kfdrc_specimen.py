@@ -4,9 +4,22 @@ This module converts Kids First biospecimens to FHIR kfdrc-specimen
 """
 from kf_lib_data_ingest.common import constants
 from kf_lib_data_ingest.common.concept_schema import CONCEPT
-from common.utils import make_identifier, make_select, get
+from kf_model_fhir.mappers.common.utils import (
+    make_identifier,
+    make_select,
+    get,
+)
 
 RESOURCE_TYPE = "Specimen"
+COLUMNS = (
+    CONCEPT.PARTICIPANT.ID,
+    CONCEPT.BIOSPECIMEN.ID,
+    CONCEPT.BIOSPECIMEN.EVENT_AGE_DAYS,
+    CONCEPT.BIOSPECIMEN.CONCENTRATION_MG_PER_ML,
+    CONCEPT.BIOSPECIMEN.COMPOSITION,
+    CONCEPT.BIOSPECIMEN.VOLUME_UL,
+)
+REQUIRED = (CONCEPT.PARTICIPANT.ID, CONCEPT.BIOSPECIMEN.ID)
 
 
 # https://www.hl7.org/fhir/v2/0487/index.html
@@ -29,16 +42,13 @@ specimen_type = {
 }
 
 
-def yield_kfdrc_specimens(eng, table, study_id, kfdrc_patients):
+def yield_kfdrc_specimens(eng, table, study_id, kfdrc_patients, where=None):
     for row in make_select(
         eng,
         table,
-        CONCEPT.PARTICIPANT.ID,
-        CONCEPT.BIOSPECIMEN.ID,
-        CONCEPT.BIOSPECIMEN.EVENT_AGE_DAYS,
-        CONCEPT.BIOSPECIMEN.CONCENTRATION_MG_PER_ML,
-        CONCEPT.BIOSPECIMEN.COMPOSITION,
-        CONCEPT.BIOSPECIMEN.VOLUME_UL,
+        *COLUMNS,
+        required=REQUIRED,
+        where=where,
     ):
         participant_id = get(row, CONCEPT.PARTICIPANT.ID)
         biospecimen_id = get(row, CONCEPT.BIOSPECIMEN.ID)
@@ -49,9 +59,6 @@ def yield_kfdrc_specimens(eng, table, study_id, kfdrc_patients):
         composition = get(row, CONCEPT.BIOSPECIMEN.COMPOSITION)
         volume_ul = get(row, CONCEPT.BIOSPECIMEN.VOLUME_UL)
 
-        if not all((participant_id, biospecimen_id)):
-            continue
-
         retval = {
             "resourceType": RESOURCE_TYPE,
             "id": make_identifier(RESOURCE_TYPE, study_id, biospecimen_id),
@@ -67,7 +74,7 @@ def yield_kfdrc_specimens(eng, table, study_id, kfdrc_patients):
                 }
             ],
             "subject": {
-                "reference": f'Patient/{kfdrc_patients[participant_id]["id"]}'
+                "reference": f"Patient/{kfdrc_patients[participant_id]}"
             },
         }
 
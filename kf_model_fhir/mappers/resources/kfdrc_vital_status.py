@@ -5,9 +5,19 @@ This module converts Kids First Outcomes to FHIR kfdrc-vital-status
 
 from kf_lib_data_ingest.common import constants
 from kf_lib_data_ingest.common.concept_schema import CONCEPT
-from common.utils import make_identifier, make_select, get
+from kf_model_fhir.mappers.common.utils import (
+    make_identifier,
+    make_select,
+    get,
+)
 
 RESOURCE_TYPE = "Observation"
+COLUMNS = (
+    CONCEPT.PARTICIPANT.ID,
+    CONCEPT.OUTCOME.EVENT_AGE_DAYS,
+    CONCEPT.OUTCOME.VITAL_STATUS,
+)
+REQUIRED = (CONCEPT.PARTICIPANT.ID,)
 
 clinical_status = {
     constants.OUTCOME.VITAL_STATUS.ALIVE: {
@@ -28,20 +38,18 @@ clinical_status = {
 }
 
 
-def yield_kfdrc_vital_statuses(eng, table, study_id, kfdrc_patients):
+def yield_kfdrc_vital_statuses(
+    eng, table, study_id, kfdrc_patients, where=None
+):
     for row in make_select(
-        eng,
-        table,
-        CONCEPT.PARTICIPANT.ID,
-        CONCEPT.OUTCOME.EVENT_AGE_DAYS,
-        CONCEPT.OUTCOME.VITAL_STATUS,
+        eng, table, *COLUMNS, required=REQUIRED, where=where
     ):
         participant_id = get(row, CONCEPT.PARTICIPANT.ID)
         event_age_days = get(row, CONCEPT.OUTCOME.EVENT_AGE_DAYS)
         vital_status = get(row, CONCEPT.OUTCOME.VITAL_STATUS)
         status = clinical_status.get(vital_status)
 
-        if not participant_id or not status:
+        if not status:
             continue
 
         retval = {
@@ -66,7 +74,7 @@ def yield_kfdrc_vital_statuses(eng, table, study_id, kfdrc_patients):
                 "text": "Clinical status",
             },
             "subject": {
-                "reference": f'Patient/{kfdrc_patients[participant_id]["id"]}'
+                "reference": f"Patient/{kfdrc_patients[participant_id]}"
             },
             "valueCodeableConcept": {"coding": [status], "text": vital_status},
         }
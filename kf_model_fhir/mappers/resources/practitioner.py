@@ -2,18 +2,21 @@
 This module converts Kids First investigators to FHIR Practitioners.
 """
 from kf_lib_data_ingest.common.concept_schema import CONCEPT
-from common.utils import make_identifier, make_select, get
+from kf_model_fhir.mappers.common.utils import (
+    make_identifier,
+    make_select,
+    get,
+)
 
 RESOURCE_TYPE = "Practitioner"
+COLUMNS = (CONCEPT.INVESTIGATOR.NAME,)
+REQUIRED = (CONCEPT.INVESTIGATOR.NAME,)
 
 
 def yield_practitioners(eng, table):
-    for row in make_select(eng, table, CONCEPT.INVESTIGATOR.NAME):
+    for row in make_select(eng, table, *COLUMNS, required=REQUIRED):
         name = get(row, CONCEPT.INVESTIGATOR.NAME)
 
-        if not name:
-            continue
-
         retval = {
             "resourceType": RESOURCE_TYPE,
             "id": make_identifier(RESOURCE_TYPE, name),
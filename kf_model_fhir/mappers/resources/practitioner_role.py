@@ -2,26 +2,32 @@
 This module converts Kids First investigators to FHIR PractitionerRoles.
 """
 from kf_lib_data_ingest.common.concept_schema import CONCEPT
-from common.utils import make_identifier, make_select, get
+from kf_model_fhir.mappers.common.utils import (
+    make_identifier,
+    make_select,
+    get,
+)
 
 RESOURCE_TYPE = "PractitionerRole"
+COLUMNS = (
+    CONCEPT.INVESTIGATOR.ID,
+    CONCEPT.INVESTIGATOR.INSTITUTION,
+    CONCEPT.INVESTIGATOR.NAME,
+)
+REQUIRED = (CONCEPT.INVESTIGATOR.INSTITUTION, CONCEPT.INVESTIGATOR.NAME)
 
 
 def yield_practitioner_roles(eng, table, practitioners, organizations):
     for row in make_select(
         eng,
         table,
-        CONCEPT.INVESTIGATOR.ID,
-        CONCEPT.INVESTIGATOR.INSTITUTION,
-        CONCEPT.INVESTIGATOR.NAME,
+        *COLUMNS,
+        required=REQUIRED,
     ):
         investigator_id = get(row, CONCEPT.INVESTIGATOR.ID)
         institution = get(row, CONCEPT.INVESTIGATOR.INSTITUTION)
         name = get(row, CONCEPT.INVESTIGATOR.NAME)
 
-        if not all((institution, name)):
-            continue
-
         retval = {
             "resourceType": RESOURCE_TYPE,
             "id": make_identifier(RESOURCE_TYPE, institution, name),
@@ -31,10 +37,10 @@ def yield_practitioner_roles(eng, table, practitioners, organizations):
                 ]
             },
             "practitioner": {
-                "reference": f'Practitioner/{practitioners[name]["id"]}'
+                "reference": f"Practitioner/{practitioners[name]}"
             },
             "organization": {
-                "reference": f'Organization/{organizations[institution]["id"]}'
+                "reference": f"Organization/{organizations[institution]}"
             },
             "code": [
                 {
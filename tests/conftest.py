@@ -1,12 +1,19 @@
+import asyncio
 import logging
 import os
+import threading
+import time
 
 import pytest
+from aiohttp import web
 from ncpi_fhir_utility.client import FhirApiClient
 
+from kf_lib_data_ingest.common import constants
+from kf_lib_data_ingest.common.concept_schema import CONCEPT
 from kf_lib_data_ingest.common.io import read_df
 from kf_lib_data_ingest.etl.load.load import LoadStage
 from kf_model_fhir.ingest_plugin import kids_first_fhir
+from kf_model_fhir.mappers.common.sources import Source, shape
 
 ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
 RESOURCE_DIR = os.path.join("site_root", "input", "resources")
@@ -63,3 +70,228 @@ def load_fhir_resources(client):
             ),
         }
     )
+
+
+class StandInSource(Source):
+    """
+    Tables of rows in memory, given as {table: (columns, rows)}, for the
+    tests of the loader and of the sources that wrap a source.
+
+    Selects since a watermark keep the rows whose value in the watermark
+    column is greater. Scans and selects are counted, and the columns of
+    every scan are kept in scanned.
+    """
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.scans = 0
+        self.scanned = []
+        self.selects = 0
+
+    def columns(self, table):
+        return self.tables[table][0]
+
+    def scan(self, table, columns):
+        self.scans += 1
+        self.scanned.append(tuple(columns))
+        existing, rows = self.tables[table]
+        index = [existing.index(c) for c in columns]
+        for values in rows:
+            yield tuple(values[i] for i in index)
+
+    def watermark(self, table, column):
+        existing, rows = self.tables[table]
+        return max(values[existing.index(column)] for values in rows)
+
+    def select(
+        self, table, columns, required=(), group_by=(), where=None, since=None
+    ):
+        self.selects += 1
+        if since is None:
+            yield from super().select(
+                table, columns, required, group_by, where
+            )
+            return
+        cols = self.available(table, columns, required, group_by, where)
+        if cols is None:
+            return
+        column, value = since
+        existing, rows = self.tables[table]
+        index = [existing.index(c) for c in cols]
+        changed = dict.fromkeys(
+            tuple(values[i] for i in index)
+            for values in rows
+            if values[existing.index(column)] > value
+        )
+        yield from shape(cols, changed, required, group_by, where)
+
+
+def stand_in_study(tables, participants=6, relations=None):
+    """
+    Return a StandInSource of a study with the given number of
+    participants, two per family, each with a Condition, a Phenotype and a
+    Specimen. tables maps "default" and "family_relationship" to the table
+    names that the loader reads. relations are (person1, person2) pairs of
+    participant numbers, by default the first of each family is the mother
+    of the second.
+    """
+    columns = [
+        CONCEPT.INVESTIGATOR.NAME,
+        CONCEPT.INVESTIGATOR.INSTITUTION,
+        CONCEPT.STUDY.ID,
+        CONCEPT.STUDY.NAME,
+        CONCEPT.STUDY.SHORT_NAME,
+        CONCEPT.STUDY.ATTRIBUTION,
+        CONCEPT.STUDY.AUTHORITY,
+        CONCEPT.FAMILY.ID,
+        CONCEPT.PARTICIPANT.ID,
+        CONCEPT.PARTICIPANT.SPECIES,
+        CONCEPT.PARTICIPANT.GENDER,
+        CONCEPT.PARTICIPANT.RACE,
+        CONCEPT.PARTICIPANT.ETHNICITY,
+        CONCEPT.DIAGNOSIS.NAME,
+        CONCEPT.DIAGNOSIS.MONDO_ID,
+        CONCEPT.DIAGNOSIS.EVENT_AGE_DAYS,
+        CONCEPT.PHENOTYPE.NAME,
+        CONCEPT.PHENOTYPE.HPO_ID,
+        CONCEPT.PHENOTYPE.OBSERVED,
+        CONCEPT.PHENOTYPE.EVENT_AGE_DAYS,
+        CONCEPT.BIOSPECIMEN.ID,
+        CONCEPT.BIOSPECIMEN.COMPOSITION,
+        CONCEPT.BIOSPECIMEN.EVENT_AGE_DAYS,
+    ]
+    rows = [
+        (
+            "Jane Smith",
+            "CHOP",
+            "SD_X",
+            "Study X",
+            "X",
+            "https://example.org/SD_X",
+            "dbGaP",
+            f"F{i // 2}",
+            f"P{i}",
+            constants.SPECIES.HUMAN,
+            constants.GENDER.FEMALE,
+            constants.RACE.WHITE,
+            constants.ETHNICITY.NON_HISPANIC,
+            f"Diagnosis {i}",
+            "MONDO:0005015",
+            "100",
+            f"Phenotype {i}",
+            "HP:0001631",
+            constants.PHENOTYPE.OBSERVED.YES,
+            "10",
+            f"B{i}",
+            constants.SPECIMEN.COMPOSITION.BLOOD,
+            "5",
+        )
+        for i in range(participants)
+    ]
+    if relations is None:
+        relations = [(i, i + 1) for i in range(0, participants - 1, 2)]
+    return StandInSource(
+        {
+            tables["default"]: (columns, rows),
+            tables["family_relationship"]: (
+                [
+                    CONCEPT.FAMILY_RELATIONSHIP.PERSON1.ID,
+                    CONCEPT.FAMILY_RELATIONSHIP.PERSON2.ID,
+                    CONCEPT.FAMILY_RELATIONSHIP.RELATION_FROM_1_TO_2,
+                ],
+                [
+                    (f"P{a}", f"P{b}", constants.RELATIONSHIP.MOTHER)
+                    for a, b in relations
+                ],
+            ),
+        }
+    )
+
+
+class StandInSink:
+    """
+    A sink that records the resources it sends, and their Type/ids in sent.
+    Resources whose Type/id is in fail are rejected, and resources of a
+    resource type in hold are only sent once one was rejected.
+    """
+
+    def __init__(self, fail=(), hold=()):
+        self.fail = set(fail)
+        self.hold = set(hold)
+        self.sent = []
+        self.payloads = []
+        self.rejected = threading.Event()
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def send(self, payload, data=None):
+        key = f'{payload["resourceType"]}/{payload["id"]}'
+        if key in self.fail:
+            self.rejected.set()
+            return [(False, {"status_code": 400}, payload)]
+        if payload["resourceType"] in self.hold:
+            assert self.rejected.wait(5)
+            # Let the loader see the rejection first
+            time.sleep(0.2)
+        with self._lock:
+            self.sent.append(key)
+            self.payloads.append(payload)
+        return [(True, {"status_code": 201}, payload)]
+
+    def send_bundle(self, bundle, data=None):
+        results = []
+        for entry in bundle["entry"]:
+            results.extend(self.send(entry["resource"]))
+        return results
+
+    def close(self):
+        self.closed = True
+
+
+class StandInServer:
+    """
+    A FHIR server that accepts every PUT, slowly, and records the most
+    requests it had in flight at once and the connections they came from
+    """
+
+    def __init__(self):
+        self.in_flight = 0
+        self.peak = 0
+        self.received = []
+        self.connections = set()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever)
+
+    async def put(self, request):
+        self.connections.add(request.transport.get_extra_info("peername"))
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        body = await request.json()
+        self.received.append(body["id"])
+        return web.json_response(body, status=201)
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_put("/{resource_type}/{id}", self.put)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}"
+
+    def __enter__(self):
+        self._thread.start()
+        return asyncio.run_coroutine_threadsafe(
+            self._start(), self._loop
+        ).result()
+
+    def __exit__(self, *exc):
+        asyncio.run_coroutine_threadsafe(
+            self._runner.cleanup(), self._loop
+        ).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
@@ -0,0 +1,54 @@
+import threading
+
+from conftest import StandInServer
+
+from kf_model_fhir.common.retry import (
+    AsyncConcurrencyLimiter,
+    FixedLimit,
+    RetryPolicy,
+)
+from kf_model_fhir.mappers.common.async_engine import AsyncSender
+
+
+def patients(phase, count):
+    for i in range(count):
+        yield {"resourceType": "Patient", "id": f"{phase}-{i}"}
+
+
+def test_send_all_phases_share_the_cap():
+    server = StandInServer()
+    results = []
+    with server as base_url:
+        sender = AsyncSender(
+            base_url,
+            (None, None),
+            {},
+            3,
+            RetryPolicy(0),
+            AsyncConcurrencyLimiter(FixedLimit(100)),
+        )
+        # Two phases send at once from their own threads
+        phases = [
+            threading.Thread(
+                target=sender.send_all,
+                args=(
+                    patients(phase, 30),
+                    sender.put_resource,
+                    results.extend,
+                ),
+            )
+            for phase in ("a", "b")
+        ]
+        for phase in phases:
+            phase.start()
+        for phase in phases:
+            phase.join()
+        sender.close()
+
+    assert server.peak == 3
+    assert len(results) == 60
+    assert all(success for success, _, _ in results)
+    assert {payload["id"] for _, _, payload in results} == set(
+        server.received
+    )
+    assert len(set(server.received)) == 60
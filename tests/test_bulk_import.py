@@ -0,0 +1,173 @@
+import json
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from kf_model_fhir.common.bulk_import import BulkImportError, bulk_import
+from kf_model_fhir.common.ndjson import NdjsonWriter
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    A FHIR server stand-in that accepts $import, answers status polls with
+    202 a few times and then with a manifest or a failure
+    """
+
+    def __init__(self, polls=2, status=200):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.polls = polls
+        self.status = status
+        self.requests = []
+        self.parameters = None
+        self.fetched = {}
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=None, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        self.server.requests.append(("POST", self.path))
+        length = int(self.headers["Content-Length"])
+        self.server.parameters = json.loads(self.rfile.read(length))
+        assert self.headers["Prefer"] == "respond-async"
+        self.reply(202, headers={"Content-Location": "/import-status/1"})
+
+    def do_GET(self):
+        self.server.requests.append(("GET", self.path))
+        server = self.server
+        if server.polls:
+            server.polls -= 1
+            self.reply(202, headers={"Retry-After": "0", "X-Progress": "50%"})
+            return
+        if server.status != 200:
+            self.reply(server.status, {"resourceType": "OperationOutcome"})
+            return
+
+        # Fetch the inputs like a server would before completing the job
+        inputs = [
+            {
+                part["name"]: part.get("valueUri") or part.get("valueCode")
+                for part in p["part"]
+            }
+            for p in server.parameters["parameter"]
+            if p["name"] == "input"
+        ]
+        output = []
+        for i in inputs:
+            lines = requests.get(i["url"]).text.splitlines()
+            server.fetched[i["url"]] = lines
+            output.append(
+                {"type": i["type"], "inputUrl": i["url"], "count": len(lines)}
+            )
+        self.reply(
+            200,
+            {
+                "transactionTime": "2020-01-01T00:00:00Z",
+                "request": f"{server.url}/$import",
+                "output": output,
+                "error": [
+                    {
+                        "type": "OperationOutcome",
+                        "url": f"{server.url}/errors/1.ndjson",
+                    }
+                ],
+            },
+        )
+
+
+@pytest.fixture
+def file_server():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    return {"port": port, "file_server_url": f"http://127.0.0.1:{port}"}
+
+
+@pytest.fixture
+def ndjson_dir(tmp_path):
+    writer = NdjsonWriter(str(tmp_path), shard_size=2)
+    for i in range(3):
+        writer.write({"resourceType": "Patient", "id": f"p{i}"})
+    writer.write({"resourceType": "Condition", "id": "c0"})
+    writer.write({"resourceType": "Patient", "id": "p0"}, "patches")
+    writer.close()
+    return str(tmp_path)
+
+
+def start(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_bulk_import(ndjson_dir, file_server):
+    server = start(StandInServer(polls=2))
+    try:
+        summary = bulk_import(
+            ndjson_dir, server.url, interval=0, progress=None, **file_server
+        )
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert [method for method, _ in server.requests] == [
+        "POST",
+        "GET",
+        "GET",
+        "GET",
+    ]
+    assert server.requests[0][1] == "/$import"
+    assert {u.rsplit("/", 1)[1] for u in server.fetched} == {
+        "Condition.0.ndjson",
+        "Patient.0.ndjson",
+        "Patient.1.ndjson",
+    }
+    assert sorted(len(lines) for lines in server.fetched.values()) == [1, 1, 2]
+    assert summary["Patient"] == {"count": 3, "errors": []}
+    assert summary["Condition"] == {"count": 1, "errors": []}
+    assert len(summary["OperationOutcome"]["errors"]) == 1
+
+
+def test_bulk_import_failure(ndjson_dir, file_server):
+    server = start(StandInServer(polls=1, status=500))
+    try:
+        with pytest.raises(BulkImportError, match="500"):
+            bulk_import(
+                ndjson_dir, server.url, interval=0, progress=None, **file_server
+            )
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_bulk_import_timeout(ndjson_dir, file_server):
+    server = start(StandInServer(polls=100))
+    try:
+        with pytest.raises(BulkImportError, match="within"):
+            bulk_import(
+                ndjson_dir,
+                server.url,
+                interval=0,
+                timeout=0,
+                progress=None,
+                **file_server,
+            )
+    finally:
+        server.shutdown()
+        server.server_close()
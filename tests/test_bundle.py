@@ -0,0 +1,103 @@
+from kf_model_fhir.mappers.common.bundle import (
+    bundle_resource_type,
+    bundle_results,
+    make_bundle,
+    make_entry,
+    retry_bundle,
+    retry_indices,
+    yield_bundles,
+)
+
+
+def patient(i):
+    return {"resourceType": "Patient", "id": f"Patient.{i}"}
+
+
+def batch(*statuses):
+    bundle = make_bundle(
+        "batch", [make_entry(patient(i)) for i in range(len(statuses))]
+    )
+    response = {
+        "resourceType": "Bundle",
+        "type": "batch-response",
+        "entry": [{"response": {"status": status}} for status in statuses],
+    }
+    return bundle, response
+
+
+def test_make_entry():
+    assert make_entry(patient(1))["request"] == {
+        "method": "PUT",
+        "url": "Patient/Patient.1",
+    }
+
+
+def test_yield_bundles():
+    payloads = [patient(i) for i in range(5)]
+    bundles = list(yield_bundles(payloads, "batch", 2, 1000000))
+    assert [len(b["entry"]) for b in bundles] == [2, 2, 1]
+    assert [e["resource"] for b in bundles for e in b["entry"]] == payloads
+
+    # An entry bigger than max_bytes gets a Bundle of its own
+    bundles = list(yield_bundles(payloads, "transaction", 100, 1))
+    assert [len(b["entry"]) for b in bundles] == [1] * 5
+    assert bundles[0]["type"] == "transaction"
+
+
+def test_bundle_resource_type():
+    bundle = make_bundle("batch", [make_entry(patient(1))])
+    assert bundle_resource_type(bundle) == "Patient"
+    bundle["entry"].append(
+        make_entry({"resourceType": "Group", "id": "Group.1"})
+    )
+    assert bundle_resource_type(bundle) == "Bundle"
+
+
+def test_bundle_results():
+    bundle, response = batch("201 Created", "400 Bad Request", "200 OK")
+    results = bundle_results(
+        bundle, True, {"status_code": 200, "response": response}
+    )
+    assert [(s, p) for s, _, p in results] == [
+        (True, patient(0)),
+        (False, patient(1)),
+        (True, patient(2)),
+    ]
+    assert results[1][1] == {"status": "400 Bad Request"}
+
+
+def test_bundle_results_missing_entries():
+    bundle, response = batch("201", "201")
+    response["entry"].pop()
+    results = bundle_results(bundle, True, {"response": response})
+    assert results[1] == (
+        False,
+        {"error": "missing Bundle response entry"},
+        patient(1),
+    )
+
+
+def test_bundle_results_rejected():
+    # A rejected Bundle fails every entry with the whole response
+    bundle, _ = batch("201", "201")
+    result = {"status_code": 400, "response": {"issue": []}}
+    assert bundle_results(bundle, False, result) == [
+        (False, result, patient(0)),
+        (False, result, patient(1)),
+    ]
+
+
+def test_retry_indices():
+    bundle, response = batch("201", "503", "400", "429 Too Many Requests")
+    results = bundle_results(bundle, True, {"response": response})
+    assert retry_indices(results) == [1, 3]
+    retry = retry_bundle(bundle, retry_indices(results))
+    assert retry["type"] == "batch"
+    assert [e["resource"] for e in retry["entry"]] == [patient(1), patient(3)]
+
+
+def test_retry_indices_rejected():
+    # Entries of a rejected Bundle are retried with the Bundle, not alone
+    bundle, _ = batch("201")
+    results = bundle_results(bundle, False, {"status_code": 503})
+    assert retry_indices(results) == []
@@ -0,0 +1,95 @@
+import pytest
+
+from conftest import StandInSource
+
+from kf_model_fhir.mappers.common.cache import CachedSource
+
+pytest.importorskip("pyarrow")
+
+TABLE = '"Ingest:initial-ingest:GuidedTransformStage".default'
+COLUMNS = ["participant", "family", "specimen"]
+ROWS = [
+    ("PT_1", "FM_1", "BS_1"),
+    ("PT_1", "FM_1", "BS_2"),
+    ("PT_2", "FM_1", None),
+]
+
+
+class VersionedSource(StandInSource):
+    """
+    A stand-in source whose tables have a version as fingerprint
+    """
+
+    def __init__(self, tables, version=1):
+        super().__init__(tables)
+        self.version = version
+
+    def fingerprint(self, table):
+        return [len(self.tables[table][1]), self.version]
+
+
+def warehouse(version=1):
+    return VersionedSource({TABLE: (COLUMNS, ROWS)}, version)
+
+
+def cached(source, cache_dir, **kwargs):
+    return CachedSource(
+        source, str(cache_dir), "SD_X", "initial-ingest", **kwargs
+    )
+
+
+def test_hit_and_miss(tmp_path):
+    source = warehouse()
+    cache = cached(source, tmp_path)
+    rows = [("PT_1", "BS_1"), ("PT_1", "BS_2"), ("PT_2", None)]
+    assert list(cache.scan(TABLE, ["participant", "specimen"])) == rows
+    assert source.scans == 1
+
+    # Hits are read from the cache, also for fewer columns in any order
+    assert list(cache.scan(TABLE, ["participant", "specimen"])) == rows
+    assert list(cache.scan(TABLE, ["specimen", "participant"])) == [
+        row[::-1] for row in rows
+    ]
+    assert list(cache.scan(TABLE, ["specimen"])) == [
+        ("BS_1",),
+        ("BS_2",),
+        (None,),
+    ]
+    assert source.scans == 1
+    # Other columns miss
+    assert list(cache.scan(TABLE, ["family"])) == [("FM_1",)] * 3
+    assert source.scans == 2
+
+
+def test_served_without_source(tmp_path):
+    list(cached(warehouse(), tmp_path).scan(TABLE, COLUMNS))
+
+    # A rerun reads everything from the cache, even the columns
+    cache = cached(StandInSource({}), tmp_path)
+    assert cache.columns(TABLE) == COLUMNS
+    assert cache.fingerprint(TABLE) == [3, 1]
+    rows = list(
+        cache.select(TABLE, ["participant", "family"], group_by=["family"])
+    )
+    assert rows == [{"family": "FM_1", "participant": ["PT_1", "PT_2"]}]
+
+
+def test_invalidation(tmp_path):
+    list(cached(warehouse(), tmp_path).scan(TABLE, COLUMNS))
+
+    # Changed tables are trusted to be cached unless verified
+    source = warehouse(version=2)
+    list(cached(source, tmp_path).scan(TABLE, COLUMNS))
+    assert source.scans == 0
+    cache = cached(source, tmp_path, verify=True)
+    list(cache.scan(TABLE, COLUMNS))
+    assert source.scans == 1
+    assert cache.fingerprint(TABLE) == [3, 2]
+
+    # Which is then cached, until it is refreshed
+    source = warehouse(version=2)
+    list(cached(source, tmp_path, verify=True).scan(TABLE, COLUMNS))
+    assert source.scans == 0
+    list(cached(source, tmp_path, refresh=True).scan(TABLE, COLUMNS))
+    assert source.scans == 1
+    assert len(list(tmp_path.glob("SD_X/initial-ingest/*.arrow"))) == 1
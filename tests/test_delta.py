@@ -0,0 +1,75 @@
+from kf_lib_data_ingest.common.concept_schema import CONCEPT
+
+from conftest import StandInSource
+
+from kf_model_fhir.mappers.common.delta import (
+    Changes,
+    WatermarkStore,
+    high_watermarks,
+)
+
+PARTICIPANT = CONCEPT.PARTICIPANT.ID
+FAMILY = CONCEPT.FAMILY.ID
+PERSON1 = CONCEPT.FAMILY_RELATIONSHIP.PERSON1.ID
+PERSON2 = CONCEPT.FAMILY_RELATIONSHIP.PERSON2.ID
+TABLES = {"default": "default", "family_relationship": "family_relationship"}
+
+
+def study():
+    return StandInSource(
+        {
+            "default": (
+                [PARTICIPANT, FAMILY, "version"],
+                [
+                    ("P1", "F1", 1),
+                    ("P2", "F1", 1),
+                    ("P3", "F2", 1),
+                    ("P4", "F2", 2),
+                    ("P5", "", 2),
+                ],
+            ),
+            "family_relationship": (
+                [PERSON1, PERSON2, "version"],
+                [("P1", "P2", 1), ("P3", "P4", 1), ("P1", "P5", 2)],
+            ),
+        }
+    )
+
+
+def test_changes():
+    changes = Changes(
+        study(), TABLES, "version", {"default": 1, "family_relationship": 1}
+    )
+    assert changes.participants == {"P4", "P5"}
+    assert changes.families == {"F2"}
+    assert changes.related == {"P4", "P5"}
+    # With the other members of F2 and the relatives of related patients
+    assert changes.patients == {"P1", "P3", "P4", "P5"}
+
+    assert changes.where("participants") == {PARTICIPANT: {"P4", "P5"}}
+    assert changes.where("groups") == {FAMILY: {"F2"}}
+    assert changes.where("relations") == {PERSON2: {"P4", "P5"}}
+    assert changes.where("sent_patients") == {PARTICIPANT: {"P4", "P5"}}
+    assert str(changes).startswith("2 changed participants, 1 changed")
+
+
+def test_changes_of_new_table():
+    # Every row of a table that was empty at the last load is new
+    changes = Changes(study(), TABLES, "version", {"default": 2})
+    assert changes.participants == set()
+    assert changes.related == {"P2", "P4", "P5"}
+    assert changes.patients == {"P1", "P2", "P3", "P4", "P5"}
+
+
+def test_watermarks(tmp_path):
+    assert high_watermarks(study(), TABLES, "version") == {
+        "default": 2,
+        "family_relationship": 2,
+    }
+    store = WatermarkStore(str(tmp_path / "watermarks.json"))
+    key = WatermarkStore.key("http://localhost:8000", "SD_X", "package")
+    assert store.get(key) is None
+    store.set(key, {"default": 2})
+    store.set(key + "|shard 1/2", {"default": 1})
+    assert store.get(key) == {"default": 2}
+    assert store.get(key + "|shard 1/2") == {"default": 1}
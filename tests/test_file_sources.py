@@ -0,0 +1,98 @@
+import pandas as pd
+import pytest
+
+from kf_model_fhir.mappers.common.file_sources import FILE_SOURCES
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+
+COLUMNS = ["participant", "family", "specimen"]
+ROWS = [
+    ("PT_1", "FM_1", "BS_1"),
+    ("PT_1", "FM_1", "BS_2"),
+    ("PT_2", "FM_1", None),
+    ("PT_3", None, "BS_3"),
+    ("PT_1", "FM_1", "BS_1"),
+]
+
+
+def write_tsv(path, columns, rows):
+    pd.DataFrame(rows, columns=columns).to_csv(path, sep="\t", index=False)
+
+
+def arrow_table(columns, rows):
+    return pa.table(dict(zip(columns, map(list, zip(*rows)))))
+
+
+def write_arrow(path, columns, rows):
+    table = arrow_table(columns, rows)
+    with pa.OSFile(str(path), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def write_parquet(path, columns, rows):
+    pq.write_table(arrow_table(columns, rows), str(path))
+
+
+WRITERS = {"tsv": write_tsv, "arrow": write_arrow, "parquet": write_parquet}
+
+
+@pytest.fixture(params=sorted(FILE_SOURCES))
+def source(request, tmp_path):
+    file_format = request.param
+    path = tmp_path / f"default.{file_format}"
+    WRITERS[file_format](path, COLUMNS, ROWS)
+    return FILE_SOURCES[file_format](
+        {
+            "default": str(path),
+            "family_relationship": str(
+                tmp_path / f"family_relationship.{file_format}"
+            ),
+        }
+    )
+
+
+def test_columns(source):
+    assert source.columns("default") == COLUMNS
+    # Only the requested columns, in the requested order
+    assert list(source.scan("default", ["specimen", "participant"]))[:2] == [
+        ("BS_1", "PT_1"),
+        ("BS_2", "PT_1"),
+    ]
+
+
+def test_select(source):
+    # Distinct rows, without those missing a required value, and without
+    # the columns the table doesn't have
+    rows = list(
+        source.select(
+            "default", ["participant", "family", "age"], required=["family"]
+        )
+    )
+    assert rows == [
+        {"participant": "PT_1", "family": "FM_1"},
+        {"participant": "PT_2", "family": "FM_1"},
+    ]
+    # No row can match a required column the table doesn't have
+    assert list(source.select("default", COLUMNS, required=["age"])) == []
+
+
+def test_select_group_by(source):
+    rows = list(
+        source.select(
+            "default",
+            ["family", "participant"],
+            required=["family"],
+            group_by=["family"],
+            where={"participant": {"PT_1", "PT_2", "PT_3"}},
+        )
+    )
+    assert rows == [{"family": "FM_1", "participant": ["PT_1", "PT_2"]}]
+
+
+def test_missing_file(source):
+    # A table without a file fails like a missing warehouse table
+    with pytest.raises(FileNotFoundError):
+        list(source.select("family_relationship", ["participant"]))
+    assert source.columns("default") == COLUMNS
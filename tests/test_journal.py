@@ -0,0 +1,46 @@
+from kf_model_fhir.mappers.common.journal import Journal
+from kf_model_fhir.mappers.common.refindex import ReferenceIndex
+
+RUN = "http://localhost:8000|SD_X|package"
+
+
+def patient(i):
+    return {"resourceType": "Patient", "id": f"Patient.{i}"}
+
+
+def test_journal_resume(tmp_path):
+    path = str(tmp_path / "journal.sqlite3")
+    journal = Journal(path, RUN)
+    roles = ReferenceIndex()
+    roles[("CHOP", "Jane")] = "PractitionerRole.1"
+    journal.complete("practitioner_roles", roles)
+    journal.ack(patient(1))
+    journal.ack(patient(2))
+    # The load dies here
+    journal.close()
+
+    journal = Journal(path, RUN, resume=True)
+    assert journal.completed() == {"practitioner_roles"}
+    assert journal.acked() == {"Patient/Patient.1", "Patient/Patient.2"}
+    restored = ReferenceIndex()
+    journal.restore("practitioner_roles", restored)
+    # Tuple keys come back as tuples, not JSON lists
+    assert dict(restored) == {("CHOP", "Jane"): "PractitionerRole.1"}
+    journal.close()
+
+
+def test_journal_new_load(tmp_path):
+    path = str(tmp_path / "journal.sqlite3")
+    journal = Journal(path, RUN)
+    journal.complete("practitioners")
+    journal.ack(patient(1))
+    journal.close()
+
+    # Another run keeps its own records, and a new load starts over
+    journal = Journal(path, RUN + "|shard 1/2", resume=True)
+    assert journal.completed() == set()
+    journal.close()
+    journal = Journal(path, RUN)
+    assert journal.completed() == set()
+    assert journal.acked() == set()
+    journal.close()
@@ -0,0 +1,69 @@
+import os
+
+from kf_model_fhir.mappers.load_studies import (
+    cli_options,
+    study_args,
+    study_entries,
+    study_loads,
+)
+
+
+def test_study_entries():
+    config = {
+        "studies": [
+            "SD_A",
+            {
+                "study_id": "SD_B",
+                "ingest_package": "pkg",
+                "options": {"max_workers": 20},
+            },
+        ]
+    }
+    assert study_entries(config, ["SD_C", "SD_D:other"]) == [
+        ("SD_A", "initial-ingest", {}),
+        ("SD_B", "pkg", {"max_workers": 20}),
+        ("SD_C", "initial-ingest", {}),
+        ("SD_D", "other", {}),
+    ]
+    assert study_entries({}, []) == []
+
+
+def test_study_args():
+    args = study_args(
+        "SD_A",
+        "pkg",
+        [{"metrics": "metrics/{study_id}-{ingest_package}.json"}],
+    )
+    assert (args.study_id, args.ingest_package) == ("SD_A", "pkg")
+    assert args.metrics == "metrics/SD_A-pkg.json"
+    # Every study writes to its own subdirectory of output_dir
+    assert args.output_dir == os.path.join("output", "SD_A")
+
+    # Unless output_dir is templated already
+    args = study_args("SD_A", "pkg", [{"output_dir": "out/{study_id}/ndjson"}])
+    assert args.output_dir == "out/SD_A/ndjson"
+
+
+def test_cli_options():
+    assert cli_options("SD_A", []) == {}
+    assert cli_options(
+        "SD_A", ["-c", "cache", "--max_in_flight", "10", "-z"]
+    ) == {"cache_dir": "cache", "max_in_flight": 10, "compress": True}
+
+
+def test_option_precedence():
+    config = {
+        "options": {"max_workers": 5, "retries": 3, "max_in_flight": 100},
+        "studies": [
+            {"study_id": "SD_A", "options": {"retries": 4, "max_workers": 6}},
+            "SD_B",
+        ],
+    }
+    # Config options < study options < command line options, even a
+    # command line option given its default value
+    a, b = study_loads(config, [], ["-w", "10", "--max_in_flight", "200"])
+    assert (a.max_workers, a.retries, a.max_in_flight) == (10, 4, 200)
+    assert (b.max_workers, b.retries, b.max_in_flight) == (10, 3, 200)
+
+    (a, _) = study_loads(config, [], [])
+    assert (a.max_workers, a.retries, a.max_in_flight) == (6, 4, 100)
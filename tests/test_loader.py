@@ -0,0 +1,228 @@
+import pytest
+
+from conftest import StandInServer, StandInSink, stand_in_study
+
+from kf_model_fhir.mappers import loader
+from kf_model_fhir.mappers.common.journal import Journal
+from kf_model_fhir.mappers.common.sinks import MultiTargetSink
+
+
+def load_args(*options):
+    return loader.parser.parse_args(["SD_X", "-q", *options])
+
+
+def study(args, **kwargs):
+    schema = f'"Ingest:{args.ingest_package}:GuidedTransformStage"'
+    return stand_in_study(
+        {
+            "default": f"{schema}.default",
+            "family_relationship": f"{schema}.family_relationship",
+        },
+        **kwargs,
+    )
+
+
+def test_load():
+    args = load_args()
+    sink = StandInSink()
+    summary = loader.load(args, source=study(args), sink=sink)
+    assert sorted({key.split("/")[0] for key in sink.sent}) == [
+        "Condition",
+        "Group",
+        "Observation",
+        "Organization",
+        "Patient",
+        "Practitioner",
+        "PractitionerRole",
+        "ResearchStudy",
+        "Specimen",
+    ]
+    assert sink.closed
+    # Only the resources that were sent are counted
+    assert summary["resources"] == len(sink.payloads)
+
+
+def test_journal_after_failure(tmp_path):
+    journal_path = str(tmp_path / "journal.sqlite3")
+    args = load_args("--journal", journal_path)
+    everything = StandInSink()
+    loader.load(load_args(), source=study(args), sink=everything)
+
+    # Conditions fail while Specimens are being sent
+    sink = StandInSink(
+        fail={"Condition/Condition.SD-X.P0.Diagnosis-0.100"},
+        hold={"Specimen"},
+    )
+    with pytest.raises(Exception):
+        loader.load(args, source=study(args), sink=sink)
+    run_key = f"{args.target_url}|SD_X|{args.ingest_package}"
+    journal = Journal(journal_path, run_key, resume=True)
+    completed = journal.completed()
+    journal.close()
+    assert "practitioners" in completed
+    assert "kfdrc_conditions" not in completed
+    assert "kfdrc_specimens" not in completed
+
+    # A resumed load sends everything that wasn't
+    resumed = StandInSink()
+    loader.load(
+        load_args("--journal", journal_path, "--resume"),
+        source=study(args),
+        sink=resumed,
+    )
+    assert set(sink.sent) | set(resumed.sent) == set(everything.sent)
+
+
+def references(value):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key == "reference":
+                yield item
+            else:
+                yield from references(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from references(item)
+
+
+@pytest.mark.parametrize("sampled", [False, True])
+def test_referenced_patients_sent(tmp_path, sampled):
+    options = []
+    if sampled:
+        # P1's mother P0 isn't sampled, and P2 has no relations
+        path = tmp_path / "participants.txt"
+        path.write_text("P1\nP2\n")
+        options = ["--participants", str(path)]
+    args = load_args(*options)
+    sink = StandInSink()
+    loader.load(args, source=study(args), sink=sink)
+
+    patients = {key for key in sink.sent if key.startswith("Patient/")}
+    referenced = {
+        reference
+        for payload in sink.payloads
+        for reference in references(payload)
+        if reference.startswith("Patient/")
+    }
+    assert referenced <= patients
+    if sampled:
+        assert patients == {
+            "Patient/Patient.SD-X.P1",
+            "Patient/Patient.SD-X.P2",
+        }
+        # Without a relation to the Patient of an unsampled participant
+        assert not any(
+            payload.get("extension")
+            and "Patient/Patient.SD-X.P0" in references(payload)
+            for payload in sink.payloads
+        )
+    else:
+        assert len(patients) == 6
+    assert len(sink.sent) == len(set(sink.sent))
+
+
+def test_preflight_before_extraction():
+    # P9 isn't a participant of the study
+    args = load_args()
+    source = study(args, relations=[(0, 1), (9, 2)])
+    with pytest.raises(Exception, match="Dangling references"):
+        loader.load(args, source=source, sink=StandInSink())
+    # Only the keys of references were selected, while the fan-out would
+    # have scanned every column of the tables
+    assert source.scanned
+    assert all(len(columns) <= 4 for columns in source.scanned)
+
+
+def test_failed_target():
+    args = load_args()
+    everything = StandInSink()
+    loader.load(args, source=study(args), sink=everything)
+
+    a, b = StandInSink(), StandInSink(fail={"Patient/Patient.SD-X.P0"})
+    sink = MultiTargetSink({"a": a, "b": b}, workers=2, buffer=4)
+    with pytest.raises(Exception, match="Failed to load into b"):
+        loader.load(args, source=study(args), sink=sink)
+    # The other target got everything
+    assert sorted(a.sent) == sorted(everything.sent)
+    assert a.closed and b.closed
+
+
+def test_map_in_processes():
+    def research_study(sink):
+        return next(
+            payload
+            for payload in sink.payloads
+            if payload["resourceType"] == "ResearchStudy"
+        )
+
+    args = load_args()
+    single = StandInSink()
+    loader.load(args, source=study(args, participants=20), sink=single)
+    args = load_args("--map_processes", "2")
+    mapped = StandInSink()
+    loader.load(args, source=study(args, participants=20), sink=mapped)
+
+    assert sorted(mapped.sent) == sorted(single.sent)
+    # The Groups are enrolled in the same order however they were mapped
+    assert research_study(mapped) == research_study(single)
+
+
+class StandInClient:
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def _fhir_version_headers(self):
+        return {"Content-Type": "application/fhir+json"}
+
+
+class StandInEngine:
+    def __init__(self, *args):
+        self.disposed = False
+
+    def dispose(self):
+        self.disposed = True
+
+
+def test_study_loader(monkeypatch):
+    monkeypatch.setattr(loader, "create_client", StandInClient)
+    monkeypatch.setattr(loader, "create_engine", StandInEngine)
+    with loader.StudyLoader("postgresql://warehouse") as study_loader:
+        engine = study_loader.engine("SD_X")
+        assert study_loader.engine("SD_X") is engine
+        assert study_loader.engine("SD_Y") is not engine
+        client = study_loader.client("http://a")
+        assert study_loader.client("http://a") is client
+        assert study_loader.client("http://b") is not client
+
+        args = study_loader.options("SD_X", quiet=True, max_workers=3)
+        assert args.max_workers == 3
+        with pytest.raises(ValueError, match="unknown loader option"):
+            study_loader.options("SD_X", max_wrokers=3)
+
+        sink = StandInSink()
+        summary = study_loader.load(args, source=study(args), sink=sink)
+        assert summary["study_id"] == "SD_X"
+        assert sink.sent
+    assert engine.disposed
+
+
+def test_study_loader_shares_sessions(monkeypatch):
+    monkeypatch.setattr(loader, "create_client", StandInClient)
+    server = StandInServer()
+    with server as base_url:
+        with loader.StudyLoader() as study_loader:
+            for _ in range(2):
+                args = study_loader.options(
+                    "SD_X",
+                    target_url=base_url,
+                    engine="asyncio",
+                    max_in_flight=3,
+                    quiet=True,
+                )
+                study_loader.load(args, source=study(args))
+            session = study_loader.async_session(base_url, 3)
+        # Both loads sent over the same connections, which are closed with
+        # the loader
+        assert len(server.received) == 2 * len(set(server.received))
+        assert len(server.connections) <= 3
+        assert session.loop.is_closed()
@@ -0,0 +1,41 @@
+from kf_model_fhir.common.manifest import ResourceManifest, canonical_hash
+
+TARGET = "http://localhost:8000"
+
+
+def patient(**fields):
+    return {"resourceType": "Patient", "id": "Patient.1", **fields}
+
+
+def test_canonical_hash():
+    # Key order and whitespace don't change the hash, values do
+    assert canonical_hash({"a": 1, "b": [1, 2]}) == canonical_hash(
+        {"b": [1, 2], "a": 1}
+    )
+    assert canonical_hash({"a": 1}) != canonical_hash({"a": 2})
+
+
+def test_manifest(tmp_path):
+    manifest = ResourceManifest(str(tmp_path / "manifest.sqlite3"))
+    assert not manifest.unchanged(TARGET, patient())
+    manifest.record(TARGET, patient(gender="female"))
+    assert manifest.unchanged(TARGET, patient(gender="female"))
+    assert not manifest.unchanged(TARGET, patient(gender="male"))
+    # Every target has its own record
+    assert not manifest.unchanged("http://other", patient(gender="female"))
+    manifest.close()
+
+
+def test_manifest_persists(tmp_path):
+    path = str(tmp_path / "state" / "manifest.sqlite3")
+    manifest = ResourceManifest(path, commit_every=1000)
+    manifest.record(TARGET, patient(gender="female"))
+    manifest.close()
+
+    # Records are committed on close, and a record replaces the last one
+    manifest = ResourceManifest(path)
+    assert manifest.unchanged(TARGET, patient(gender="female"))
+    manifest.record(TARGET, patient(gender="male"))
+    assert manifest.unchanged(TARGET, patient(gender="male"))
+    assert not manifest.unchanged(TARGET, patient(gender="female"))
+    manifest.close()
@@ -0,0 +1,60 @@
+import json
+
+from kf_model_fhir.common.metrics import Metrics, serialize
+
+
+def test_summary():
+    metrics = Metrics(slowest=2)
+    for seconds in (0.1, 0.2, 0.3, 0.4):
+        metrics.observe("map", "Patient", seconds, size=10)
+    # A Bundle of 50 resources is one observation of 50 resources
+    observe = metrics.send_observer("Patient", "POST /", count=50)
+    observe(0, False, {"status_code": 503}, 2.0)
+    observe(1, True, {"status_code": 200}, 1.0)
+
+    summary = metrics.summary()
+    mapped = summary["stages"]["map"]["Patient"]
+    assert mapped["count"] == 4
+    assert mapped["observations"] == 4
+    assert mapped["bytes"] == 40
+    assert mapped["p50"] == 0.3
+    assert mapped["p99"] == 0.4
+    sent = summary["stages"]["send"]["Patient"]
+    assert sent["count"] == 100
+    assert sent["observations"] == 2
+    assert summary["retries"] == {"Patient": 1}
+    assert [entry["status"] for entry in summary["slowest"]] == [503, 200]
+
+
+def test_prometheus():
+    metrics = Metrics()
+    metrics.observe("send", 'Bundle "batch"', 1.5, size=100, count=50)
+    metrics.observe("send", 'Bundle "batch"', 0.5, size=100, count=50)
+    metrics.retry("Patient")
+
+    lines = metrics.prometheus().splitlines()
+    labels = 'stage="send",resource_type="Bundle \\"batch\\""'
+    # The count of a summary is of observations, like its quantiles
+    assert f"kf_fhir_load_seconds_count{{{labels}}} 2" in lines
+    assert f"kf_fhir_load_seconds_sum{{{labels}}} 2.0" in lines
+    assert f'kf_fhir_load_seconds{{{labels},quantile="0.5"}} 1.5' in lines
+    assert f"kf_fhir_load_resources_total{{{labels}}} 100" in lines
+    assert f"kf_fhir_load_bytes_total{{{labels}}} 200" in lines
+    assert 'kf_fhir_load_retries_total{resource_type="Patient"} 1' in lines
+    assert "# TYPE kf_fhir_load_seconds summary" in lines
+
+
+def test_serialize(tmp_path):
+    body = {"resourceType": "Patient", "id": "Patient.1"}
+    assert serialize(body) == json.dumps(body).encode()
+
+    metrics = Metrics()
+    data = serialize(body, metrics, "Patient")
+    serialized = metrics.summary()["stages"]["serialize"]["Patient"]
+    assert serialized["count"] == 1
+    assert serialized["bytes"] == len(data)
+
+    metrics.write(str(tmp_path / "metrics.json"), str(tmp_path / "prom"))
+    with open(tmp_path / "metrics.json") as f:
+        assert json.load(f)["stages"]["serialize"]["Patient"]["count"] == 1
+    assert "serialize" in (tmp_path / "prom").read_text()
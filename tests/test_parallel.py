@@ -0,0 +1,64 @@
+import json
+
+from kf_lib_data_ingest.common.concept_schema import CONCEPT
+
+from conftest import StandInSource
+
+from kf_model_fhir.mappers.common.parallel import (
+    RecordingSource,
+    map_in_processes,
+    serialized,
+    split,
+)
+from kf_model_fhir.mappers.common.utils import get, make_select
+
+PARTICIPANT = CONCEPT.PARTICIPANT.ID
+
+
+def yield_specimens(eng, table):
+    for row in make_select(eng, table, PARTICIPANT, "specimen"):
+        yield {"id": get(row, "specimen"), "subject": get(row, PARTICIPANT)}
+
+
+ROWS = [(f"PT_{i // 3}", f"BS_{i}") for i in range(60)]
+
+
+def study():
+    return StandInSource({"t": ([PARTICIPANT, "specimen"], ROWS)})
+
+
+def test_split():
+    source = study()
+    recording = RecordingSource(source)
+    assert list(yield_specimens(recording, "t")) == []
+    assert source.selects == 0
+
+    chunks = split(source, recording.selects, 4)
+    assert source.selects == 1
+    (key,) = recording.selects
+    assert sum(len(chunk[key]) for chunk in chunks) == len(ROWS)
+    # The rows of a participant are all in the same chunk
+    for chunk in chunks:
+        participants = {get(row, PARTICIPANT) for row in chunk[key]}
+        assert all(
+            get(row, PARTICIPANT) not in participants
+            for other in chunks
+            if other is not chunk
+            for row in other[key]
+        )
+
+
+def test_map_in_processes():
+    source = study()
+    specimens = list(map_in_processes(2, yield_specimens, source, "t"))
+    assert sorted(s["id"] for s in specimens) == sorted(s for _, s in ROWS)
+    # The rows were read once by the loader, not by every worker
+    assert source.selects == 1
+
+    # With the bytes the workers serialized them to, in the same order on
+    # every run
+    assert all(
+        json.loads(serialized(specimen)) == specimen for specimen in specimens
+    )
+    again = list(map_in_processes(2, yield_specimens, study(), "t"))
+    assert again == specimens
@@ -0,0 +1,56 @@
+from kf_lib_data_ingest.common.concept_schema import CONCEPT
+
+from conftest import StandInSource
+
+from kf_model_fhir.mappers.common.preflight import check_references
+
+PARTICIPANT = CONCEPT.PARTICIPANT.ID
+PERSON1 = CONCEPT.FAMILY_RELATIONSHIP.PERSON1.ID
+PERSON2 = CONCEPT.FAMILY_RELATIONSHIP.PERSON2.ID
+TABLES = {"default": "default", "family_relationship": "family_relationship"}
+
+
+def study(relations):
+    return StandInSource(
+        {
+            "default": (
+                [PARTICIPANT, CONCEPT.BIOSPECIMEN.ID],
+                [("PT_1", "BS_1"), ("PT_2", "BS_2"), ("PT_3", "")],
+            ),
+            "family_relationship": ([PERSON1, PERSON2], relations),
+        }
+    )
+
+
+def test_no_dangling_references():
+    source = study([("PT_1", "PT_2"), ("PT_3", "PT_2")])
+    phases = {"kfdrc_patient_relations", "kfdrc_specimens"}
+    assert check_references(source, TABLES, phases) == []
+
+
+def test_dangling_references():
+    source = study([("PT_1", "PT_2"), ("PT_4", "PT_2"), ("PT_5", "PT_1")])
+    (violation,) = check_references(
+        source, TABLES, {"kfdrc_patient_relations", "kfdrc_specimens"}
+    )
+    assert violation.startswith("kfdrc_patient_relations: 2 ")
+    assert "(PT_4, PT_5)" in violation
+
+    # Only the phases to run are checked
+    assert check_references(source, TABLES, {"kfdrc_specimens"}) == []
+
+
+def test_dangling_references_filtered():
+    # Sampled relations reference a participant outside the sample
+    source = study([("PT_1", "PT_2")])
+    sample = {PARTICIPANT: {"PT_2"}}
+    (violation,) = check_references(
+        source,
+        TABLES,
+        {"kfdrc_patient_relations"},
+        {
+            "kfdrc_patients": sample,
+            "kfdrc_patient_relations": {PERSON2: {"PT_2"}},
+        },
+    )
+    assert "(PT_1)" in violation
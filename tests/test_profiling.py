@@ -0,0 +1,59 @@
+import pstats
+import tracemalloc
+
+import pytest
+
+from kf_model_fhir.common.profiling import Profiler
+
+
+@pytest.fixture
+def profiler(tmp_path):
+    tracing = tracemalloc.is_tracing()
+    yield Profiler(str(tmp_path), "SD_X", top=5)
+    if not tracing:
+        tracemalloc.stop()
+
+
+def build_patients(count):
+    return [{"resourceType": "Patient", "id": str(i)} for i in range(count)]
+
+
+def functions(path):
+    return {function for _, _, function in pstats.Stats(path).stats}
+
+
+def test_phase(profiler, tmp_path):
+    with profiler.phase("Patient.kfdrc_patients"):
+        patients = build_patients(10000)
+    assert len(patients) == 10000
+
+    assert "build_patients" in functions(
+        str(tmp_path / "SD_X.Patient.kfdrc_patients.pstats")
+    )
+    lines = (
+        (tmp_path / "SD_X.Patient.kfdrc_patients.alloc.txt")
+        .read_text()
+        .splitlines()
+    )
+    assert lines[0] == "Top 5 allocations of Patient.kfdrc_patients by line"
+    assert 0 < len(lines[2:]) <= 5
+    assert "test_profiling.py" in lines[2]
+
+
+def test_wrap(profiler, tmp_path):
+    wrapped = profiler.wrap("Patient/put", build_patients)
+    assert wrapped.__name__ == "build_patients"
+    for _ in range(3):
+        wrapped(10)
+    profiler.dump_all()
+
+    # Every call goes into the same profile, named after the file safe name
+    path = str(tmp_path / "SD_X.Patient-put.pstats")
+    stats = pstats.Stats(path).stats
+    (calls,) = [
+        stat[0]
+        for (_, _, function), stat in stats.items()
+        if function == "build_patients"
+    ]
+    assert calls == 3
+    assert (tmp_path / "SD_X.Patient-put.alloc.txt").exists()
@@ -0,0 +1,41 @@
+import sys
+
+import pytest
+
+from kf_model_fhir.mappers.common.refindex import ReferenceIndex
+
+
+def test_lookups():
+    index = ReferenceIndex()
+    index["PT_1"] = "Patient.1"
+    index[("CHOP", "Jane")] = "PractitionerRole.1"
+    index["PT_1"] = "Patient.2"
+    assert index["PT_1"] == "Patient.2"
+    assert index[("CHOP", "Jane")] == "PractitionerRole.1"
+    assert len(index) == 2
+    assert dict(index) == {
+        "PT_1": "Patient.2",
+        ("CHOP", "Jane"): "PractitionerRole.1",
+    }
+
+
+def test_missing_keys():
+    index = ReferenceIndex()
+    index["PT_1"] = "Patient.1"
+    with pytest.raises(KeyError):
+        index["PT_2"]
+    assert index.get("PT_2") is None
+    assert "PT_2" not in index and "PT_1" in index
+    # Tuple keys aren't the lists that JSON would make of them
+    index[("CHOP", "Jane")] = "PractitionerRole.1"
+    with pytest.raises(TypeError):
+        index[["CHOP", "Jane"]]
+
+
+def test_interned():
+    index = ReferenceIndex()
+    index["".join(["PT_", "1"])] = "".join(["Patient.", "1"])
+    (key,) = index
+    # Equal keys and ids are stored once, however they were built
+    assert key is sys.intern("PT_1")
+    assert index[key] is sys.intern("Patient.1")
@@ -0,0 +1,146 @@
+import asyncio
+import threading
+
+from kf_model_fhir.common.retry import (
+    Aimd,
+    AsyncConcurrencyLimiter,
+    ConcurrencyLimiter,
+    FixedLimit,
+    RetryPolicy,
+    retryable,
+    send_with_retries,
+)
+
+
+def test_retryable():
+    assert retryable(None)
+    assert retryable(503)
+    assert retryable(429)
+    assert not retryable(400)
+    assert not retryable(404)
+
+
+def test_retry_policy_delay():
+    policy = RetryPolicy(base=1.0, cap=4.0)
+    assert all(0 <= policy.delay(attempt) <= 4.0 for attempt in range(10))
+    assert policy.delay(0, retry_after=2.5) == 2.5
+    assert policy.delay(0, retry_after=100) == 4.0
+
+
+def test_aimd():
+    limit = Aimd(10, initial=4, cooldown=60)
+    limit.on_success(0.1)
+    assert limit.limit == 4.25
+    limit.on_overload()
+    assert limit.limit == 2.125
+    # Only one decrease per cooldown
+    limit.on_overload()
+    assert limit.limit == 2.125
+
+
+def test_aimd_latency_target():
+    limit = Aimd(10, initial=4, latency_target=1.0)
+    limit.on_success(2.0)
+    assert limit.limit == 2
+
+
+def test_send_with_retries():
+    results = [
+        (False, {"status_code": 503}),
+        (False, {"status_code": None}),
+        (True, {"status_code": 200}),
+    ]
+    limiter = ConcurrencyLimiter(FixedLimit(1))
+    success, result = send_with_retries(
+        lambda: results.pop(0), RetryPolicy(5, base=0), limiter, log=None
+    )
+    assert success and result["status_code"] == 200
+    assert not results
+
+
+def test_send_with_retries_logs(caplog, capsys):
+    results = [(False, {"status_code": 503}), (True, {"status_code": 200})]
+    limiter = ConcurrencyLimiter(FixedLimit(1))
+    send_with_retries(lambda: results.pop(0), RetryPolicy(5, base=0), limiter)
+    assert [r.levelname for r in caplog.records] == ["WARNING"]
+    assert caplog.records[0].message.startswith("Retrying in 0.0s after 503")
+    assert capsys.readouterr().out == ""
+
+
+def test_send_with_retries_final_failure():
+    calls = []
+
+    def send():
+        calls.append(1)
+        return False, {"status_code": 400}
+
+    limiter = ConcurrencyLimiter(FixedLimit(1))
+    success, result = send_with_retries(
+        send, RetryPolicy(5, base=0), limiter, log=None
+    )
+    assert not success and len(calls) == 1
+
+
+def test_async_limiter_across_event_loops():
+    limiter = AsyncConcurrencyLimiter(FixedLimit(3))
+    lock = threading.Lock()
+    in_flight = [0]
+    peak = []
+
+    async def write():
+        async with limiter:
+            with lock:
+                in_flight[0] += 1
+                peak.append(in_flight[0])
+            await asyncio.sleep(0.001)
+            with lock:
+                in_flight[0] -= 1
+
+    async def phase():
+        await asyncio.gather(*(write() for _ in range(20)))
+
+    # One loop after another, then four at once from threads, all counted
+    # against the same limit
+    asyncio.run(phase())
+    asyncio.run(phase())
+    threads = [
+        threading.Thread(target=asyncio.run, args=(phase(),))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(peak) == 120
+    assert max(peak) == 3
+    assert limiter.in_flight == 0
+
+
+def test_send_with_retries_not_idempotent():
+    limiter = ConcurrencyLimiter(FixedLimit(1))
+    policy = RetryPolicy(5, base=0)
+
+    # A POST that may have been processed isn't sent again
+    for status_code in (None, 500, 503):
+        calls = []
+
+        def send():
+            calls.append(1)
+            return False, {"status_code": status_code}
+
+        success, _ = send_with_retries(
+            send, policy, limiter, log=None, idempotent=False
+        )
+        assert not success and len(calls) == 1
+
+    # One that certainly wasn't is
+    results = [
+        (False, {"status_code": 429}),
+        (False, {"status_code": 503, "retry_after": "0"}),
+        (True, {"status_code": 201}),
+    ]
+    success, _ = send_with_retries(
+        lambda: results.pop(0), policy, limiter, log=None, idempotent=False
+    )
+    assert success and not results
@@ -0,0 +1,49 @@
+from kf_lib_data_ingest.common.concept_schema import CONCEPT
+
+from conftest import StandInSource
+
+from kf_model_fhir.mappers.common.sample import Sample
+
+PARTICIPANT = CONCEPT.PARTICIPANT.ID
+
+
+def participants_source(participants):
+    return StandInSource(
+        {"default": ([PARTICIPANT], [(p,) for p in participants])}
+    )
+
+
+def test_first():
+    participants = [f"PT_{i:04d}" for i in range(200)] + ["", None]
+    source = participants_source(participants)
+    sample = Sample.first(source, "default", 10)
+    assert len(sample.participants) == 10
+    assert sample.participants <= set(participants[:200])
+
+    # The same participants every time and in any order, and a bigger
+    # sample holds every smaller one
+    reversed_source = participants_source(participants[::-1])
+    again = Sample.first(reversed_source, "default", 10)
+    assert again.participants == sample.participants
+    bigger = Sample.first(source, "default", 20)
+    assert sample.participants < bigger.participants
+    assert len(Sample.first(source, "default", 1000).participants) == 200
+
+
+def test_read(tmp_path):
+    path = tmp_path / "participants.txt"
+    path.write_text("PT_1\n\n  PT_2  \nPT_1\n")
+    sample = Sample.read(str(path))
+    assert sample.participants == {"PT_1", "PT_2"}
+    assert str(sample) == "2 sampled participants"
+
+
+def test_where():
+    sample = Sample(["PT_1"])
+    for name in ("participants", "patients", "groups", "sent_patients"):
+        assert sample.where(name) == {PARTICIPANT: {"PT_1"}}
+    # Only relations between sampled participants
+    assert sample.where("relations") == {
+        CONCEPT.FAMILY_RELATIONSHIP.PERSON1.ID: {"PT_1"},
+        CONCEPT.FAMILY_RELATIONSHIP.PERSON2.ID: {"PT_1"},
+    }
@@ -0,0 +1,87 @@
+import threading
+
+import pytest
+
+from kf_model_fhir.mappers.common.scheduler import run_phases
+
+
+def recorder(log, name, wait_for=None):
+    def run():
+        if wait_for:
+            assert wait_for.wait(5)
+        log.append(name)
+
+    return run
+
+
+def test_run_phases_order():
+    log = []
+    run_phases(
+        [
+            ("studies", ("roles", "groups"), recorder(log, "studies")),
+            ("roles", ("practitioners",), recorder(log, "roles")),
+            ("practitioners", (), recorder(log, "practitioners")),
+            ("patients", (), recorder(log, "patients")),
+            ("groups", ("patients",), recorder(log, "groups")),
+        ]
+    )
+    assert sorted(log) == [
+        "groups",
+        "patients",
+        "practitioners",
+        "roles",
+        "studies",
+    ]
+    for before, after in [
+        ("practitioners", "roles"),
+        ("patients", "groups"),
+        ("roles", "studies"),
+        ("groups", "studies"),
+    ]:
+        assert log.index(before) < log.index(after)
+
+
+def test_run_phases_concurrently():
+    # Each phase waits for the other, so they only finish if both run at once
+    log = []
+    a, b = threading.Event(), threading.Event()
+
+    def phase(name, mine, other):
+        def run():
+            mine.set()
+            assert other.wait(5)
+            log.append(name)
+
+        return run
+
+    run_phases([("a", (), phase("a", a, b)), ("b", (), phase("b", b, a))])
+    assert sorted(log) == ["a", "b"]
+
+
+def test_run_phases_failure():
+    log = []
+    release = threading.Event()
+
+    def fail():
+        try:
+            raise KeyError("Patient.1")
+        finally:
+            release.set()
+
+    with pytest.raises(KeyError):
+        run_phases(
+            [
+                ("patients", (), fail),
+                ("slow", (), recorder(log, "slow", wait_for=release)),
+                ("conditions", ("patients",), recorder(log, "conditions")),
+            ]
+        )
+    # Phases already running finish, and dependents never start
+    assert log == ["slow"]
+
+
+def test_run_phases_invalid():
+    with pytest.raises(ValueError, match="unknown"):
+        run_phases([("a", ("b",), lambda: None)])
+    with pytest.raises(ValueError, match="Cyclic"):
+        run_phases([("a", ("b",), lambda: None), ("b", ("a",), lambda: None)])
@@ -0,0 +1,34 @@
+import pytest
+
+from kf_model_fhir.common.sharding import parse_shard, shard_of
+
+
+def test_shard_of_is_stable():
+    # crc32, so the same on every host and in every run
+    assert shard_of("PT_00000001", 4) == shard_of("PT_00000001", 4)
+    assert [shard_of(f"PT_{i}", 4) for i in range(8)] == [
+        shard_of(f"PT_{i}", 4) for i in range(8)
+    ]
+    assert shard_of("PT_1", 1) == 0
+
+
+def test_shard_of_spreads_values():
+    counts = [0] * 4
+    for i in range(4000):
+        counts[shard_of(f"PT_{i:08d}", 4)] += 1
+    assert all(800 < count < 1200 for count in counts)
+
+
+def test_shard_of_salt():
+    values = [f"PT_{i}" for i in range(100)]
+    assert [shard_of(v, 4) for v in values] != [
+        shard_of(v, 4, "map") for v in values
+    ]
+
+
+def test_parse_shard():
+    assert parse_shard("0/2") == (0, 2)
+    assert parse_shard("3/4") == (3, 4)
+    for text in ("2/2", "-1/2", "1", "a/b", "1/2/3"):
+        with pytest.raises(ValueError):
+            parse_shard(text)
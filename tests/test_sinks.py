@@ -0,0 +1,136 @@
+import gzip
+import json
+import os
+import threading
+
+import pytest
+
+from conftest import StandInSink
+
+from kf_model_fhir.mappers.common.sinks import (
+    MultiTargetSink,
+    NdjsonSink,
+    NullSink,
+)
+
+
+class SerializedSink(StandInSink):
+    """
+    A sink that sends the data it is given
+    """
+
+    def __init__(self, release=None):
+        super().__init__()
+        self.release = release
+        self.data = []
+
+    def send(self, payload, data=None):
+        if self.release:
+            self.release.wait(5)
+        self.data.append(data)
+        return super().send(payload, data)
+
+
+def patient(i):
+    return {"resourceType": "Patient", "id": f"Patient.{i}"}
+
+
+def test_multi_target_sink():
+    a, b = StandInSink(), SerializedSink()
+    sink = MultiTargetSink({"a": a, "b": b}, workers=2, buffer=4)
+    ((success, result, payload),) = sink.send(patient(1))
+    assert success and payload == patient(1)
+    assert result == {"a": {"status_code": 201}, "b": {"status_code": 201}}
+    bundle = {"entry": [{"resource": patient(i)} for i in (2, 3)]}
+    assert [s for s, _, _ in sink.send_bundle(bundle)] == [True, True]
+    sink.close()
+    assert a.payloads == b.payloads == [patient(1), patient(2), patient(3)]
+    # Serialized once and passed to every sink
+    assert a.closed and b.closed
+    assert b.data[0] == b'{"resourceType": "Patient", "id": "Patient.1"}'
+    assert sink.failures == {}
+
+
+def test_multi_target_sink_waits_for_every_target():
+    release = threading.Event()
+    fast, slow = StandInSink(), SerializedSink(release)
+    sink = MultiTargetSink({"fast": fast, "slow": slow}, workers=1, buffer=4)
+    future = sink.submit(patient(1))
+    assert not future.done()
+    release.set()
+    assert future.result(5)[0][0]
+    sink.close()
+
+
+def test_multi_target_sink_failure():
+    a, b = StandInSink(), StandInSink(fail={"Patient/Patient.1"})
+    sink = MultiTargetSink({"a": a, "b": b}, workers=1, buffer=4)
+    # Sent by a, so the resource succeeds with the result of each target
+    ((success, result, _),) = sink.send(patient(1))
+    assert success
+    assert result == {"a": {"status_code": 201}, "b": {"status_code": 400}}
+
+    # The failed target stops sending while the other one goes on
+    ((success, result, _),) = sink.send(patient(2))
+    assert success and "error" in result["b"]
+    assert a.payloads == [patient(1), patient(2)]
+    assert b.payloads == []
+
+    # close reports the failure instead of raising
+    sink.close()
+    assert list(sink.failures) == ["b"]
+    assert "Patient.1" in sink.failures["b"]
+
+    # A resource that no target sent fails
+    c = StandInSink(fail={"Patient/Patient.3"})
+    sink = MultiTargetSink({"c": c}, workers=1, buffer=4)
+    ((success, _, _),) = sink.send(patient(3))
+    assert not success
+    sink.close()
+
+
+def read_lines(path):
+    with (gzip.open if path.endswith(".gz") else open)(path, "rt") as f:
+        return f.read().splitlines()
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_ndjson_sink(tmp_path, compress):
+    sink = NdjsonSink(str(tmp_path), shard_size=2, compress=compress)
+    for i in range(3):
+        sink.send(patient(i))
+    sink.send_bundle(
+        {
+            "resourceType": "Bundle",
+            "entry": [
+                {"resource": {"resourceType": "Group", "id": "Group.1"}}
+            ],
+        }
+    )
+    sink.close()
+
+    # A shard every shard_size resources of a resource type, with one
+    # resource per line
+    suffix = ".ndjson.gz" if compress else ".ndjson"
+    assert sorted(os.listdir(tmp_path)) == [
+        f"Group.0{suffix}",
+        f"Patient.0{suffix}",
+        f"Patient.1{suffix}",
+    ]
+    lines = read_lines(str(tmp_path / f"Patient.0{suffix}"))
+    assert [json.loads(line) for line in lines] == [patient(0), patient(1)]
+    assert read_lines(str(tmp_path / f"Patient.1{suffix}")) == [
+        '{"resourceType":"Patient","id":"Patient.2"}'
+    ]
+
+
+def test_null_sink(capsys):
+    sink = NullSink()
+    sink.send(patient(1))
+    sink.send(patient(2), b"{}")
+    sink.close()
+    assert dict(sink.counts) == {"Patient": 2}
+    assert sink.bytes["Patient"] == len(json.dumps(patient(1))) + 2
+    assert capsys.readouterr().out == (
+        f"Patient: 2 resources, {sink.bytes['Patient']} bytes\n"
+    )
@@ -0,0 +1,233 @@
+import threading
+
+from conftest import StandInSource
+
+from kf_model_fhir.mappers.common.sources import (
+    CopySource,
+    FanOutSource,
+    PostgresSource,
+)
+
+
+class StandInCursor:
+    def __init__(self, data, error=None):
+        self.data = data
+        self.error = error
+
+    def mogrify(self, sql, params):
+        return sql.encode()
+
+    def copy_expert(self, sql, stream):
+        stream.write(self.data)
+        if self.error:
+            raise self.error
+
+
+class StandInConnection:
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.closed = False
+
+    def cursor(self):
+        return self._cursor
+
+    def close(self):
+        self.closed = True
+
+
+class StandInResult:
+    def __init__(self, columns):
+        self.columns = columns
+
+    def keys(self):
+        return self.columns
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        return iter(())
+
+
+class StandInEngine:
+    """
+    An engine whose tables have the given columns and no rows, which
+    records the SQL it executes
+    """
+
+    def __init__(self, connection=None, error=None, columns=()):
+        self.connection = connection
+        self.error = error
+        self.columns = list(columns)
+        self.executed = []
+
+    def execute(self, sql, params=None):
+        self.executed.append((sql, params))
+        return StandInResult(self.columns)
+
+    def raw_connection(self):
+        if self.error:
+            raise self.error
+        return self.connection
+
+
+def read(source, sql):
+    """
+    Read a COPY from another thread, so that a hang fails the test
+    """
+    rows, errors = [], []
+
+    def run():
+        try:
+            rows.extend(source._copy(sql))
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive(), "the COPY reader hung"
+    return rows, errors
+
+
+def test_copy():
+    connection = StandInConnection(StandInCursor(b"a,1\nb,\n"))
+    rows, errors = read(CopySource(StandInEngine(connection)), "SELECT")
+    assert rows == [("a", "1"), ("b", "")]
+    assert not errors
+    assert connection.closed
+
+
+def test_copy_connection_failure():
+    engine = StandInEngine(error=ConnectionError("no warehouse"))
+    rows, errors = read(CopySource(engine), "SELECT")
+    assert rows == []
+    assert isinstance(errors[0], ConnectionError)
+
+
+def test_copy_failure():
+    connection = StandInConnection(
+        StandInCursor(b"a,1\n", RuntimeError("COPY failed"))
+    )
+    rows, errors = read(CopySource(StandInEngine(connection)), "SELECT")
+    assert isinstance(errors[0], RuntimeError)
+    assert connection.closed
+
+
+def test_postgres_select_sql():
+    engine = StandInEngine(columns=["person1", "person2", "relation"])
+    source = PostgresSource(engine)
+    list(
+        source.select(
+            "t",
+            ["person2", "person1", "relation", "missing"],
+            required=["person2"],
+            where={"person2": {"p2"}},
+        )
+    )
+    assert engine.executed[-1] == (
+        'SELECT DISTINCT "person2","person1","relation" FROM t WHERE '
+        "\"person2\" IS NOT NULL AND \"person2\"::text <> '' AND "
+        '"person2"::text IN %(where_0)s;',
+        {"where_0": ("p2",)},
+    )
+
+    list(
+        source.select(
+            "t", ["person1", "person2", "relation"], group_by=["person2"]
+        )
+    )
+    # The lists of a group are ordered alike
+    assert engine.executed[-1] == (
+        'SELECT "person2",'
+        'array_agg("person1" ORDER BY "person1","relation") AS "person1",'
+        'array_agg("relation" ORDER BY "person1","relation") AS "relation" '
+        'FROM (SELECT DISTINCT "person1","person2","relation" FROM t) '
+        'AS projection GROUP BY "person2";',
+        None,
+    )
+
+    # Nothing is selected when a required column doesn't exist
+    executed = len(engine.executed)
+    assert list(source.select("t", ["person1"], required=["missing"])) == []
+    assert len(engine.executed) == executed
+
+
+def fan_out():
+    source = StandInSource(
+        {
+            "t": (
+                ["participant", "family", "specimen"],
+                [("p1", "f1", "s1"), ("p1", "f1", "s2"), ("p2", "f1", "")],
+            )
+        }
+    )
+    projections = {
+        "t": [("participant", "family"), ("participant", "specimen")]
+    }
+    return source, FanOutSource(source, projections)
+
+
+def test_fan_out():
+    source, fanned_out = fan_out()
+    assert list(
+        fanned_out.select("t", ("participant", "family"), group_by=("family",))
+    ) == [{"family": "f1", "participant": ["p1", "p2"]}]
+    assert list(
+        fanned_out.select(
+            "t", ("participant", "specimen"), required=("specimen",)
+        )
+    ) == [
+        {"participant": "p1", "specimen": "s1"},
+        {"participant": "p1", "specimen": "s2"},
+    ]
+    # Some of the columns of a projection, filtered on one of them
+    assert list(
+        fanned_out.select(
+            "t", ("participant",), where={"participant": {"p2"}}
+        )
+    ) == [{"participant": "p2"}]
+    assert source.scans == 1
+
+    # Columns that no projection has together go to the source
+    assert len(list(fanned_out.select("t", ("family", "specimen")))) == 3
+    assert source.scans == 2
+
+
+def test_fan_out_release():
+    source, fanned_out = fan_out()
+    list(fanned_out.select("t", ("participant", "family")))
+    fanned_out.release("t", ("participant", "family"))
+    assert list(fanned_out._rows["t"]) == [("participant", "specimen")]
+    list(fanned_out.select("t", ("participant", "specimen")))
+    assert source.scans == 1
+
+    # Once no projection of the table is kept, its rows are dropped and
+    # selects go to the source instead of extracting it again
+    fanned_out.release("t", ("participant", "specimen"))
+    assert "t" not in fanned_out._rows
+    assert len(list(fanned_out.select("t", ("participant", "family")))) == 2
+    assert source.scans == 2
+    assert "t" not in fanned_out._rows
+
+
+def test_fan_out_count():
+    source, fanned_out = fan_out()
+    assert source.count("t", ("participant", "family")) is None
+    assert (
+        fanned_out.count("t", ("participant", "family"), group_by=("family",))
+        == 1
+    )
+    assert (
+        fanned_out.count(
+            "t", ("participant", "specimen"), required=("specimen",)
+        )
+        == 2
+    )
+    assert source.scans == 1
+
+    # Rows that aren't held aren't counted
+    fanned_out.release("t", ("participant", "family"))
+    fanned_out.release("t", ("participant", "specimen"))
+    assert fanned_out.count("t", ("participant", "family")) is None
+    assert source.scans == 1